@@ -0,0 +1,189 @@
+"""
+推論前の受付制御（アドミッションコントロール）
+
+    admission = AdmissionController("qwen3-vl")
+    with admission.admit(client_id(request)) as ticket:
+        ocr_image(image, degraded=ticket.degraded)
+
+- 処理中・待機中のリクエスト数が上限を超えたら即座に拒否する
+- 同じクライアントからの同時実行数を制限する
+- 直近の処理間隔から完了までの時間を推定し、SLOを超える場合は
+  画素数予算を下げた縮退モードで受け付けるか、待たせずに拒否する
+"""
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# 処理中＋待機中のリクエスト数の上限（0で無制限）
+MAX_QUEUE = int(os.environ.get("OCR_ADMISSION_MAX_QUEUE", "16"))
+# クライアント（IPアドレス）ごとの同時実行数の上限（0で無制限）
+MAX_PER_CLIENT = int(os.environ.get("OCR_ADMISSION_MAX_PER_CLIENT", "4"))
+# 受付から完了までの目標時間（秒、0で推定待ち時間による判定を行わない）
+SLO_SECONDS = float(os.environ.get("OCR_ADMISSION_SLO_SECONDS", "60"))
+# 推定時間がSLOの何倍までなら縮退モードで受け付けるか（1以下で縮退モードを使わない）
+DEGRADE_MARGIN = float(os.environ.get("OCR_ADMISSION_DEGRADE_MARGIN", "1.5"))
+# 処理時間の実測値がないうちに使う1件あたりの処理間隔（秒）
+INITIAL_SERVICE_SECONDS = float(os.environ.get("OCR_ADMISSION_INITIAL_SECONDS", "10"))
+# 縮退モードで適用する画素数予算の倍率
+DEGRADED_PIXEL_RATIO = float(os.environ.get("OCR_DEGRADED_PIXEL_RATIO", "0.5"))
+# X-Forwarded-Forを追記する信頼できるプロキシの段数（右から数えてこの位置を接続元とする、0でヘッダを使わない）
+#   Cloud Run直接は1、外部HTTPSロードバランサ経由は2（ロードバランサが接続元と自身のアドレスを追記する）
+TRUSTED_PROXIES = int(os.environ.get("OCR_TRUSTED_PROXIES", "1"))
+# Gradio UIのキューに積める最大件数（超えた分はGradioが即座にエラーを返す）
+UI_QUEUE_MAX_SIZE = int(os.environ.get("OCR_UI_QUEUE_MAX_SIZE", "32"))
+
+# 処理間隔の指数移動平均の重み
+EWMA_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """受付を拒否したときに送出する（statusはHTTPステータス、retry_afterは再試行までの秒数）"""
+
+    def __init__(self, message, status=503, retry_after=None, reason="overloaded"):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Ticket:
+    """受け付けたリクエスト（measuredがFalseのものは処理間隔の計測に使わない）"""
+
+    def __init__(self, client, degraded, estimated_seconds):
+        self.client = client
+        self.degraded = degraded
+        self.estimated_seconds = estimated_seconds
+        self.measured = True
+
+
+def client_id(request, trusted_proxies=None):
+    """
+    StarletteのRequestまたはgr.Requestからクライアントを識別する文字列を返す
+
+    X-Forwarded-Forの左側はクライアントが自由に書けるため、信頼できるプロキシが追記した
+    右からtrusted_proxies番目（既定はOCR_TRUSTED_PROXIES）の値を接続元とする
+    """
+    if request is None:
+        return None
+    trusted_proxies = TRUSTED_PROXIES if trusted_proxies is None else trusted_proxies
+    headers = getattr(request, "headers", None) or {}
+    forwarded = [hop.strip() for hop in headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    if forwarded and trusted_proxies > 0:
+        return forwarded[max(0, len(forwarded) - trusted_proxies)]
+    client = getattr(request, "client", None)
+    return getattr(client, "host", None)
+
+
+class AdmissionController:
+    """
+    1つのモデルを共有するリクエストの受付判定
+
+    完了までの推定時間 = (処理中＋待機中の件数 + 1) × 1件あたりの処理間隔
+    処理間隔は、処理が途切れていない間の完了間隔の指数移動平均
+    （バッチ推論では1バッチの時間をバッチ内の件数で割った値に近づく）
+    """
+
+    def __init__(self, name, max_queue=MAX_QUEUE, max_per_client=MAX_PER_CLIENT, slo_seconds=SLO_SECONDS,
+                 degrade_margin=DEGRADE_MARGIN, initial_service_seconds=INITIAL_SERVICE_SECONDS):
+        self.name = name
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self.slo_seconds = slo_seconds
+        self.degrade_margin = degrade_margin
+        self.service_interval = initial_service_seconds
+        self.in_flight = 0
+        self.counts = {"accepted": 0, "degraded": 0, "queue_full": 0, "client_limit": 0, "slo": 0}
+        self._clients = {}
+        self._busy_since = None
+        self._last_completion = None
+        self._lock = threading.Lock()
+
+    def estimate_seconds(self):
+        """今受け付けたリクエストが完了するまでの推定時間"""
+        return (self.in_flight + 1) * self.service_interval
+
+    def acquire(self, client=None):
+        """受付判定を行いTicketを返す（受け付けられない場合はAdmissionRejectedを送出）"""
+        with self._lock:
+            if self.max_queue and self.in_flight >= self.max_queue:
+                self.counts["queue_full"] += 1
+                raise AdmissionRejected(
+                    f"混雑しています（処理待ち{self.in_flight}件）。しばらくしてから再度お試しください",
+                    status=503, retry_after=math.ceil(self.service_interval), reason="queue_full",
+                )
+            if client is not None and self.max_per_client and self._clients.get(client, 0) >= self.max_per_client:
+                self.counts["client_limit"] += 1
+                raise AdmissionRejected(
+                    f"同時に処理できるのは1クライアントあたり{self.max_per_client}件までです",
+                    status=429, retry_after=math.ceil(self.service_interval), reason="client_limit",
+                )
+
+            estimated = self.estimate_seconds()
+            degraded = False
+            if self.slo_seconds and estimated > self.slo_seconds:
+                if estimated <= self.slo_seconds * self.degrade_margin:
+                    degraded = True
+                else:
+                    self.counts["slo"] += 1
+                    raise AdmissionRejected(
+                        f"混雑しています（推定待ち時間 約{estimated:.0f}秒）。しばらくしてから再度お試しください",
+                        status=503, retry_after=math.ceil(estimated - self.slo_seconds), reason="slo",
+                    )
+
+            if self.in_flight == 0:
+                self._busy_since = time.monotonic()
+            self.in_flight += 1
+            if client is not None:
+                self._clients[client] = self._clients.get(client, 0) + 1
+            self.counts["degraded" if degraded else "accepted"] += 1
+
+        if degraded:
+            print(f"[{self.name}] 縮退モードで受け付けました (推定 {estimated:.1f}秒 / SLO {self.slo_seconds:.0f}秒)")
+        return Ticket(client, degraded, estimated)
+
+    def release(self, ticket):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            if ticket.client is not None:
+                remaining = self._clients.get(ticket.client, 1) - 1
+                if remaining > 0:
+                    self._clients[ticket.client] = remaining
+                else:
+                    self._clients.pop(ticket.client, None)
+
+            # キャッシュヒットやエラーは処理間隔を実際より短く見せるため計測しない
+            if ticket.measured and self._busy_since is not None:
+                interval = now - max(self._busy_since, self._last_completion or self._busy_since)
+                self.service_interval += EWMA_ALPHA * (interval - self.service_interval)
+                self._last_completion = now
+            if self.in_flight == 0:
+                self._busy_since = None
+                self._last_completion = None
+
+    @contextmanager
+    def admit(self, client=None):
+        ticket = self.acquire(client)
+        try:
+            yield ticket
+        except BaseException:
+            ticket.measured = False
+            raise
+        finally:
+            self.release(ticket)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self.counts,
+                in_flight=self.in_flight,
+                service_interval=round(self.service_interval, 3),
+                estimated_seconds=round(self.estimate_seconds(), 3),
+            )
+
+
+def degraded_pixels(max_pixels):
+    """縮退モードで使う画素数の上限"""
+    return max(1, int(max_pixels * DEGRADED_PIXEL_RATIO))
@@ -1,155 +1,614 @@
-from transformers import Qwen3VLForConditionalGeneration, AutoProcessor
-from PIL import Image
+from transformers import TextIteratorStreamer
 import torch
 import os
 import gradio as gr
-import io
-
-print("Qwen3-VL-2Bモデルを読み込んでいます...")
+from threading import Thread
+from contextlib import closing
+from batching import MicroBatcher
+from ocr_cache import cache_from_env
+from batch_documents import process_documents
+from preprocess import MAX_PIXELS, preprocess_image, preprocess_settings
+from rest_api import create_api, decode_image, serve
+from metrics import (PrefillTimer, RequestTrace, active_traces, register_admission, register_cache, register_jobs,
+                     register_near_duplicates, stage, track)
+from admission import AdmissionController, AdmissionRejected, client_id, degraded_pixels
+from prepared_model import is_prepared, load_prepared
+from quantization import quantization_label, quantize_from_env
+from prompt_cache import PretokenizedPrompt
+from generation_control import (FINISH_CANCELLED, FINISH_LENGTH, FINISH_REPETITION, GenerationMonitor, StopFlag,
+                                adaptive_max_new_tokens, combine_generation, generation_settings, stopping_criteria)
+from tiling import needs_tiling, ocr_tiles, tiling_settings
+from worker_pool import WORKERS, WorkerPool, is_frontend
+from job_queue import JobQueue
+from web_common import (get_adsense_bottom, get_adsense_script, get_adsense_top, get_analytics_script, get_favicon,
+                        is_embedded)
+from model_registry import ModelNotReady, ModelRegistry, warmup_image
+from thread_tuning import applied_profile, apply_thread_profile
+from phash_index import index_from_env
 
 # モデルとプロセッサーの読み込み
 model_name = "Qwen/Qwen3-VL-2B-Instruct"
-processor = AutoProcessor.from_pretrained(model_name)
-model = Qwen3VLForConditionalGeneration.from_pretrained(
-    model_name,
-    torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
-    device_map="auto"
-)
+
+# CPU推論用の変換済みモデル（python prepared_model.py qwen で作成）
+PREPARED_MODEL_DIR = os.environ.get("OCR_PREPARED_MODEL_DIR", "./models/qwen3-vl-2b-cpu")
+
+# stubの場合は重みを読み込まずにスタブモデルで動かす（ベンチマーク・動作確認用）
+MODEL_BACKEND = os.environ.get("OCR_MODEL_BACKEND", "hf")
+
+# OCR_WORKERS>0の場合、このプロセスはモデルを読み込まず推論をワーカープロセスに任せる
+SERVE_WITH_WORKERS = is_frontend()
+
+# モデル・プロセッサー・推論ワーカーはload_model()で設定する（importの時点では読み込まない）
+processor = model = prompt_inputs = worker_pool = None
+
+# CPU環境ではOCR_QUANTIZE=int8でLinearの重みをint8に量子化する（ワーカー使用時は各ワーカーで行う）
+QUANTIZATION = quantization_label()
 
 # デバイス確認
 device = "cuda" if torch.cuda.is_available() else "cpu"
-print(f"モデル読み込み完了 (デバイス: {device})")
-print(f"モデル: {model_name}")
 
-def process_image_ocr(image):
+# メトリクス・キャッシュ等で使用するアプリ名
+APP_NAME = "qwen3-vl"
+# 統合アプリ・推論ワーカーから読み込まれた場合はOCR処理だけを提供する（受付制御・UIは作らない）
+EMBEDDED = is_embedded()
+
+# OCR用の指示文
+OCR_PROMPT = "この画像に含まれるすべてのテキストを正確に抽出してください。テキストのみを出力し、説明は不要です。"
+# 生成トークン数の上限（OCR_ADAPTIVE_MAX_TOKENS=0の場合、またはテキスト密度が不明な場合に使う）
+MAX_NEW_TOKENS = 512
+
+# マイクロバッチ設定（環境変数から取得）
+BATCH_MAX_SIZE = int(os.environ.get("OCR_BATCH_MAX_SIZE", "4"))
+BATCH_WAIT_MS = float(os.environ.get("OCR_BATCH_WAIT_MS", "50"))
+
+# ストリーミング表示の初期値（ストリーミングはマイクロバッチを通らず1件ずつ生成するため、既定では無効）
+STREAMING_DEFAULT = os.environ.get("OCR_STREAMING", "0") == "1"
+
+# デコード設定（バッチ処理とストリーミングで共通）
+DECODE_KWARGS = {
+    "skip_special_tokens": True,
+    "clean_up_tokenization_spaces": False,
+}
+
+def build_messages(image):
+    """OCR用のメッセージを構築"""
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "image": image,
+                },
+                {
+                    "type": "text",
+                    "text": OCR_PROMPT
+                },
+            ],
+        }
+    ]
+
+def load_model():
+    """
+    モデル・プロセッサーを読み込んでモジュールの変数に設定する（model_registryから呼ばれる）
+
+    ワーカー使用時はモデルを読み込まず、推論ワーカーを起動してモデルの読み込みが終わるまで待つ
+    """
+    global processor, model, prompt_inputs, worker_pool, QUANTIZATION
+    if SERVE_WITH_WORKERS:
+        print(f"推論ワーカー{WORKERS}個で起動します（このプロセスではモデルを読み込みません）")
+        if MODEL_BACKEND != "stub" and not torch.cuda.is_available() and not is_prepared(PREPARED_MODEL_DIR):
+            print("警告: 変換済みモデルがないため、重みはワーカーごとに別々のメモリに読み込まれます")
+        worker_pool = WorkerPool("app").start()
+        return
+
+    from transformers import AutoProcessor, Qwen3VLForConditionalGeneration
+
+    # CPU推論のスレッド数を設定する（生成はマイクロバッチ単位で1件ずつ実行される）
+    apply_thread_profile(streams=1)
+    print("Qwen3-VL-2Bモデルを読み込んでいます...")
+    if MODEL_BACKEND == "stub":
+        from stub_models import load_stub_qwen
+        print("スタブモデルを使用します（OCR_MODEL_BACKEND=stub）")
+        loaded_processor, loaded_model = load_stub_qwen()
+    elif not torch.cuda.is_available() and is_prepared(PREPARED_MODEL_DIR):
+        # float32変換済みの重みをメモリマップして読み込む
+        print(f"変換済みモデルを読み込んでいます: {PREPARED_MODEL_DIR}")
+        loaded_processor = AutoProcessor.from_pretrained(PREPARED_MODEL_DIR)
+        loaded_model = load_prepared(Qwen3VLForConditionalGeneration, PREPARED_MODEL_DIR)
+    else:
+        loaded_processor = AutoProcessor.from_pretrained(model_name)
+        loaded_model = Qwen3VLForConditionalGeneration.from_pretrained(
+            model_name,
+            torch_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
+            device_map="auto"
+        )
+
+    QUANTIZATION = quantize_from_env(loaded_model)
+    # バッチ生成ではプロンプト末尾を揃えるため左詰めでパディングする
+    loaded_processor.tokenizer.padding_side = "left"
+    # 指示文は固定のため、チャットテンプレートの展開とトークナイズは読み込み時に1回だけ行う
+    prompt_inputs = PretokenizedPrompt(loaded_processor, build_messages)
+    processor, model = loaded_processor, loaded_model
+    print(f"モデル読み込み完了 (デバイス: {device})")
+    print(f"モデル: {model_name}")
+
+def warmup_model():
+    """合成画像で1回推論する（ワーカー使用時は各ワーカーの読み込みで行う）"""
+    if not SERVE_WITH_WORKERS:
+        run_ocr_batch([warmup_image()], [16])
+
+def unload_model():
+    """モデル・プロセッサー（ワーカー使用時は推論ワーカー）を手放す（次の推論で再び読み込まれる）"""
+    global processor, model, prompt_inputs, worker_pool
+    if worker_pool is not None:
+        worker_pool.close()
+    processor = model = prompt_inputs = worker_pool = None
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+# モデルの読み込みと準備状態（サーバー起動時にOCR_MODEL_LOADINGに従って読み込む）
+models = ModelRegistry().register(APP_NAME, load_model, warmup_model, unload_model)
+
+def prepare_inputs(images):
+    """画像のリストからモデル入力を作成"""
+    models.require(APP_NAME)
+    with stage("processor"):
+        inputs = prompt_inputs(images)
+        return inputs.to(model.device)
+
+def generation_monitor(inputs, limits):
+    """行ごとの上限トークン数と繰り返しの検出を行う終了条件を作る"""
+    tokenizer = processor.tokenizer
+    eos_token_id = model.generation_config.eos_token_id if hasattr(model, "generation_config") else None
+    eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+    return GenerationMonitor(
+        inputs.input_ids.shape[1], limits, eos_token_ids + [tokenizer.eos_token_id, tokenizer.pad_token_id]
+    )
+
+def run_ocr_batch(images, limits=None):
+    """
+    複数の画像を1回のprocessor呼び出しと1回のgenerateでまとめて処理
+
+    limitsは画像ごとの生成トークン数の上限（省略時はMAX_NEW_TOKENS）
+    戻り値: 画像ごとの {"text": 抽出テキスト, "max_new_tokens", "generated_tokens", "finish_reason"}
+    """
+    limits = list(limits) if limits else [MAX_NEW_TOKENS] * len(images)
+    inputs = prepare_inputs(images)
+    traces = active_traces()
+    monitor = generation_monitor(inputs, limits)
+
+    # 推論実行（最初のトークンまでをprefill、以降をdecodeとして計測）
+    # 上限はバッチ内の最大値とし、各行は自分の上限に達するか繰り返しを検出した時点で終える
+    with torch.no_grad():
+        generated_ids = model.generate(
+            **inputs,
+            max_new_tokens=max(limits),
+            do_sample=False,
+            stopping_criteria=stopping_criteria(monitor),
+            streamer=PrefillTimer(traces)
+        )
+
+    # 入力部分を除去してデコード
+    with stage("postprocess"):
+        prompt_length = inputs.input_ids.shape[1]
+        rows = [monitor.finalize(row, out_ids[prompt_length:]) for row, out_ids in enumerate(generated_ids)]
+        output_texts = processor.batch_decode([ids for ids, _, _ in rows], **DECODE_KWARGS)
+
+    results = []
+    for row, (text, (_, tokens, reason)) in enumerate(zip(output_texts, rows)):
+        trace = traces[row] if row < len(traces) else None
+        if trace is not None:
+            trace.set("generated_tokens", tokens)
+            trace.set("finish_reason", reason)
+        results.append({
+            "text": text.strip(),
+            "max_new_tokens": limits[row],
+            "generated_tokens": tokens,
+            "finish_reason": reason,
+        })
+    return results
+
+def run_ocr_requests(requests):
+    """バッチスケジューラから呼ばれる（requestは {"image", "max_new_tokens"}）"""
+    return run_ocr_batch(
+        [request["image"] for request in requests],
+        [request["max_new_tokens"] for request in requests]
+    )
+
+def stream_ocr(image, trace=None, max_new_tokens=MAX_NEW_TOKENS, outcome=None):
+    """
+    1枚の画像を推論し、生成途中のテキストを逐次返すジェネレータ
+
+    outcomeにdictを渡すと、終了後に生成トークン数・終了理由を書き込む
+    繰り返しで打ち切った場合は、最後に繰り返し部分を除いたテキストを返す
+    ジェネレータが途中で閉じられた場合（クライアントの切断など）は生成を打ち切る
+    """
+    # ジェネレータは呼び出しごとに別スレッドで再開されうるため、yieldをまたいでtrackしない
+    traces = (trace,) if trace is not None else ()
+    with track(*traces):
+        inputs = prepare_inputs([image])
+    monitor = generation_monitor(inputs, [max_new_tokens])
+    stop = StopFlag()
+    finished = []
+
+    # skip_promptで入力部分を除去し、batch_decodeと同じ設定でデコードする
+    streamer = TextIteratorStreamer(processor.tokenizer, skip_prompt=True, **DECODE_KWARGS)
+    errors = []
+
+    def generate():
+        try:
+            # バッチ推論と同じ実行枠で1件ずつ生成し、torchのスレッドを取り合わないようにする
+            with ocr_batcher.slot:
+                if stop.is_set():
+                    # 実行枠を待つ間に切断された
+                    streamer.end()
+                    return
+                with torch.no_grad():
+                    generated_ids = model.generate(
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        do_sample=False,
+                        stopping_criteria=stopping_criteria(monitor, [stop]),
+                        streamer=PrefillTimer(traces, inner=streamer)
+                    )
+            ids, tokens, reason = monitor.finalize(0, generated_ids[0][inputs.input_ids.shape[1]:])
+            if stop.is_set():
+                reason = FINISH_CANCELLED
+            finished.append((ids, tokens, reason))
+            for stream_trace in traces:
+                stream_trace.set("generated_tokens", tokens)
+                stream_trace.set("finish_reason", reason)
+        except Exception as e:
+            errors.append(e)
+            # 受信側が待ち続けないようにストリームを終了させる
+            streamer.end()
+
+    thread = Thread(target=generate, name="qwen3-vl-stream", daemon=True)
+    thread.start()
+
+    output_text = ""
+    try:
+        for chunk in streamer:
+            output_text += chunk
+            yield output_text
+    except GeneratorExit:
+        # 途中で閉じられた場合は生成を止め、実行枠を次の推論に渡す
+        stop.set()
+        raise
+    thread.join()
+
+    if errors:
+        raise errors[0]
+
+    ids, tokens, reason = finished[0]
+    if reason == FINISH_REPETITION:
+        yield processor.batch_decode([ids], **DECODE_KWARGS)[0]
+    if outcome is not None:
+        outcome.update(max_new_tokens=max_new_tokens, generated_tokens=tokens, finish_reason=reason)
+
+# 同時に届いたリクエストをまとめて推論するスケジューラ
+ocr_batcher = MicroBatcher(
+    run_ocr_requests,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_WAIT_MS,
+    name=APP_NAME
+)
+
+# ワーカープロセスで同時に受け付ける件数（ワーカー内のバッチスケジューラでまとめて推論される）
+WORKER_CONCURRENCY = BATCH_MAX_SIZE
+
+def worker_infer(request, trace):
+    """ワーカープロセスでの1件分の推論（ocr_worker.pyから呼ばれる）"""
+    return ocr_batcher.submit(request, trace=trace)
+
+# UI・一括処理で同時に推論へ投入する件数（ワーカー使用時はワーカー数倍）
+PARALLELISM = BATCH_MAX_SIZE * (WORKERS if SERVE_WITH_WORKERS else 1)
+
+# 同じ画像の再アップロードに備えた結果キャッシュ
+result_cache = cache_from_env(APP_NAME)
+register_cache(APP_NAME, result_cache)
+# 撮り直し・圧縮し直しなど、ほぼ同一の画像に過去の結果を返す知覚ハッシュの索引
+near_duplicates = index_from_env(APP_NAME, result_cache)
+register_near_duplicates(APP_NAME, near_duplicates)
+
+# 混雑時に待たせずに拒否・縮退させる受付制御（UI・API・一括処理で共有）
+# 統合アプリから読み込まれた場合は統合アプリの受付制御を使うため作らない
+admission = None
+if not EMBEDDED:
+    admission = AdmissionController(APP_NAME)
+    register_admission(APP_NAME, admission)
+
+def cache_settings():
+    """キャッシュキーに含める処理パラメータ（ほぼ同一画像の索引も同じ設定の結果の中から探す）"""
+    return {
+        "model": model_name,
+        "prompt": OCR_PROMPT,
+        "max_new_tokens": MAX_NEW_TOKENS,
+        "generation": generation_settings(),
+        "tiling": tiling_settings(),
+        "quantization": QUANTIZATION,
+        "preprocess": preprocess_settings(),
+    }
+
+def get_cache_key(image):
+    return result_cache.make_key(image, **cache_settings())
+
+def preprocess_request(image, degraded=False):
+    """前処理（縮退モードでは画素数予算を下げて推論を軽くする）"""
+    if not degraded:
+        return preprocess_image(image)
+    image, info = preprocess_image(image, max_pixels=degraded_pixels(MAX_PIXELS))
+    info["degraded"] = True
+    return image, info
+
+def infer_request(image, info, trace=None):
+    """前処理済みの画像1枚を推論する（ワーカープロセスまたはバッチスケジューラへ送る）"""
+    # テキスト密度から生成トークン数の上限を決める
+    request = {"image": image, "max_new_tokens": adaptive_max_new_tokens(info, MAX_NEW_TOKENS)}
+    # 読み込み中はここで待つ（キャッシュにある結果は読み込み中でも返せる）
+    models.require(APP_NAME)
+    if worker_pool is not None:
+        return worker_pool.call(request, trace)
+    return ocr_batcher.submit(request, trace=trace)
+
+def ocr_tile(tile):
+    """タイル1枚の推論（余白除去は分割前に済ませている）"""
+    tile, info = preprocess_image(tile, trim=False)
+    return infer_request(tile, info)
+
+def ocr_tiled(image):
+    """
+    大きな画像をタイルに分割して並列に推論し、ocr_imageと同じ形の結果を返す
+
+    タイルはバッチスケジューラ（ワーカー使用時は各ワーカー）に同時に投入され、まとめて推論される
+    """
+    with stage("tiles"):
+        tiled = ocr_tiles(image, MAX_PIXELS, ocr_tile, max_workers=PARALLELISM)
+    results = [tile["result"] for tile in tiled["tiles"] if tile["result"] is not None]
+    generation = combine_generation(results)
+    for trace in active_traces():
+        if trace is not None:
+            trace.set("tiles", len(results))
+            trace.set("generated_tokens", generation["generated_tokens"])
+            trace.set("finish_reason", generation["finish_reason"])
+    info = dict(tiled["tiling"], original_size=[image.width, image.height], tiled=True)
+    info["tile_results"] = [
+        {
+            "row": tile["row"], "col": tile["col"], "box": tile["box"], "skipped": tile["skipped"],
+            "finish_reason": tile["result"]["finish_reason"] if tile["result"] else None,
+        }
+        for tile in tiled["tiles"]
+    ]
+    return {"text": tiled["text"], "preprocess": info, "generation": generation}
+
+def ocr_image(image, trace=None, degraded=False):
+    """
+    1枚の画像からテキストを抽出（キャッシュ→前処理→バッチスケジューラの順に処理、失敗時は例外を送出）
+
+    戻り値: {"text": 抽出テキスト, "preprocess": 前処理パラメータ,
+            "generation": 生成トークン数の上限・生成トークン数・終了理由, "cached": キャッシュから返したか}
+    traceを渡した場合は各段階の所要時間を記録する（終了処理は呼び出し側で行う）
+    degradedの場合は画素数予算を下げて処理し、結果はキャッシュしない
+    キャッシュにない画像は知覚ハッシュでほぼ同一の画像の結果を探す（見つかればnear_duplicateに距離を付けて返す）
+    画素数予算に比べて大きな画像はタイルに分割して推論する（縮退モードでは分割せず縮小する）
+    """
+    own_trace = trace is None
+    if own_trace:
+        trace = RequestTrace(APP_NAME)
+    status = "error"
+
+    try:
+        with track(trace):
+            # PIL Imageはファイルを経由せずメモリ上でそのままバッチスケジューラへ渡す
+            with stage("upload_decode"):
+                if image.mode != "RGB":
+                    image = image.convert("RGB")
+
+            with stage("cache_lookup"):
+                cache_key = get_cache_key(image)
+                cached = result_cache.get(cache_key)
+            if cached is not None:
+                print(f"キャッシュから結果を返します: {result_cache.stats()}")
+                status = "cached"
+                return dict(cached, cached=True)
+
+            with stage("near_duplicate_lookup"):
+                settings = cache_settings()
+                near, fingerprint = near_duplicates.find(image, settings, result_cache)
+            if near is not None:
+                print(f"ほぼ同一の画像の結果を返します: {near['near_duplicate']}")
+                status = "near_duplicate"
+                return dict(near, cached=True)
+
+            if not degraded and needs_tiling(image, MAX_PIXELS):
+                result = ocr_tiled(image)
+            else:
+                # 画素数予算に合わせて縮小・余白除去してからモデルに渡す
+                with stage("preprocess"):
+                    image, info = preprocess_request(image, degraded)
+                result = None
+
+        if result is None:
+            output = infer_request(image, info, trace)
+            text = output.pop("text")
+            result = {"text": text, "preprocess": info, "generation": output}
+        if not degraded:
+            result_cache.put(cache_key, result)
+            near_duplicates.add(fingerprint, settings, cache_key)
+        status = "ok"
+        return dict(result, cached=False)
+    finally:
+        if own_trace:
+            trace.finish(status)
+
+def display_info(result):
+    """UIに表示する処理パラメータ（前処理と生成の結果）"""
+    return dict(result["preprocess"], generation=result["generation"])
+
+def process_image_ocr(image, request=None):
     """
     Qwen3-VLを使用して画像からテキストを抽出
     """
     if image is None:
-        return "エラー: 画像がアップロードされていません"
+        return "エラー: 画像がアップロードされていません", None
 
     try:
-        # PIL Imageを一時ファイルとして保存してパスを取得
-        # （Qwen3-VLはファイルパスまたはURLを受け取る）
-        temp_path = "/tmp/temp_ocr_image.png"
-        image.save(temp_path)
-
-        # OCR用のメッセージを構築
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "image": temp_path,
-                    },
-                    {
-                        "type": "text",
-                        "text": "この画像に含まれるすべてのテキストを正確に抽出してください。テキストのみを出力し、説明は不要です。"
-                    },
-                ],
-            }
-        ]
-
-        # プロンプトを準備
-        text_prompt = processor.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
+        with admission.admit(client_id(request)) as ticket:
+            result = ocr_image(image, degraded=ticket.degraded)
+            ticket.measured = not result["cached"]
+        return result["text"], display_info(result)
 
-        # 画像とテキストを処理
-        inputs = processor(
-            text=[text_prompt],
-            images=[Image.open(temp_path)],
-            padding=True,
-            return_tensors="pt"
-        )
-        inputs = inputs.to(model.device)
+    except (AdmissionRejected, ModelNotReady) as e:
+        return f"エラー: {e}", None
+    except Exception as e:
+        import traceback
+        error_msg = f"エラーが発生しました: {str(e)}\n\n詳細:\n{traceback.format_exc()}"
+        print(error_msg)
+        return error_msg, None
+
+def process_image_ocr_stream(image, streaming=True, request: gr.Request = None):
+    """
+    Gradio用のハンドラ（ストリーミング有効時は生成途中のテキストを順次表示）
 
-        # 推論実行
-        with torch.no_grad():
-            generated_ids = model.generate(
-                **inputs,
-                max_new_tokens=512,
-                do_sample=False
-            )
+    requestはGradioが型注釈を見て渡す接続情報（受付制御のクライアント識別に使用）
+    """
+    # ワーカープロセスでの推論・タイル分割では生成途中のテキストを受け取れないため、まとめて表示する
+    if not streaming or image is None or SERVE_WITH_WORKERS or needs_tiling(image, MAX_PIXELS):
+        yield process_image_ocr(image, request)
+        return
+
+    try:
+        ticket = admission.acquire(client_id(request))
+    except AdmissionRejected as e:
+        yield f"エラー: {e}", None
+        return
+
+    trace = RequestTrace(APP_NAME)
+    status = "error"
+    try:
+        # ジェネレータは呼び出しごとに別スレッドで再開されうるため、yieldをまたいでtrackしない
+        with track(trace):
+            with stage("upload_decode"):
+                if image.mode != "RGB":
+                    image = image.convert("RGB")
+
+            with stage("cache_lookup"):
+                cache_key = get_cache_key(image)
+                cached = result_cache.get(cache_key)
+
+            fingerprint = None
+            if cached is None:
+                with stage("near_duplicate_lookup"):
+                    settings = cache_settings()
+                    cached, fingerprint = near_duplicates.find(image, settings, result_cache)
+
+            if cached is None:
+                with stage("preprocess"):
+                    image, info = preprocess_request(image, ticket.degraded)
+                max_new_tokens = adaptive_max_new_tokens(info, MAX_NEW_TOKENS)
+
+        if cached is not None:
+            print(f"キャッシュから結果を返します: {result_cache.stats()}")
+            status = "near_duplicate" if "near_duplicate" in cached else "cached"
+            yield cached["text"], display_info(cached)
+            return
+
+        output_text = ""
+        generation = {}
+        # 切断でこのジェネレータが閉じられたとき、stream_ocrも閉じて生成を止める
+        with closing(stream_ocr(image, trace=trace, max_new_tokens=max_new_tokens, outcome=generation)) as outputs:
+            for output_text in outputs:
+                yield output_text.lstrip(), info
+
+        result = {"text": output_text.strip(), "preprocess": info, "generation": generation}
+        if not ticket.degraded:
+            result_cache.put(cache_key, result)
+            near_duplicates.add(fingerprint, settings, cache_key)
+        status = "ok"
+        yield result["text"], display_info(result)
+
+    except GeneratorExit:
+        status = "cancelled"
+        raise
+    except ModelNotReady as e:
+        yield f"エラー: {e}", None
+    except Exception as e:
+        import traceback
+        error_msg = f"エラーが発生しました: {str(e)}\n\n詳細:\n{traceback.format_exc()}"
+        print(error_msg)
+        yield error_msg, None
+    finally:
+        trace.finish(status)
+        ticket.measured = status == "ok"
+        admission.release(ticket)
 
-        # 入力部分を除去してデコード
-        generated_ids_trimmed = [
-            out_ids[len(in_ids):] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
+# 一括処理で同時に投入するページ数（バッチスケジューラでまとめて推論される）
+PAGE_WORKERS = int(os.environ.get("OCR_PAGE_WORKERS", str(PARALLELISM)))
 
-        output_text = processor.batch_decode(
-            generated_ids_trimmed,
-            skip_special_tokens=True,
-            clean_up_tokenization_spaces=False
-        )[0]
+def process_documents_ocr(files, request: gr.Request = None):
+    """
+    複数の画像・PDFをページ順に処理し、結合したテキストと処理時間を返す
 
-        # 一時ファイルを削除
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+    受付制御はページ単位で行う（混雑時に拒否されたページはエラーとして記録される）
+    """
+    client = client_id(request)
 
-        return output_text.strip()
+    def ocr_page(image):
+        with admission.admit(client) as ticket:
+            result = ocr_image(image, degraded=ticket.degraded)
+            ticket.measured = not result["cached"]
+        return result["text"]
 
+    try:
+        return process_documents(files, ocr_page, max_workers=PAGE_WORKERS)
     except Exception as e:
         import traceback
         error_msg = f"エラーが発生しました: {str(e)}\n\n詳細:\n{traceback.format_exc()}"
         print(error_msg)
-        return error_msg
-
-# Google Analytics設定（環境変数から取得）
-GA_MEASUREMENT_ID = os.environ.get("GA_MEASUREMENT_ID", "G-01HQFFXE17")
-
-# Google AdSense設定（環境変数から取得）
-ADSENSE_CLIENT_ID = os.environ.get("ADSENSE_CLIENT_ID", "")
-ADSENSE_SLOT_TOP = os.environ.get("ADSENSE_SLOT_TOP", "")
-ADSENSE_SLOT_BOTTOM = os.environ.get("ADSENSE_SLOT_BOTTOM", "")
-
-# AdSense広告HTML（設定されている場合のみ表示）
-def get_adsense_top():
-    if ADSENSE_CLIENT_ID and ADSENSE_SLOT_TOP:
-        return f"""
-        <div class="adsense-banner-top" style="text-align: center; margin: 20px 0;">
-          <ins class="adsbygoogle"
-               style="display:block"
-               data-ad-client="ca-pub-{ADSENSE_CLIENT_ID}"
-               data-ad-slot="{ADSENSE_SLOT_TOP}"
-               data-ad-format="auto"
-               data-full-width-responsive="true"></ins>
-          <script>
-               (adsbygoogle = window.adsbygoogle || []).push({{}});
-          </script>
-        </div>
-        """
-    return ""
-
-def get_adsense_bottom():
-    if ADSENSE_CLIENT_ID and ADSENSE_SLOT_BOTTOM:
-        return f"""
-        <div class="adsense-banner-bottom" style="text-align: center; margin: 20px 0;">
-          <ins class="adsbygoogle"
-               style="display:block"
-               data-ad-client="ca-pub-{ADSENSE_CLIENT_ID}"
-               data-ad-slot="{ADSENSE_SLOT_BOTTOM}"
-               data-ad-format="auto"
-               data-full-width-responsive="true"></ins>
-          <script>
-               (adsbygoogle = window.adsbygoogle || []).push({{}});
-          </script>
-        </div>
-        """
-    return ""
-
-def get_favicon():
-    """ファビコン設定"""
-    # SVGをdata URIとして埋め込み
-    favicon_svg = '''<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 64 64" width="64" height="64"><rect width="64" height="64" fill="%232563eb" rx="8"/><rect x="14" y="12" width="36" height="40" fill="white" rx="2"/><rect x="18" y="18" width="20" height="3" fill="%232563eb" rx="1"/><rect x="18" y="24" width="28" height="3" fill="%232563eb" rx="1"/><rect x="18" y="30" width="24" height="3" fill="%232563eb" rx="1"/><rect x="18" y="36" width="26" height="3" fill="%232563eb" rx="1"/><line x1="12" y1="28" x2="52" y2="28" stroke="%2360a5fa" stroke-width="2" opacity="0.7"/><circle cx="48" cy="44" r="6" fill="none" stroke="%2310b981" stroke-width="2.5"/><line x1="52" y1="48" x2="56" y2="52" stroke="%2310b981" stroke-width="2.5" stroke-linecap="round"/></svg>'''
-
-    return f'''
-    <link rel="icon" type="image/svg+xml" href="data:image/svg+xml,{favicon_svg}">
-    <link rel="apple-touch-icon" href="data:image/svg+xml,{favicon_svg}">
-    '''
+        return error_msg, ""
+
+def api_ocr(image, params, trace=None, ticket=None):
+    """
+    HTTP API用のOCR処理（JSONで返す結果を作成、受付判定はAPI側で済んでいる）
+    """
+    degraded = ticket is not None and ticket.degraded
+    result = ocr_image(image, trace=trace, degraded=degraded)
+    return {
+        "model": model_name,
+        "text": result["text"],
+        "preprocess": result["preprocess"],
+        "cached": result["cached"],
+        # ほぼ同一の画像の結果を返した場合はハッシュのハミング距離（それ以外はNone）
+        "near_duplicate": result.get("near_duplicate"),
+        "degraded": degraded and not result["cached"],
+        # finish_reason: stop（最後まで生成）/ length（上限で打ち切り）/ repetition（繰り返しで打ち切り）
+        "generation": result["generation"],
+        "truncated": result["generation"]["finish_reason"] == FINISH_LENGTH,
+        "early_stopped": result["generation"]["finish_reason"] == FINISH_REPETITION,
+        # Qwen3-VLのOCRは領域の座標を出力しない
+        "boxes": None
+    }
+
+def job_ocr(image, params, trace):
+    """非同期ジョブ用のOCR処理（結果はAPIと同じ形式、検出結果画像はない）"""
+    # ジョブは急がないため、起動直後のモデルの読み込みは完了まで待つ
+    models.require(APP_NAME, timeout=None)
+    return api_ocr(image, params, trace), None
+
+def api_health():
+    workers = worker_pool.stats() if worker_pool is not None else None
+    return {
+        "ready": models.ready() and (workers is None or any(worker["healthy"] for worker in workers)),
+        "model": model_name,
+        "loading": models.status()[APP_NAME],
+        "device": device,
+        "quantization": QUANTIZATION,
+        "threads": applied_profile(),
+        "admission": admission.stats() if admission is not None else None,
+        "prompt": prompt_inputs.stats() if prompt_inputs is not None else None,
+        "workers": workers
+    }
 
 def get_seo_meta_tags():
     """SEO最適化用メタタグ"""
@@ -196,98 +655,130 @@ def get_seo_meta_tags():
     </script>
     """
 
-def get_analytics_script():
-    """Google Analyticsトラッキングコード"""
-    if GA_MEASUREMENT_ID:
-        return f"""
-        <!-- Google tag (gtag.js) -->
-        <script async src="https://www.googletagmanager.com/gtag/js?id={GA_MEASUREMENT_ID}"></script>
-        <script>
-          window.dataLayer = window.dataLayer || [];
-          function gtag(){{dataLayer.push(arguments);}}
-          gtag('js', new Date());
-          gtag('config', '{GA_MEASUREMENT_ID}');
-        </script>
-        """
-    return ""
-
-def get_adsense_script():
-    if ADSENSE_CLIENT_ID:
-        return f"""
-        <script async src="https://pagead2.googlesyndication.com/pagead/js/adsbygoogle.js?client=ca-pub-{ADSENSE_CLIENT_ID}"
-             crossorigin="anonymous"></script>
-        """
-    return ""
-
 def get_head_scripts():
     """すべてのヘッダースクリプトとメタタグを結合"""
     return get_favicon() + get_seo_meta_tags() + get_analytics_script() + get_adsense_script()
 
-# Gradioインターフェースの作成
-with gr.Blocks(
-    title="無料OCRツール - 画像からテキスト抽出 | AI文字認識 Qwen3-VL",
-    head=get_head_scripts()
-) as demo:
-    # トップバナー広告
-    if get_adsense_top():
-        gr.HTML(get_adsense_top())
-
-    gr.Markdown(
-        """
-        # Qwen3-VL OCR - 高精度テキスト認識ツール
-
-        Qwen3-VL-2Bを使用した最新の光学文字認識（OCR）ツールです。
-        32言語対応、低照度・傾き・ぼかしにも強い高精度なテキスト抽出が可能です。
-        """
-    )
+def create_demo():
+    """Gradioインターフェースを作成する"""
+    with gr.Blocks(
+        title="無料OCRツール - 画像からテキスト抽出 | AI文字認識 Qwen3-VL",
+        head=get_head_scripts()
+    ) as demo:
+        # トップバナー広告
+        if get_adsense_top():
+            gr.HTML(get_adsense_top())
+
+        gr.Markdown(
+            """
+            # Qwen3-VL OCR - 高精度テキスト認識ツール
+
+            Qwen3-VL-2Bを使用した最新の光学文字認識（OCR）ツールです。
+            32言語対応、低照度・傾き・ぼかしにも強い高精度なテキスト抽出が可能です。
+            """
+        )
 
-    with gr.Row():
-        with gr.Column():
-            image_input = gr.Image(
-                type="pil",
-                label="画像をアップロード"
-            )
-
-            submit_btn = gr.Button("テキスト抽出", variant="primary")
-
-        with gr.Column():
-            output_text = gr.Textbox(
-                label="抽出されたテキスト",
-                lines=15,
-                max_lines=30,
-                placeholder="結果がここに表示されます...",
-                show_copy_button=True
-            )
-
-    gr.Markdown(
-        """
-        ### 使い方
-        1. 画像をアップロード（PNG, JPG, etc.）
-        2. 「テキスト抽出」ボタンをクリック
-        3. 抽出されたテキストが表示されます
-
-        ### 対応言語
-        - 日本語、英語、中国語など32言語に対応
-        - 低照度・ぼかし・傾きがある画像でも高精度
-
-        ### 特徴
-        - 稀な文字・専門用語にも対応
-        - 長文書の構造解析が可能
-        - 印刷文字・手書き文字両方に対応
-        """
-    )
+        with gr.Tabs():
+            with gr.Tab("画像1枚"):
+                with gr.Row():
+                    with gr.Column():
+                        image_input = gr.Image(
+                            type="pil",
+                            label="画像をアップロード"
+                        )
+
+                        streaming_checkbox = gr.Checkbox(
+                            value=STREAMING_DEFAULT,
+                            label="生成中のテキストを逐次表示する（混雑時は処理が遅くなります）"
+                        )
+
+                        submit_btn = gr.Button("テキスト抽出", variant="primary")
+
+                    with gr.Column():
+                        output_text = gr.Textbox(
+                            label="抽出されたテキスト",
+                            lines=15,
+                            max_lines=30,
+                            placeholder="結果がここに表示されます...",
+                            show_copy_button=True
+                        )
+
+                        preprocess_info = gr.JSON(
+                            label="処理パラメータ（余白除去・リサイズ・生成トークン数）"
+                        )
+
+            with gr.Tab("一括処理（複数画像・PDF）"):
+                with gr.Row():
+                    with gr.Column():
+                        files_input = gr.File(
+                            file_count="multiple",
+                            file_types=["image", ".pdf"],
+                            label="画像・PDFをアップロード（複数可）"
+                        )
+
+                        batch_btn = gr.Button("一括テキスト抽出", variant="primary")
+
+                        batch_timings = gr.Markdown()
+
+                    with gr.Column():
+                        batch_output = gr.Textbox(
+                            label="抽出されたテキスト（ページ順）",
+                            lines=15,
+                            max_lines=30,
+                            placeholder="結果がここに表示されます...",
+                            show_copy_button=True
+                        )
+
+        gr.Markdown(
+            """
+            ### 使い方
+            1. 画像をアップロード（PNG, JPG, etc.）
+            2. 「テキスト抽出」ボタンをクリック
+            3. 抽出されたテキストが表示されます
+            4. 複数の画像やPDFは「一括処理」タブでまとめて処理できます（ページ順に結合されます）
+
+            ### 対応言語
+            - 日本語、英語、中国語など32言語に対応
+            - 低照度・ぼかし・傾きがある画像でも高精度
+
+            ### 特徴
+            - 稀な文字・専門用語にも対応
+            - 長文書の構造解析が可能
+            - 印刷文字・手書き文字両方に対応
+            """
+        )
 
-    submit_btn.click(
-        fn=process_image_ocr,
-        inputs=[image_input],
-        outputs=[output_text]
-    )
+        submit_btn.click(
+            fn=process_image_ocr_stream,
+            inputs=[image_input, streaming_checkbox],
+            outputs=[output_text, preprocess_info],
+            # バッチにまとめられるよう同時実行数をバッチサイズ（×ワーカー数）に合わせる
+            concurrency_limit=PARALLELISM
+        )
+
+        batch_btn.click(
+            fn=process_documents_ocr,
+            inputs=[files_input],
+            outputs=[batch_output, batch_timings]
+        )
+
+        # ボトムバナー広告
+        if get_adsense_bottom():
+            gr.HTML(get_adsense_bottom())
+
+    return demo
 
-    # ボトムバナー広告
-    if get_adsense_bottom():
-        gr.HTML(get_adsense_bottom())
+# 統合アプリ・推論ワーカーから読み込まれた場合はUIを作らない
+demo = None if EMBEDDED else create_demo()
 
 if __name__ == "__main__":
     # Cloud Run環境ではPORT環境変数を使用
     port = int(os.environ.get("PORT", 7860))
-    demo.launch(share=False, server_name="0.0.0.0", server_port=port)
+    # モデルはOCR_MODEL_LOADINGに従って読み込む（既定ではUI・ヘルスチェックを先に起動し、裏で読み込む）
+    models.start_from_env()
+    # 長いドキュメント向けの非同期ジョブ（/api/jobs、完了まで/api/ocrと同じ受付制御の件数に数える）
+    jobs = JobQueue(APP_NAME, job_ocr, decode_image, admission=admission).start()
+    register_jobs(APP_NAME, jobs)
+    # Gradio UIとHTTP API（/api/ocr, /api/jobs, /healthz）を同じサーバーで提供
+    api = create_api(api_ocr, api_health, title="Qwen3-VL OCR API", app_name=APP_NAME, admission=admission, jobs=jobs)
+    serve(demo, api, port)
@@ -0,0 +1,146 @@
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from PIL import Image, ImageOps
+
+# 一括処理の設定（環境変数から取得）
+MAX_PAGES = int(os.environ.get("OCR_MAX_PAGES", "200"))
+PDF_DPI = int(os.environ.get("OCR_PDF_DPI", "150"))
+
+
+def _file_path(file):
+    # Gradioのバージョンによって文字列またはファイルオブジェクトが渡される
+    return file if isinstance(file, str) else getattr(file, "name", str(file))
+
+
+def _pdfium():
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:
+        raise RuntimeError("PDFの処理にはpypdfium2が必要です: pip install pypdfium2")
+    return pdfium
+
+
+def rasterize_pdf(path, dpi=PDF_DPI):
+    """PDFの各ページをローカルで画像化する（pypdfium2を使用、1ページずつ画像化して返す）"""
+    pdf = _pdfium().PdfDocument(path)
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            try:
+                yield page.render(scale=dpi / 72).to_pil().convert("RGB")
+            finally:
+                page.close()
+    finally:
+        pdf.close()
+
+
+def count_pages(files):
+    """アップロードされた画像・PDFのページ数（PDFは画像化せずにページ数だけを読む）"""
+    total = 0
+    for file in files or []:
+        path = _file_path(file)
+        if path.lower().endswith(".pdf"):
+            pdf = _pdfium().PdfDocument(path)
+            try:
+                total += len(pdf)
+            finally:
+                pdf.close()
+        else:
+            total += 1
+    return total
+
+
+def load_pages(files, max_pages=MAX_PAGES):
+    """
+    アップロードされた画像・PDFを、ページ順に (ラベル, PIL Image) として1ページずつ返すジェネレータ
+
+    全ページを先に画像化するとPDFのページ数に比例してメモリを使うため、必要になった時点で画像化する
+    """
+    pages = count_pages(files)
+    if pages > max_pages:
+        raise ValueError(f"ページ数が上限（{max_pages}ページ）を超えています")
+
+    for file in files or []:
+        path = _file_path(file)
+        name = os.path.basename(path)
+        if path.lower().endswith(".pdf"):
+            for number, image in enumerate(rasterize_pdf(path), start=1):
+                yield f"{name} p.{number}", image
+        else:
+            with Image.open(path) as image:
+                yield name, ImageOps.exif_transpose(image).convert("RGB")
+
+
+def run_pages(pages, ocr_fn, max_workers=1):
+    """
+    各ページをワーカープールで処理し、ページ順の結果を返す
+
+    ocr_fnはPIL Imageを受け取りテキストを返す関数（失敗時は例外を送出）
+    ワーカー数はモデル1つ分のメモリを共有するスレッド数であり、モデルは複製されない
+    pagesはジェネレータでもよく、処理中のページがワーカー数に達している間は次のページを読み込まない
+    （画像は処理が終わった時点で手放す）
+    """
+    workers = max(1, int(max_workers))
+
+    def process(index, label, image):
+        started = time.perf_counter()
+        try:
+            text, error = ocr_fn(image), None
+        except Exception as e:
+            text, error = "", str(e)
+        return {
+            "page": index + 1,
+            "label": label,
+            "text": text,
+            "error": error,
+            "seconds": time.perf_counter() - started,
+        }
+
+    results = []
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-page") as pool:
+        for index, (label, image) in enumerate(pages):
+            if len(pending) >= workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results.extend(future.result() for future in done)
+            pending.add(pool.submit(process, index, label, image))
+            image = None
+        results.extend(future.result() for future in wait(pending)[0])
+    return sorted(results, key=lambda result: result["page"])
+
+
+def build_document(results):
+    """ページごとの結果を1つのMarkdown文書に結合"""
+    sections = []
+    for result in results:
+        body = result["text"] if result["error"] is None else f"（エラー: {result['error']}）"
+        sections.append(f"<!-- page {result['page']}: {result['label']} -->\n{body.strip()}")
+    return "\n\n---\n\n".join(sections)
+
+
+def format_timings(results, total_seconds):
+    """ページごとの処理時間をMarkdownの表にまとめる"""
+    lines = [
+        "| ページ | ファイル | 処理時間（秒） | 状態 |",
+        "|---:|---|---:|---|",
+    ]
+    for result in results:
+        status = "OK" if result["error"] is None else "エラー"
+        lines.append(f"| {result['page']} | {result['label']} | {result['seconds']:.2f} | {status} |")
+    lines.append("")
+    lines.append(f"合計: {len(results)}ページ / {total_seconds:.2f}秒")
+    return "\n".join(lines)
+
+
+def process_documents(files, ocr_fn, max_workers=1):
+    """一括処理の入口（結合した文書と処理時間の表を返す）"""
+    started = time.perf_counter()
+    pages = count_pages(files)
+    if not pages:
+        return "エラー: ファイルがアップロードされていません", ""
+    print(f"一括処理を開始します: {pages}ページ (ワーカー数: {max_workers})")
+    results = run_pages(load_pages(files), ocr_fn, max_workers=max_workers)
+    total = time.perf_counter() - started
+    return build_document(results), format_timings(results, total)
@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import track
+
+
+class MicroBatcher:
+    """
+    短い待ち時間の間に届いたリクエストをまとめて1回のバッチ推論で処理するスケジューラ
+
+    batch_fnは入力のリストを受け取り、同じ順序・同じ長さの結果リストを返す関数
+    """
+
+    def __init__(self, batch_fn, max_batch_size=4, max_wait_ms=50.0, name="batcher"):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # 推論の実行枠（バッチ以外の推論もこのロックを取り、torchのスレッドを取り合わないようにする）
+        self.slot = threading.Lock()
+
+    def submit(self, item, timeout=None, trace=None):
+        """1件のリクエストを投入し、バッチ処理の結果が返るまで待つ（traceには待ち時間と推論の各段階を記録）"""
+        future = Future()
+        self._queue.put((item, future, trace, time.perf_counter()))
+        self._ensure_started()
+        return future.result(timeout=timeout)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name=f"{self.name}-scheduler", daemon=True
+                )
+                self._thread.start()
+
+    def _collect(self):
+        """最初の1件を待ち、その後はウィンドウ内に届いた分を最大バッチサイズまで集める"""
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # 呼び出し側がタイムアウト等でキャンセル済みのものは除外
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if batch:
+                with self.slot:
+                    self._execute(batch)
+
+    def _execute(self, batch):
+        items = [entry[0] for entry in batch]
+        futures = [entry[1] for entry in batch]
+        traces = [entry[2] for entry in batch]
+
+        started = time.perf_counter()
+        for _, _, trace, enqueued in batch:
+            if trace is not None:
+                trace.add("queue_wait", started - enqueued)
+                trace.set("batch_size", len(items))
+
+        if len(items) > 1:
+            print(f"[{self.name}] バッチ推論: {len(items)}件")
+
+        try:
+            # バッチ内の処理段階の時間は、バッチに含まれる全リクエストに記録される
+            with track(*traces):
+                results = self.batch_fn(items)
+            if len(results) != len(items):
+                raise RuntimeError(
+                    f"バッチ結果の件数が一致しません (入力: {len(items)}, 出力: {len(results)})"
+                )
+        except Exception as e:
+            if len(items) == 1:
+                futures[0].set_exception(e)
+                return
+            # 1枚の不正な画像でバッチ全体が失敗しないよう、個別に再実行する
+            print(f"[{self.name}] バッチ推論に失敗したため個別に再実行します: {e}")
+            for item, future, trace, _ in batch:
+                try:
+                    with track(trace):
+                        future.set_result(self.batch_fn([item])[0])
+                except Exception as item_error:
+                    future.set_exception(item_error)
+            return
+
+        for future, result in zip(futures, results):
+            future.set_result(result)
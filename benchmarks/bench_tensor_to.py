@@ -0,0 +1,86 @@
+"""
+Tensor.to()のパッチによる1呼び出しあたりのオーバーヘッドを計測するマイクロベンチマーク
+
+    python benchmarks/bench_tensor_to.py --number 200000
+
+比較対象:
+  unpatched: 元の.to()
+  legacy:    以前の実装（プロセス全体に常時適用していた引数解析付きのパッチ）
+  scoped:    cpu_compat_mode()内で適用される現在のパッチ
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cpu_compat import cpu_compat_mode
+
+_original_to = torch.Tensor.to
+
+
+def legacy_patched_to(self, *args, **kwargs):
+    # 以前の実装をそのまま再現（比較用）
+    if len(args) > 0:
+        if isinstance(args[0], torch.dtype) and args[0] == torch.bfloat16:
+            if not self.dtype.is_floating_point:
+                return _original_to(self, *args, **kwargs)
+            args = (torch.float32,) + args[1:]
+    if 'dtype' in kwargs and kwargs['dtype'] == torch.bfloat16:
+        if not self.dtype.is_floating_point:
+            return _original_to(self, *args, **kwargs)
+        kwargs['dtype'] = torch.float32
+    return _original_to(self, *args, **kwargs)
+
+
+def measure(stmt, number, repeat):
+    """最良値を1呼び出しあたりのナノ秒で返す"""
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    x = torch.zeros(8, dtype=torch.float32)
+    cases = {
+        ".to(torch.float32)": lambda: x.to(torch.float32),
+        ".to('cpu')": lambda: x.to("cpu"),
+        ".to(dtype=torch.float32)": lambda: x.to(dtype=torch.float32),
+        ".to(torch.bfloat16)": lambda: x.to(torch.bfloat16),
+    }
+
+    results = {}
+    for name, stmt in cases.items():
+        row = {"unpatched": measure(stmt, args.number, args.repeat)}
+
+        torch.Tensor.to = legacy_patched_to
+        try:
+            row["legacy"] = measure(stmt, args.number, args.repeat)
+        finally:
+            torch.Tensor.to = _original_to
+
+        with cpu_compat_mode():
+            row["scoped"] = measure(stmt, args.number, args.repeat)
+
+        # スコープ外では元の.to()に戻っていることを確認
+        assert torch.Tensor.to is _original_to
+        results[name] = row
+
+    print(f"torch {torch.__version__}, number={args.number}, repeat={args.repeat} (ns/call)")
+    print(f"{'case':<28}{'unpatched':>12}{'legacy':>12}{'scoped':>12}{'legacy+':>10}{'scoped+':>10}")
+    for name, row in results.items():
+        print(
+            f"{name:<28}{row['unpatched']:>12.1f}{row['legacy']:>12.1f}{row['scoped']:>12.1f}"
+            f"{row['legacy'] - row['unpatched']:>10.1f}{row['scoped'] - row['unpatched']:>10.1f}"
+        )
+    print("スコープ外（推論以外の処理）では常にunpatchedの値になります")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+"""
+2つのOCRパイプライン（app.py / deepseekuse_gradio.py）のオフラインベンチマーク
+
+ローカルで生成した合成文書画像を、指定した同時実行数で各アプリのocr_imageに流し、
+レイテンシ（p50/p95/p99）・スループット・ピークメモリ・キャッシュヒット率をJSONに書き出す
+
+    # スタブモデルで実行（重みのダウンロード不要、CPUのみ）
+    python benchmarks/ocr_bench.py run --apps qwen,deepseek --concurrency 1,4 --output base.json
+
+    # 実モデルで実行し、前回の結果と比較（劣化があれば終了コード1）
+    python benchmarks/ocr_bench.py run --backend hf --output new.json --compare base.json
+
+    # 保存済みの結果同士を比較
+    python benchmarks/ocr_bench.py compare base.json new.json --threshold 0.1
+
+アプリ×同時実行数の組み合わせごとに別プロセスで実行するため、
+モデルの読み込み・キャッシュ・ピークメモリは組み合わせ間で共有されない
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCHEMA_VERSION = 1
+
+# アプリ名 -> (モジュール名, ocr_imageの呼び出し方)
+APPS = {
+    "qwen": ("app", lambda module, image, trace: module.ocr_image(image, trace)),
+    "deepseek": ("deepseekuse_gradio", lambda module, image, trace: module.ocr_image(image, "OCR", "自動", trace)),
+}
+
+# 比較対象の指標 (キー, 大きいほど良いか, 表示名)
+COMPARED_METRICS = (
+    (("latency_ms", "p50"), False, "p50レイテンシ"),
+    (("latency_ms", "p95"), False, "p95レイテンシ"),
+    (("latency_ms", "p99"), False, "p99レイテンシ"),
+    (("throughput_rps",), True, "スループット"),
+    (("peak_rss_bytes",), False, "ピークRSS"),
+)
+# キャッシュヒット率は比率ではなく差（ポイント）で判定する
+HIT_RATE_TOLERANCE = 0.05
+
+WORDS = (
+    "invoice", "total", "amount", "date", "quantity", "price", "tax", "subtotal", "customer",
+    "address", "order", "payment", "due", "section", "summary", "report", "revenue", "page",
+)
+
+
+# ---------------------------------------------------------------------------
+# 合成文書の生成
+
+
+def _font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow 10.1より前はサイズ指定に対応していない
+        return ImageFont.load_default()
+
+
+def _sentence(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def _draw_lines(draw, rng, box, line_height, words_per_line, font):
+    left, top, _, bottom = box
+    y = top
+    while y + line_height <= bottom:
+        draw.text((left, y), _sentence(rng, rng.randint(*words_per_line)), fill=(20, 20, 20), font=font)
+        y += line_height
+
+
+def make_invoice(rng):
+    image = Image.new("RGB", (1240, 1754), "white")
+    draw = ImageDraw.Draw(image)
+    draw.text((100, 80), f"INVOICE No.{rng.randint(1000, 9999)}", fill="black", font=_font(48))
+    _draw_lines(draw, rng, (100, 200, 1140, 500), 32, (4, 8), _font(22))
+    # 明細表
+    for row in range(12):
+        y = 560 + row * 48
+        draw.line((100, y, 1140, y), fill=(120, 120, 120), width=2)
+        draw.text((120, y + 12), _sentence(rng, 3), fill="black", font=_font(20))
+        draw.text((900, y + 12), f"{rng.randint(1, 99999):>8,}", fill="black", font=_font(20))
+    _draw_lines(draw, rng, (100, 1200, 1140, 1650), 30, (6, 10), _font(20))
+    return image
+
+
+def make_receipt(rng):
+    image = Image.new("RGB", (576, 1400), "white")
+    draw = ImageDraw.Draw(image)
+    _draw_lines(draw, rng, (24, 24, 552, 1376), 26, (2, 4), _font(20))
+    return image
+
+
+def make_slide(rng):
+    # 文字の少ない横長画像（低密度・小さい解像度モードの経路）
+    image = Image.new("RGB", (1600, 900), (235, 240, 250))
+    draw = ImageDraw.Draw(image)
+    draw.text((120, 120), _sentence(rng, 3).title(), fill=(10, 30, 80), font=_font(72))
+    for index in range(3):
+        draw.text((160, 360 + index * 110), "- " + _sentence(rng, 4), fill=(30, 30, 30), font=_font(40))
+    return image
+
+
+def make_scan(rng):
+    # 灰色の余白とノイズのあるスキャン風画像（余白除去の経路）
+    page = make_invoice(rng).resize((1000, 1414))
+    noise = Image.effect_noise(page.size, 12).convert("RGB")
+    page = Image.blend(page, noise, 0.08)
+    image = Image.new("RGB", (1400, 1900), (200, 200, 200))
+    image.paste(page, (180 + rng.randint(0, 40), 220 + rng.randint(0, 40)))
+    return image
+
+
+GENERATORS = (make_invoice, make_receipt, make_slide, make_scan)
+
+
+def build_corpus(pages, duplicate_ratio, seed):
+    """
+    (ラベル, 画像) のリストを返す（同じシードなら毎回同じ内容）
+
+    キャッシュの効果を測るため、末尾に既出のページの複製を duplicate_ratio の割合で加える
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(pages):
+        generator = GENERATORS[index % len(GENERATORS)]
+        corpus.append((f"{index:03d}-{generator.__name__[5:]}", generator(rng)))
+
+    duplicates = int(round(pages * duplicate_ratio))
+    for label, image in rng.sample(corpus, min(duplicates, len(corpus))):
+        corpus.append((label + "-dup", image.copy()))
+    return corpus
+
+
+# ---------------------------------------------------------------------------
+# 計測
+
+
+def percentile(values, q):
+    """線形補間によるパーセンタイル（qは0〜100）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100.0
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _round(value, digits=2):
+    return None if value is None else round(value, digits)
+
+
+def _latency_summary(values):
+    return {
+        "p50": _round(percentile(values, 50)),
+        "p95": _round(percentile(values, 95)),
+        "p99": _round(percentile(values, 99)),
+        "mean": _round(sum(values) / len(values)) if values else None,
+        "max": _round(max(values)) if values else None,
+    }
+
+
+def run_worker(app, concurrency, settings, result_file):
+    """1つのアプリを読み込み、コーパス全体を指定の同時実行数で処理した結果を書き出す"""
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(REPO_DIR)
+    import importlib
+
+    load_started = time.perf_counter()
+    module_name, call = APPS[app]
+    module = importlib.import_module(module_name)
+    # モデルはimportでは読み込まれないため、読み込み時間に含めるようここで読み込む
+    module.models.load_all()
+    from metrics import RequestTrace
+    load_seconds = time.perf_counter() - load_started
+
+    # ウォームアップ（本番のコーパスとは別のシードで生成し、キャッシュに影響させない）
+    for _, image in build_corpus(settings["warmup"], 0.0, settings["seed"] + 1):
+        call(module, image, None)
+    warm_stats = module.result_cache.stats()
+
+    corpus = build_corpus(settings["pages"], settings["duplicate_ratio"], settings["seed"])
+
+    def process(entry):
+        label, image = entry
+        trace = RequestTrace(module.APP_NAME)
+        started = time.perf_counter()
+        status, error = "error", None
+        try:
+            result = call(module, image, trace)
+            status = "cached" if result.get("cached") else "ok"
+        except Exception as e:
+            error = str(e)
+        finally:
+            trace.finish(status)
+        return {
+            "label": label,
+            "latency_ms": (time.perf_counter() - started) * 1000,
+            "status": status,
+            "error": error,
+            "stages_ms": trace.summary(),
+            "values": dict(trace.values),
+        }
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as pool:
+        requests = list(pool.map(process, corpus))
+    wall = time.perf_counter() - started
+
+    latencies = [r["latency_ms"] for r in requests if r["status"] != "error"]
+    stage_names = sorted({name for r in requests for name in r["stages_ms"]})
+    stages = {
+        name: _round(percentile([r["stages_ms"][name] for r in requests if name in r["stages_ms"]], 50))
+        for name in stage_names
+    }
+    rates = [r["values"]["tokens_per_second"] for r in requests if r["values"].get("tokens_per_second")]
+    peaks = [r["values"]["peak_rss_bytes"] for r in requests if r["values"].get("peak_rss_bytes")]
+    # 生成の終了理由の内訳（length: 上限で打ち切り、repetition: 繰り返しで打ち切り）
+    finish_reasons = {}
+    for r in requests:
+        reason = r["values"].get("finish_reason")
+        if reason:
+            finish_reasons[reason] = finish_reasons.get(reason, 0) + 1
+
+    # ウォームアップ分を除いたキャッシュの統計
+    stats = module.result_cache.stats()
+    lookups = {key: stats[key] - warm_stats[key] for key in ("hits", "disk_hits", "misses")}
+    total_lookups = sum(lookups.values())
+    lookups["hit_rate"] = _round((lookups["hits"] + lookups["disk_hits"]) / total_lookups, 4) if total_lookups else 0.0
+
+    result = {
+        "app": app,
+        "model": module.model_name,
+        "concurrency": concurrency,
+        "requests": len(requests),
+        "errors": sum(1 for r in requests if r["status"] == "error"),
+        "model_load_seconds": _round(load_seconds),
+        "wall_seconds": _round(wall, 3),
+        "throughput_rps": _round(len(latencies) / wall, 4) if wall > 0 else None,
+        "latency_ms": _latency_summary(latencies),
+        "stage_p50_ms": stages,
+        "tokens_per_second_p50": _round(percentile(rates, 50)),
+        "peak_rss_bytes": max(peaks) if peaks else None,
+        "finish_reasons": finish_reasons,
+        "cache": lookups,
+        "failures": [{"label": r["label"], "error": r["error"]} for r in requests if r["error"]][:10],
+    }
+    with open(result_file, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False)
+
+
+def _worker_env(backend):
+    env = dict(os.environ)
+    env["OCR_MODEL_BACKEND"] = backend
+    # ディスクキャッシュ・JSONL出力を無効化し、前回の実行結果の影響を受けないようにする
+    env["OCR_CACHE_DIR"] = ""
+    env["OCR_METRICS_JSONL"] = ""
+    return env
+
+
+def _environment():
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+    try:
+        import torch
+        info["torch"] = torch.__version__
+        info["torch_threads"] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+
+def run_benchmark(args):
+    settings = {
+        "backend": args.backend,
+        "pages": args.pages,
+        "duplicate_ratio": args.duplicate_ratio,
+        "seed": args.seed,
+        "warmup": args.warmup,
+    }
+    apps = [name.strip() for name in args.apps.split(",") if name.strip()]
+    levels = [int(level) for level in args.concurrency.split(",")]
+    for app in apps:
+        if app not in APPS:
+            raise SystemExit(f"不明なアプリです: {app}（{', '.join(APPS)}から選択）")
+
+    if args.save_corpus:
+        os.makedirs(args.save_corpus, exist_ok=True)
+        for label, image in build_corpus(args.pages, args.duplicate_ratio, args.seed):
+            image.save(os.path.join(args.save_corpus, f"{label}.png"))
+        print(f"コーパスを保存しました: {args.save_corpus}")
+
+    runs = []
+    for app in apps:
+        for concurrency in levels:
+            print(f"実行中: {app} (同時実行数: {concurrency}, バックエンド: {args.backend})")
+            with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+                result_file = f.name
+            try:
+                command = [
+                    sys.executable, os.path.abspath(__file__), "_worker",
+                    "--app", app,
+                    "--concurrency", str(concurrency),
+                    "--settings", json.dumps(settings),
+                    "--result-file", result_file,
+                ]
+                completed = subprocess.run(command, env=_worker_env(args.backend), cwd=REPO_DIR)
+                if completed.returncode != 0:
+                    raise SystemExit(f"{app} (同時実行数 {concurrency}) の実行に失敗しました")
+                with open(result_file, encoding="utf-8") as f:
+                    run = json.load(f)
+            finally:
+                os.unlink(result_file)
+            runs.append(run)
+            print(format_run(run))
+
+    report = {
+        "schema": SCHEMA_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": _environment(),
+        "settings": settings,
+        "runs": runs,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        return report_comparison(baseline, report, args.threshold)
+    return 0
+
+
+def format_run(run):
+    latency = run["latency_ms"]
+    rss = run["peak_rss_bytes"]
+    rss_text = f"{rss / 1024 ** 2:.0f}MiB" if rss else "不明"
+    return (
+        f"  p50 {latency['p50']}ms / p95 {latency['p95']}ms / p99 {latency['p99']}ms, "
+        f"{run['throughput_rps']} req/s, ピークRSS {rss_text}, "
+        f"キャッシュヒット率 {run['cache']['hit_rate']:.0%}, エラー {run['errors']}件"
+    )
+
+
+# ---------------------------------------------------------------------------
+# 比較
+
+
+def _metric(run, path):
+    value = run
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def compare(baseline, current, threshold):
+    """
+    (アプリ, 同時実行数) が一致する実行同士を比較し、(行のリスト, 劣化があるか) を返す
+
+    threshold は許容する変化の割合（0.1なら10%）
+    """
+    rows = []
+    regressed = False
+    base_runs = {(run["app"], run["concurrency"]): run for run in baseline["runs"]}
+    for run in current["runs"]:
+        base = base_runs.get((run["app"], run["concurrency"]))
+        if base is None:
+            continue
+        for path, higher_is_better, label in COMPARED_METRICS:
+            old, new = _metric(base, path), _metric(run, path)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = worse > threshold
+            regressed = regressed or flag
+            rows.append((run["app"], run["concurrency"], label, old, new, f"{change:+.1%}", flag))
+
+        old, new = base["cache"]["hit_rate"], run["cache"]["hit_rate"]
+        flag = old - new > HIT_RATE_TOLERANCE
+        regressed = regressed or flag
+        rows.append((run["app"], run["concurrency"], "キャッシュヒット率", old, new, f"{new - old:+.2f}", flag))
+
+        if run["errors"] > base["errors"]:
+            regressed = True
+            rows.append((run["app"], run["concurrency"], "エラー件数", base["errors"], run["errors"], "", True))
+    return rows, regressed
+
+
+def report_comparison(baseline, current, threshold):
+    """比較結果を表示し、劣化があれば1を返す"""
+    if baseline.get("settings") != current.get("settings"):
+        print(f"警告: 実行条件が異なります\n  比較元: {baseline.get('settings')}\n  今回:   {current.get('settings')}")
+
+    rows, regressed = compare(baseline, current, threshold)
+    if not rows:
+        print("比較できる実行がありません（アプリと同時実行数の組み合わせが一致しません）")
+        return 0
+
+    print("\n| アプリ | 同時実行数 | 指標 | 比較元 | 今回 | 変化 | 判定 |")
+    print("|---|---:|---|---:|---:|---:|---|")
+    for app, concurrency, label, old, new, change, flag in rows:
+        print(f"| {app} | {concurrency} | {label} | {old} | {new} | {change} | {'劣化' if flag else 'OK'} |")
+    print(f"\n{'劣化が検出されました' if regressed else '劣化はありません'}（許容: {threshold:.0%}）")
+    return 1 if regressed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCRパイプラインのオフラインベンチマーク")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="ベンチマークを実行してJSONに保存")
+    run_parser.add_argument("--apps", default="qwen,deepseek", help="カンマ区切り（qwen, deepseek）")
+    run_parser.add_argument("--concurrency", default="1,4", help="同時実行数（カンマ区切り）")
+    run_parser.add_argument("--pages", type=int, default=16, help="合成文書のページ数（複製を除く）")
+    run_parser.add_argument("--duplicate-ratio", type=float, default=0.25, help="再送する既出ページの割合")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--warmup", type=int, default=1, help="計測前に処理するページ数")
+    run_parser.add_argument("--backend", choices=("stub", "hf"), default="stub",
+                            help="stub: スタブモデル, hf: 実モデル")
+    run_parser.add_argument("--output", default="ocr_bench.json")
+    run_parser.add_argument("--compare", help="比較元の結果JSON")
+    run_parser.add_argument("--threshold", type=float, default=0.1, help="劣化とみなす変化の割合")
+    run_parser.add_argument("--save-corpus", help="生成した画像を保存するディレクトリ")
+
+    compare_parser = subparsers.add_parser("compare", help="2つの結果JSONを比較")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+
+    worker_parser = subparsers.add_parser("_worker")
+    worker_parser.add_argument("--app", required=True)
+    worker_parser.add_argument("--concurrency", type=int, required=True)
+    worker_parser.add_argument("--settings", required=True)
+    worker_parser.add_argument("--result-file", required=True)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        return run_benchmark(args)
+    if args.command == "compare":
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.current, encoding="utf-8") as f:
+            current = json.load(f)
+        return report_comparison(baseline, current, args.threshold)
+    run_worker(args.app, args.concurrency, json.loads(args.settings), args.result_file)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""
+int8動的量子化の精度・メモリ・速度をfloat32と比較する
+
+同じモデルを1回だけ読み込み、float32で全サンプルを処理した後、その場で量子化して同じサンプルを再処理する
+
+    # ローカルのサンプル画像・PDFで確認（同名の.txtがあれば正解テキストとの文字誤り率も出す）
+    python benchmarks/quantization_accuracy.py --app qwen --samples ./samples --output quant_qwen.json
+
+    # サンプルがなければ合成文書で確認（ocr_bench.pyと同じコーパス）
+    python benchmarks/quantization_accuracy.py --app deepseek --pages 8 --quantize-vision
+
+float32の出力に対する文字誤り率（CER）の平均が --max-cer を超えると終了コード1で終わる
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+from ocr_bench import REPO_DIR, build_corpus, percentile
+
+SAMPLE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp", ".pdf")
+
+
+def edit_distance(a, b):
+    """文字単位のレーベンシュタイン距離"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b),
+            ))
+        previous = current
+    return previous[-1]
+
+
+def cer(hypothesis, reference):
+    """参照テキストに対する文字誤り率"""
+    return edit_distance(hypothesis, reference) / max(1, len(reference))
+
+
+def load_samples(directory, pages, seed):
+    """(ラベル, 画像, 正解テキストまたはNone) のリスト"""
+    if not directory:
+        return [(label, image, None) for label, image in build_corpus(pages, 0.0, seed)]
+
+    from batch_documents import load_pages
+
+    samples = []
+    for name in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() not in SAMPLE_EXTENSIONS:
+            continue
+        reference = None
+        reference_path = os.path.join(directory, stem + ".txt")
+        if os.path.exists(reference_path):
+            with open(reference_path, encoding="utf-8") as f:
+                reference = f.read().strip()
+        for label, image in load_pages([os.path.join(directory, name)]):
+            # PDFは複数ページになるため、正解テキストは1ページの画像にのみ対応付ける
+            samples.append((label, image, reference if ext.lower() != ".pdf" else None))
+    return samples
+
+
+def qwen_runner(module):
+    from preprocess import preprocess_image
+
+    def run(image):
+        image, _ = preprocess_image(image)
+        return module.run_ocr_batch([image])[0]["text"]
+    return run
+
+
+def deepseek_runner(module):
+    from preprocess import preprocess_image
+
+    def run(image):
+        image, info = preprocess_image(image, max_pixels=module.MAX_PIXELS)
+        base_size, image_size, crop = module.resolve_mode("自動", info)
+        text, _, _, _ = module.run_infer(image, module.get_prompt("OCR"), base_size, image_size, crop)
+        return text
+    return run
+
+
+# アプリ名 -> (モジュール名, キャッシュ・バッチを通さずに1枚を推論する関数)
+APPS = {
+    "qwen": ("app", qwen_runner),
+    "deepseek": ("deepseekuse_gradio", deepseek_runner),
+}
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_pass(run, samples):
+    outputs, seconds = [], []
+    for label, image, _ in samples:
+        started = time.perf_counter()
+        outputs.append(run(image))
+        seconds.append(time.perf_counter() - started)
+        print(f"  {label}: {seconds[-1]:.2f}秒")
+    return outputs, seconds
+
+
+def summarize_pass(outputs, seconds, model_bytes):
+    # 量子化で解放したfloat32の重みはアロケータがOSに返さないことがあるため、
+    # int8のRSSは新しいプロセスで読み込んだ場合より大きめに出る（model_bytesの差が目安）
+    gc.collect()
+    return {
+        "model_bytes": model_bytes,
+        "rss_bytes": rss_bytes(),
+        "latency_s": {
+            "mean": round(sum(seconds) / len(seconds), 3),
+            "p50": round(percentile(seconds, 50), 3),
+            "max": round(max(seconds), 3),
+        },
+        "output_chars": sum(len(text) for text in outputs),
+    }
+
+
+def _delta(before, after):
+    if not before or after is None:
+        return None
+    return round((after - before) / before, 4)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="int8動的量子化とfloat32の比較")
+    parser.add_argument("--app", choices=sorted(APPS), default="qwen")
+    parser.add_argument("--samples", help="サンプル画像・PDFのディレクトリ（同名の.txtを正解テキストとして使用）")
+    parser.add_argument("--pages", type=int, default=8, help="サンプル未指定時の合成文書のページ数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quantize-vision", action="store_true", help="画像エンコーダも量子化する")
+    parser.add_argument("--skip", default="", help="量子化対象外とするモジュール名（カンマ区切り）")
+    parser.add_argument("--backend", choices=("stub", "hf"), default="hf")
+    parser.add_argument("--max-cer", type=float, default=0.05, help="float32の出力に対する平均CERの上限")
+    parser.add_argument("--output", default="quantization_report.json")
+    args = parser.parse_args()
+
+    # 読み込み時には量子化せず、float32で1回処理してから量子化する
+    os.environ["OCR_QUANTIZE"] = "off"
+    os.environ["OCR_MODEL_BACKEND"] = args.backend
+    sys.path.insert(0, REPO_DIR)
+    os.chdir(REPO_DIR)
+    import importlib
+
+    from quantization import model_size_bytes, quantize_model
+
+    module_name, make_runner = APPS[args.app]
+    module = importlib.import_module(module_name)
+    # モデルはimportでは読み込まれないため、module.modelを使う前に読み込む
+    module.models.load_all()
+    run = make_runner(module)
+    samples = load_samples(args.samples, args.pages, args.seed)
+    if not samples:
+        raise SystemExit("サンプルがありません")
+
+    # 初回呼び出しのオーバーヘッドを除くため1枚分ウォームアップする
+    run(samples[0][1])
+
+    print(f"float32で処理しています ({len(samples)}枚)...")
+    fp32_outputs, fp32_seconds = run_pass(run, samples)
+    fp32 = summarize_pass(fp32_outputs, fp32_seconds, model_size_bytes(module.model))
+
+    summary = quantize_model(
+        module.model,
+        quantize_vision=args.quantize_vision,
+        skip=[name for name in args.skip.split(",") if name],
+    )
+    gc.collect()
+    run(samples[0][1])
+
+    print(f"int8で処理しています ({len(samples)}枚)...")
+    int8_outputs, int8_seconds = run_pass(run, samples)
+    int8 = summarize_pass(int8_outputs, int8_seconds, summary["size_after"])
+
+    per_sample = []
+    for (label, _, reference), fp32_text, int8_text in zip(samples, fp32_outputs, int8_outputs):
+        entry = {
+            "label": label,
+            "cer_vs_fp32": round(cer(int8_text, fp32_text), 4),
+            "exact_match": int8_text == fp32_text,
+        }
+        if reference is not None:
+            entry["cer_fp32_vs_reference"] = round(cer(fp32_text, reference), 4)
+            entry["cer_int8_vs_reference"] = round(cer(int8_text, reference), 4)
+        per_sample.append(entry)
+
+    mean_cer = sum(entry["cer_vs_fp32"] for entry in per_sample) / len(per_sample)
+    report = {
+        "app": args.app,
+        "model": module.model_name,
+        "backend": args.backend,
+        "quantize_vision": args.quantize_vision,
+        "quantization": summary,
+        "fp32": fp32,
+        "int8": int8,
+        "delta": {
+            "model_bytes": _delta(fp32["model_bytes"], int8["model_bytes"]),
+            "rss_bytes": _delta(fp32["rss_bytes"], int8["rss_bytes"]),
+            "latency_mean": _delta(fp32["latency_s"]["mean"], int8["latency_s"]["mean"]),
+        },
+        "accuracy": {
+            "mean_cer_vs_fp32": round(mean_cer, 4),
+            "exact_match_rate": round(sum(entry["exact_match"] for entry in per_sample) / len(per_sample), 4),
+            "max_cer": args.max_cer,
+        },
+        "samples": per_sample,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    mib = 1024 ** 2
+    print("\n| 項目 | float32 | int8 | 変化 |")
+    print("|---|---:|---:|---:|")
+    print(f"| モデルサイズ | {fp32['model_bytes'] / mib:.0f}MiB | {int8['model_bytes'] / mib:.0f}MiB | {report['delta']['model_bytes']:+.1%} |")
+    if fp32["rss_bytes"] and int8["rss_bytes"]:
+        print(f"| RSS | {fp32['rss_bytes'] / mib:.0f}MiB | {int8['rss_bytes'] / mib:.0f}MiB | {report['delta']['rss_bytes']:+.1%} |")
+    print(f"| 平均レイテンシ | {fp32['latency_s']['mean']}秒 | {int8['latency_s']['mean']}秒 | {report['delta']['latency_mean']:+.1%} |")
+    print(f"\nfloat32に対する平均CER: {mean_cer:.4f} (上限 {args.max_cer}), 完全一致率: {report['accuracy']['exact_match_rate']:.0%}")
+    print(f"結果を保存しました: {args.output}")
+    return 1 if mean_cer > args.max_cer else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
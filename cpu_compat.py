@@ -0,0 +1,224 @@
+import threading
+import weakref
+from contextlib import contextmanager
+
+import torch
+
+# float32への変換対象外とする整数型
+INT_DTYPES = (torch.int32, torch.int64, torch.int16, torch.int8, torch.uint8, torch.bool)
+
+
+# CPU環境用のモデル変換関数
+def convert_model_to_float32(model, verbose=True):
+    """モデル全体をfloat32に変換（全てのサブモジュールを含む、ただし整数型は除く）"""
+    bf16_params = []
+    # named_parametersを使って全てのパラメータを取得（サブモジュール含む）
+    for name, param in model.named_parameters():
+        if param.dtype == torch.bfloat16:
+            bf16_params.append(name)
+            param.data = param.data.to(torch.float32)
+
+    bf16_buffers = []
+    int_buffers_protected = []
+    # named_buffersを使って全てのバッファを取得（サブモジュール含む）
+    for name, buffer in model.named_buffers():
+        # 整数型バッファは変換しない
+        if buffer.dtype in INT_DTYPES:
+            int_buffers_protected.append(name)
+            continue
+        if buffer.dtype == torch.bfloat16:
+            bf16_buffers.append(name)
+            buffer.data = buffer.data.to(torch.float32)
+
+    if verbose:
+        if bf16_params:
+            print(f"bfloat16パラメータを変換しました: {len(bf16_params)}個")
+        if bf16_buffers:
+            print(f"bfloat16バッファを変換しました: {len(bf16_buffers)}個")
+        if int_buffers_protected:
+            print(f"整数型バッファを保護しました: {len(int_buffers_protected)}個")
+
+    return len(bf16_params) + len(bf16_buffers)
+
+
+class Float32Guard:
+    """
+    ロード時に一度だけfloat32へ変換し、その後は新しく登録されたテンソルだけを変換する
+
+    PyTorchのモジュール登録フックで以下を監視する
+    - 監視対象のモデルへのパラメータ/バッファの登録: bfloat16ならその場でfloat32に置き換える
+    - 既存モデルへのサブモジュールの追加: 次回のensure()でそのサブモジュールだけを確認する
+    リクエストごとのensure()は追加されたサブモジュールがなければO(1)で終わる
+    フックはプロセス全体に掛かるため、監視対象外のモジュール（同じプロセスの他のモデル）には何もしない。
+    モデルを手放す前にremove()を呼ぶこと（フックが残るとガード経由でモデルが解放されない）
+    """
+
+    def __init__(self, model, extra_attrs=("sam_model", "clip_model")):
+        self.model = model
+        self.extra_attrs = extra_attrs
+        self.version = 0
+        self._checked_version = 0
+        self._pending = []
+        self._tracked = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._handles = []
+        self._hooks_available = False
+
+    def install(self):
+        """モデル全体を一度だけ変換し、以降の登録を監視するフックを設定"""
+        convert_model_to_float32(self.model)
+        self._tracked = weakref.WeakSet(self.model.modules())
+
+        # 属性として保持されているだけで子モジュールとして登録されていないもの（sam_model等）も一度だけ変換
+        for module in list(self.model.modules()):
+            for attr in self.extra_attrs:
+                submodule = getattr(module, attr, None)
+                if isinstance(submodule, torch.nn.Module) and submodule not in self._tracked:
+                    convert_model_to_float32(submodule)
+                    self._tracked.update(submodule.modules())
+
+        hooks = torch.nn.modules.module
+        if not all(
+            hasattr(hooks, name)
+            for name in (
+                "register_module_parameter_registration_hook",
+                "register_module_buffer_registration_hook",
+                "register_module_module_registration_hook",
+            )
+        ):
+            print("モジュール登録フックが利用できないため、リクエストごとに全体を確認します")
+            return self
+
+        self._handles = [
+            hooks.register_module_parameter_registration_hook(self._on_parameter),
+            hooks.register_module_buffer_registration_hook(self._on_buffer),
+            hooks.register_module_module_registration_hook(self._on_module),
+        ]
+        self._hooks_available = True
+        return self
+
+    def remove(self):
+        """フックを外し、モデルへの参照を手放す"""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._hooks_available = False
+        with self._lock:
+            self.model = None
+            self._tracked = weakref.WeakSet()
+            self._pending = []
+
+    def ensure(self, full_check=False):
+        """推論前の不変条件チェック（新しいサブモジュールがなければ何もしない）"""
+        if full_check or not self._hooks_available:
+            convert_model_to_float32(self.model, verbose=False)
+            return
+
+        if self.version == self._checked_version:
+            return
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+            version = self.version
+
+        converted = 0
+        for module_ref in pending:
+            module = module_ref()
+            if module is not None:
+                converted += convert_model_to_float32(module, verbose=False)
+        self._checked_version = version
+        if converted:
+            print(f"新しく追加されたテンソルをfloat32に変換しました: {converted}個")
+
+    def _on_parameter(self, module, name, param):
+        if module not in self._tracked:
+            return None
+        if param is not None and param.dtype == torch.bfloat16 and param.device.type == "cpu":
+            return torch.nn.Parameter(param.data.to(torch.float32), requires_grad=param.requires_grad)
+        return None
+
+    def _on_buffer(self, module, name, buffer):
+        if module not in self._tracked:
+            return None
+        if buffer is not None and buffer.dtype == torch.bfloat16 and buffer.device.type == "cpu":
+            return buffer.to(torch.float32)
+        return None
+
+    def _on_module(self, module, name, submodule):
+        # 監視対象のモデルに後から追加されたサブモジュールだけを記録する
+        if submodule is None or module not in self._tracked:
+            return None
+        with self._lock:
+            self._tracked.update(submodule.modules())
+            self._pending.append(weakref.ref(submodule))
+            self.version += 1
+        return None
+
+
+_BF16 = torch.bfloat16
+_original_cuda = torch.Tensor.cuda
+_original_to = torch.Tensor.to
+_original_autocast = torch.autocast
+
+
+def patched_cuda(self, *args, **kwargs):
+    # CPU環境では常にfloat32に変換してから返す
+    if self.dtype == _BF16:
+        return self.float()
+    return self
+
+
+def patched_to(self, *args, **kwargs):
+    """bfloat16への変換をfloat32に置き換える.to()（bfloat16指定がなければ元の処理をそのまま呼ぶ）"""
+    bf16_arg = False
+    for arg in args:
+        if arg is _BF16:
+            bf16_arg = True
+            break
+    if not bf16_arg and kwargs.get("dtype") is not _BF16:
+        return _original_to(self, *args, **kwargs)
+
+    # 整数型テンソルはそのまま、浮動小数点型のみfloat32に変換
+    if not self.dtype.is_floating_point:
+        return _original_to(self, *args, **kwargs)
+    if bf16_arg:
+        args = tuple(torch.float32 if arg is _BF16 else arg for arg in args)
+    if kwargs.get("dtype") is _BF16:
+        kwargs["dtype"] = torch.float32
+    return _original_to(self, *args, **kwargs)
+
+
+@contextmanager
+def patched_autocast(device_type="cuda", enabled=True, dtype=None, **kwargs):
+    # CPU環境ではautocastを完全にスキップ
+    yield
+
+
+class _CPUCompatState:
+    lock = threading.Lock()
+    depth = 0
+
+
+@contextmanager
+def cpu_compat_mode():
+    """
+    推論中だけ.cuda()/.to()/torch.autocastをCPU互換の実装に差し替えるコンテキスト
+
+    入れ子や複数スレッドからの同時利用に対応し、最後の利用者が抜けた時点で元に戻す
+    （差し替え中は同じプロセスの他のスレッドにも適用される点に注意）
+    """
+    with _CPUCompatState.lock:
+        if _CPUCompatState.depth == 0:
+            torch.Tensor.cuda = patched_cuda
+            torch.Tensor.to = patched_to
+            torch.autocast = patched_autocast
+        _CPUCompatState.depth += 1
+    try:
+        yield
+    finally:
+        with _CPUCompatState.lock:
+            _CPUCompatState.depth -= 1
+            if _CPUCompatState.depth == 0:
+                torch.Tensor.cuda = _original_cuda
+                torch.Tensor.to = _original_to
+                torch.autocast = _original_autocast
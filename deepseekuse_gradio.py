@@ -1,377 +1,802 @@
-from transformers import AutoModel, AutoTokenizer
 import torch
 import os
 import gradio as gr
 from pathlib import Path
+import shutil
+import tempfile
+import inspect
+from ocr_cache import cache_from_env
+from batch_documents import process_documents
+from preprocess import DEEPSEEK_MODES, preprocess_image, preprocess_settings
+from rest_api import create_api, decode_image, serve
+from metrics import (RequestTrace, active_traces, register_admission, register_cache, register_jobs,
+                     register_near_duplicates, stage, track)
+from admission import AdmissionController, AdmissionRejected, client_id, degraded_pixels
+from cpu_compat import Float32Guard, cpu_compat_mode
+from contextlib import nullcontext
+from prepared_model import is_prepared, load_prepared
+from quantization import quantization_label, quantize_from_env
+from prompt_cache import PRETOKENIZED_PROMPT, CachedEncodeTokenizer
+from generation_control import (FINISH_LENGTH, FINISH_REPETITION, adaptive_max_new_tokens, generation_settings,
+                                combine_generation, install_generate_limit, limit_generation)
+from tiling import needs_tiling, ocr_tiles, tiling_settings
+from worker_pool import WORKERS, WorkerPool, is_frontend
+from job_queue import JobQueue
+from web_common import encode_image_base64, get_adsense_bottom, get_adsense_script, get_adsense_top, is_embedded
+from model_registry import ModelNotReady, ModelRegistry, warmup_image
+from thread_tuning import applied_profile, apply_thread_profile
+from ocr_artifacts import (ARCHIVE_DIR, LAYOUT_VERSION, annotated_image, archive_artifacts, boxes_requested, layout_blocks,
+                           parse_output, place_regions, rescale_blocks)
+from phash_index import index_from_env
 
 # ローカルモデル保存先
 LOCAL_MODEL_DIR = './models/deepseek-ocr'
 model_name = 'deepseek-ai/DeepSeek-OCR'
 
-# CPU環境用のモデル変換関数
-def convert_model_to_float32(model):
-    """モデル全体をfloat32に変換（全てのサブモジュールを含む、ただし整数型は除く）"""
-    bf16_params = []
-    # named_parametersを使って全てのパラメータを取得（サブモジュール含む）
-    for name, param in model.named_parameters():
-        if param.dtype == torch.bfloat16:
-            bf16_params.append(name)
-            param.data = param.data.to(torch.float32)
-
-    bf16_buffers = []
-    int_buffers_protected = []
-    # named_buffersを使って全てのバッファを取得（サブモジュール含む）
-    for name, buffer in model.named_buffers():
-        # 整数型バッファは変換しない
-        if buffer.dtype in [torch.int32, torch.int64, torch.long, torch.int, torch.int8, torch.int16, torch.uint8, torch.bool]:
-            int_buffers_protected.append(name)
-            continue
-        if buffer.dtype == torch.bfloat16:
-            bf16_buffers.append(name)
-            buffer.data = buffer.data.to(torch.float32)
-
-    # すべてのモジュールのパラメータをfloat32に変換（手動で、整数型を保護しながら）
-    for module in model.modules():
-        for param in module.parameters(recurse=False):
-            if param.dtype == torch.bfloat16:
-                param.data = param.data.to(torch.float32)
-
-    if bf16_params:
-        print(f"bfloat16パラメータを変換しました: {len(bf16_params)}個")
-    if bf16_buffers:
-        print(f"bfloat16バッファを変換しました: {len(bf16_buffers)}個")
-    if int_buffers_protected:
-        print(f"整数型バッファを保護しました: {len(int_buffers_protected)}個")
-
 # CUDA設定
 # os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
-print("モデルを読み込んでいます...")
+# CPU推論用の変換済みモデル（python prepared_model.py deepseek で作成）
+PREPARED_MODEL_DIR = os.environ.get("OCR_PREPARED_MODEL_DIR", "./models/deepseek-ocr-cpu")
 
-# ローカルモデルの確認
-model_exists = os.path.exists(f'{LOCAL_MODEL_DIR}/config.json')
+# stubの場合は重みを読み込まずにスタブモデルで動かす（ベンチマーク・動作確認用）
+MODEL_BACKEND = os.environ.get("OCR_MODEL_BACKEND", "hf")
 
-if model_exists:
-    print(f"ローカルモデルを読み込んでいます: {LOCAL_MODEL_DIR}")
-    tokenizer = AutoTokenizer.from_pretrained(
-        LOCAL_MODEL_DIR,
-        trust_remote_code=True
-    )
-    model = AutoModel.from_pretrained(
-        LOCAL_MODEL_DIR,
-        trust_remote_code=True,
-        use_safetensors=True,
-        torch_dtype=torch.float32 if not torch.cuda.is_available() else torch.bfloat16
-    )
+# OCR_WORKERS>0の場合、このプロセスはモデルを読み込まず推論をワーカープロセスに任せる
+SERVE_WITH_WORKERS = is_frontend()
+
+# 1の場合はリクエストごとにモデル全体のdtypeを確認する（デバッグ用）
+VERIFY_DTYPE = os.environ.get("OCR_VERIFY_DTYPE", "0") == "1"
+
+# モデル・トークナイザー・推論ワーカーはload_model()で設定する（importの時点では読み込まない）
+tokenizer = model = worker_pool = None
+prompt_tokenizer = infer_tokenizer = None
+# CPU環境ではロード時に一度だけfloat32へ変換し、以降は新しく登録されたテンソルのみを変換する
+dtype_guard = None
+# model.inferが生の出力を返せる（eval_mode）場合は結果ファイルを介さずに結果を受け取る
+INFER_IN_MEMORY = False
+
+# CPU環境ではOCR_QUANTIZE=int8でLinearの重みをint8に量子化する（float32への変換後に行う）
+QUANTIZATION = quantization_label()
+if SERVE_WITH_WORKERS:
+    device_info = f"{'GPU' if torch.cuda.is_available() else 'CPU'} (推論ワーカー{WORKERS}個)"
 else:
+    device_info = "GPU" if torch.cuda.is_available() else "CPU"
+if QUANTIZATION != "off":
+    device_info += f" ({QUANTIZATION})"
+
+def load_pretrained():
+    """(tokenizer, model) を読み込む（ローカルにない場合はダウンロードして保存する）"""
+    if MODEL_BACKEND == "stub":
+        from stub_models import load_stub_deepseek
+        print("スタブモデルを使用します（OCR_MODEL_BACKEND=stub）")
+        return load_stub_deepseek()
+
+    from transformers import AutoModel, AutoTokenizer
+
+    if not torch.cuda.is_available() and is_prepared(PREPARED_MODEL_DIR):
+        # float32変換済みの重みをメモリマップして読み込む（変換処理が不要）
+        print(f"変換済みモデルを読み込んでいます: {PREPARED_MODEL_DIR}")
+        loaded_tokenizer = AutoTokenizer.from_pretrained(
+            PREPARED_MODEL_DIR,
+            trust_remote_code=True
+        )
+        return loaded_tokenizer, load_prepared(AutoModel, PREPARED_MODEL_DIR, trust_remote_code=True)
+    # ローカルモデルの確認
+    if os.path.exists(f'{LOCAL_MODEL_DIR}/config.json'):
+        print(f"ローカルモデルを読み込んでいます: {LOCAL_MODEL_DIR}")
+        loaded_tokenizer = AutoTokenizer.from_pretrained(
+            LOCAL_MODEL_DIR,
+            trust_remote_code=True
+        )
+        loaded_model = AutoModel.from_pretrained(
+            LOCAL_MODEL_DIR,
+            trust_remote_code=True,
+            use_safetensors=True,
+            torch_dtype=torch.float32 if not torch.cuda.is_available() else torch.bfloat16
+        )
+        return loaded_tokenizer, loaded_model
+
     print(f"Hugging Faceからモデルをダウンロードしています: {model_name}")
-    tokenizer = AutoTokenizer.from_pretrained(
+    loaded_tokenizer = AutoTokenizer.from_pretrained(
         model_name,
         trust_remote_code=True
     )
-    model = AutoModel.from_pretrained(
+    loaded_model = AutoModel.from_pretrained(
         model_name,
         trust_remote_code=True,
         use_safetensors=True,
         torch_dtype=torch.float32 if not torch.cuda.is_available() else torch.bfloat16
     )
-    
+
     print("モデルをローカルに保存しています...")
     os.makedirs(LOCAL_MODEL_DIR, exist_ok=True)
-    tokenizer.save_pretrained(LOCAL_MODEL_DIR)
+    loaded_tokenizer.save_pretrained(LOCAL_MODEL_DIR)
     # CPU環境ではfloat32で保存
     if not torch.cuda.is_available():
-        model = model.to(torch.float32)
-        for param in model.parameters():
+        loaded_model = loaded_model.to(torch.float32)
+        for param in loaded_model.parameters():
             if param.dtype != torch.float32:
                 param.data = param.data.to(torch.float32)
-    model.save_pretrained(LOCAL_MODEL_DIR, safe_serialization=True)
+    loaded_model.save_pretrained(LOCAL_MODEL_DIR, safe_serialization=True)
+    return loaded_tokenizer, loaded_model
 
-# モデルを準備
-if torch.cuda.is_available():
-    try:
-        model = model.eval().cuda().to(torch.bfloat16)
-        device_info = "GPU"
-    except:
+def load_model():
+    """
+    モデル・トークナイザーを読み込んで推論の準備をし、モジュールの変数に設定する（model_registryから呼ばれる）
+
+    ワーカー使用時はモデルを読み込まず、推論ワーカーを起動してモデルの読み込みが終わるまで待つ
+    """
+    global tokenizer, model, worker_pool, prompt_tokenizer, infer_tokenizer, dtype_guard, INFER_IN_MEMORY
+    global QUANTIZATION, device_info
+    if SERVE_WITH_WORKERS:
+        print(f"推論ワーカー{WORKERS}個で起動します（このプロセスではモデルを読み込みません）")
+        if MODEL_BACKEND != "stub" and not torch.cuda.is_available() and not is_prepared(PREPARED_MODEL_DIR):
+            print("警告: 変換済みモデルがないため、重みはワーカーごとに別々のメモリに読み込まれます")
+        worker_pool = WorkerPool("deepseekuse_gradio").start()
+        return
+
+    # CPU推論のスレッド数を設定する（同時に処理するリクエスト数でCPUを分け合う）
+    apply_thread_profile(streams=CONCURRENCY_LIMIT)
+    print("モデルを読み込んでいます...")
+    loaded_tokenizer, loaded_model = load_pretrained()
+
+    # モデルを準備
+    if torch.cuda.is_available():
+        try:
+            loaded_model = loaded_model.eval().cuda().to(torch.bfloat16)
+            device_info = "GPU"
+        except:
+            # CPU環境ではすべてfloat32に確実に変換
+            loaded_model = loaded_model.eval()
+            dtype_guard = Float32Guard(loaded_model).install()
+            device_info = "CPU (CUDA利用不可)"
+    else:
         # CPU環境ではすべてfloat32に確実に変換
-        model = model.eval()
-        convert_model_to_float32(model)
-        device_info = "CPU (CUDA利用不可)"
-else:
-    # CPU環境ではすべてfloat32に確実に変換
-    model = model.eval()
-    convert_model_to_float32(model)
-    device_info = "CPU"
+        loaded_model = loaded_model.eval()
+        dtype_guard = Float32Guard(loaded_model).install()
+        device_info = "CPU"
+
+    QUANTIZATION = quantize_from_env(loaded_model)
+    if QUANTIZATION != "off":
+        device_info += f" ({QUANTIZATION})"
 
-print(f"モデル読み込み完了 (デバイス: {device_info})")
+    # model.infer内で毎回トークナイズされる固定のプロンプト断片はencode結果を使い回す
+    prompt_tokenizer = CachedEncodeTokenizer(loaded_tokenizer) if PRETOKENIZED_PROMPT else None
+    infer_tokenizer = prompt_tokenizer if prompt_tokenizer is not None else loaded_tokenizer
 
-# CPU環境で動作するようにモンキーパッチを適用
+    # model.infer内のgenerateに、リクエストごとの生成トークン数の上限と繰り返しの検出を適用できるようにする
+    if hasattr(loaded_model, "generate"):
+        install_generate_limit(loaded_model, [loaded_tokenizer.eos_token_id, loaded_tokenizer.pad_token_id])
+
+    INFER_IN_MEMORY = "eval_mode" in inspect.signature(loaded_model.infer).parameters
+    if not INFER_IN_MEMORY:
+        print("警告: model.inferがeval_modeに対応していないため、結果をファイル経由で受け取ります（検出結果画像なし）")
+
+    tokenizer, model = loaded_tokenizer, loaded_model
+    print(f"モデル読み込み完了 (デバイス: {device_info})")
+
+# CPU環境では推論中だけCPU互換モード（.cuda()/.to()/autocastの差し替え）を有効にする
 if not torch.cuda.is_available():
-    print("CPU環境を検出しました。CPU互換モードを有効化します...")
-
-    # .cuda()をパッチ
-    original_cuda = torch.Tensor.cuda
-    def patched_cuda(self, *args, **kwargs):
-        # CPU環境では常にfloat32に変換してから返す
-        if self.dtype == torch.bfloat16:
-            return self.float()
-        return self
-    torch.Tensor.cuda = patched_cuda
-
-    # .to()メソッドをパッチしてbfloat16への変換を防ぐ
-    original_to = torch.Tensor.to
-    def patched_to(self, *args, **kwargs):
-        # 引数を解析
-        if len(args) > 0:
-            # dtype指定がある場合（浮動小数点型のみ変換）
-            if isinstance(args[0], torch.dtype) and args[0] == torch.bfloat16:
-                # 整数型テンソルはそのまま、浮動小数点型のみfloat32に変換
-                if not self.dtype.is_floating_point:
-                    return original_to(self, *args, **kwargs)
-                args = (torch.float32,) + args[1:]
-        if 'dtype' in kwargs and kwargs['dtype'] == torch.bfloat16:
-            # 整数型テンソルはそのまま、浮動小数点型のみfloat32に変換
-            if not self.dtype.is_floating_point:
-                return original_to(self, *args, **kwargs)
-            kwargs['dtype'] = torch.float32
-        return original_to(self, *args, **kwargs)
-    torch.Tensor.to = patched_to
-
-    # torch.autocastをパッチ
-    from contextlib import contextmanager
-    original_autocast = torch.autocast
-
-    @contextmanager
-    def patched_autocast(device_type="cuda", enabled=True, dtype=None, **kwargs):
-        # CPU環境ではautocastを完全にスキップ
-        if device_type == "cuda" or not enabled:
-            # CUDAデバイスまたはenabledがFalseの場合は何もしない
-            yield
-        else:
-            # その他の場合（CPUでenabledがTrue）も何もしない
-            yield
-
-    torch.autocast = patched_autocast
-
-    print("CPU互換パッチを適用しました")
-
-def process_image_gradio(image, task, crop_mode):
+    print("CPU環境を検出しました。推論時にCPU互換モードを有効化します")
+    inference_context = cpu_compat_mode
+else:
+    inference_context = nullcontext
+
+# リクエストごとの作業ディレクトリの作成先（未指定時はシステムの一時ディレクトリ）
+SCRATCH_DIR = os.environ.get("OCR_SCRATCH_DIR") or None
+
+# メトリクス・ログで使うアプリ名
+APP_NAME = "deepseek-ocr"
+# 統合アプリ・推論ワーカーから読み込まれた場合はOCR処理だけを提供する（受付制御・UIは作らない）
+EMBEDDED = is_embedded()
+
+# 同じ画像の再アップロードに備えた結果キャッシュ
+result_cache = cache_from_env(APP_NAME)
+register_cache(APP_NAME, result_cache)
+# 撮り直し・圧縮し直しなど、ほぼ同一の画像に過去の結果を返す知覚ハッシュの索引
+near_duplicates = index_from_env(APP_NAME, result_cache)
+register_near_duplicates(APP_NAME, near_duplicates)
+
+# 混雑時に待たせずに拒否・縮退させる受付制御（UI・API・一括処理で共有）
+# 統合アプリから読み込まれた場合は統合アプリの受付制御を使うため作らない
+admission = None
+if not EMBEDDED:
+    admission = AdmissionController(APP_NAME)
+    register_admission(APP_NAME, admission)
+
+# クロップモードを手動指定した場合の解像度
+BASE_SIZE = 1024
+IMAGE_SIZE = 640
+
+# 生成トークン数の上限（model.infer内の既定値と同じ、テキスト密度から決める上限もこれを超えない）
+MAX_NEW_TOKENS = int(os.environ.get("OCR_DEEPSEEK_MAX_NEW_TOKENS", "8192"))
+
+# 前処理の画素数上限（クロップモードで細部を読むためQwen3-VLより大きめ）
+MAX_PIXELS = int(os.environ.get("OCR_DEEPSEEK_MAX_PIXELS", str(2048 * 2048)))
+
+# 同時に処理するリクエスト数（リクエストごとに作業ディレクトリが分かれるため2以上も可）
+CONCURRENCY_LIMIT = int(os.environ.get("OCR_CONCURRENCY_LIMIT", "1"))
+
+# ワーカープロセスで同時に受け付ける件数
+WORKER_CONCURRENCY = CONCURRENCY_LIMIT
+
+# UI・一括処理で同時に推論へ投入する件数（ワーカー使用時はワーカー数倍）
+PARALLELISM = CONCURRENCY_LIMIT * (WORKERS if SERVE_WITH_WORKERS else 1)
+
+def get_prompt(task):
+    """タスクに応じたプロンプトを返す"""
+    if task == "Markdown":
+        return "<image>\n<|grounding|>Convert the document to markdown. "
+    return "<image>\nFree OCR. "
+
+def resolve_mode(crop_mode, info, degraded=False):
     """
-    Gradio用の画像処理関数
+    クロップモードの指定（自動/有効/無効）から (base_size, image_size, crop_mode) を決める
+
+    縮退モードの自動選択ではタイル分割（gundam）を使わずbaseに落とす
     """
-    if image is None:
-        return "エラー: 画像がアップロードされていません", None
+    if crop_mode == "自動":
+        mode = info["deepseek_mode"]
+        if degraded and mode == "gundam":
+            mode = "base"
+        return DEEPSEEK_MODES[mode]
+    return BASE_SIZE, IMAGE_SIZE, crop_mode == "有効"
+
+def run_infer(image, prompt, base_size, image_size, crop, max_new_tokens=MAX_NEW_TOKENS):
+    """
+    リクエスト専用の作業ディレクトリでmodel.inferを実行し、(テキスト, 参照領域, 成功したか, 生成結果) を返す
 
-    # 一時ファイルとして画像を保存
-    temp_image = "./temp_input_image.png"
+    参照領域は画像上の画素座標（ocr_artifacts.parse_outputの形式）、生成結果は
+    {"max_new_tokens", "generated_tokens", "finish_reason"}
+    """
+    models.require(APP_NAME)
+    # リクエストごとに専用の作業ディレクトリを作成（同時実行時に入出力が衝突しないように）
+    workdir = tempfile.mkdtemp(prefix="deepseek_ocr_", dir=SCRATCH_DIR)
 
     try:
-        # PIL Imageをファイルとして保存
-        if image.mode == 'RGBA':
-            # RGBA画像はRGBに変換してから保存
-            rgb_image = image.convert('RGB')
-            rgb_image.save(temp_image, 'PNG')
-        else:
-            image.save(temp_image, 'PNG')
-
-        print(f"画像を保存しました: {temp_image}")
-
-        # タスクに応じたプロンプトを設定
-        if task == "Markdown":
-            prompt = "<image>\n<|grounding|>Convert the document to markdown. "
-        else:
-            prompt = "<image>\nFree OCR. "
-
-        # 出力ディレクトリ
-        output_path = './output'
-        os.makedirs(output_path, exist_ok=True)
-
-        print(f"画像処理を開始します... タスク: {task}, クロップ: {crop_mode}")
-
-        # モデルを再度float32に変換（infer内部で動的に作成される可能性があるため）
-        if not torch.cuda.is_available():
-            convert_model_to_float32(model)
-            # sam_modelや他のサブモジュールも明示的に変換
-            for name, module in model.named_modules():
-                if hasattr(module, 'sam_model') and module.sam_model is not None:
-                    convert_model_to_float32(module.sam_model)
-                if hasattr(module, 'clip_model') and module.clip_model is not None:
-                    convert_model_to_float32(module.clip_model)
+        # model.inferはファイルパスを受け取るため、無圧縮のBMPで書き出してPNGのエンコード/デコードを省く
+        temp_image = os.path.join(workdir, "input.bmp")
+        with stage("scratch_write"):
+            image.save(temp_image, 'BMP')
+
+        # 前回以降に追加されたサブモジュールだけをfloat32に変換（追加がなければ何もしない）
+        if dtype_guard is not None:
+            with stage("dtype_check"):
+                dtype_guard.ensure(full_check=VERIFY_DTYPE)
 
         # 処理の実行（CPUモード対応）
-        res = model.infer(
-            tokenizer,
-            prompt=prompt,
-            image_file=temp_image,
-            output_path=output_path,
-            base_size=1024,
-            image_size=640,
-            crop_mode=(crop_mode == "有効"),
-            save_results=True,
-            test_compress=True
+        # model.inferは内部でgenerateを呼ぶためprefillとdecodeは分けずにまとめて計測する
+        # eval_modeでは生の出力をそのまま返させ、結果ファイル・検出結果画像の書き出しを省く
+        with stage("generate"), inference_context(), limit_generation(max_new_tokens) as limit:
+            res = model.infer(
+                infer_tokenizer,
+                prompt=prompt,
+                image_file=temp_image,
+                output_path=workdir,
+                base_size=base_size,
+                image_size=image_size,
+                crop_mode=crop,
+                save_results=not INFER_IN_MEMORY,
+                test_compress=not INFER_IN_MEMORY,
+                **({"eval_mode": True} if INFER_IN_MEMORY else {})
+            )
+
+        regions = []
+        with stage("result_io"):
+            if INFER_IN_MEMORY:
+                found = isinstance(res, str)
+                if found:
+                    result_text, raw_regions = parse_output(res)
+                    regions = place_regions(raw_regions, (0, 0, image.width, image.height))
+            else:
+                # eval_modeに対応していないモデルでは、作業ディレクトリに保存された結果を読み込む
+                result_file = os.path.join(workdir, 'result.mmd')
+                found = os.path.exists(result_file)
+                if found:
+                    with open(result_file, 'r', encoding='utf-8') as f:
+                        result_text = f.read()
+            if not found:
+                result_text = "結果を取得できませんでした。"
+
+        if found and limit.generated_tokens is None:
+            # generateを差し替えられない場合は、結果テキストを再トークナイズして数える
+            limit.generated_tokens = len(tokenizer.encode(result_text, add_special_tokens=False))
+        if found:
+            for trace in active_traces():
+                if trace is not None:
+                    trace.set("generated_tokens", limit.generated_tokens)
+                    if limit.finish_reason is not None:
+                        trace.set("finish_reason", limit.finish_reason)
+
+        return result_text, regions, found, limit.summary()
+
+    finally:
+        # 作業ディレクトリごと確実に削除
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def worker_infer(request, trace):
+    """ワーカープロセスでの1件分の推論（ocr_worker.pyから呼ばれる）"""
+    with track(trace):
+        return run_infer(
+            request["image"], request["prompt"], request["base_size"], request["image_size"], request["crop"],
+            request["max_new_tokens"]
         )
 
-        # 保存されたファイルから結果を読み込む
-        result_file = os.path.join(output_path, 'result.mmd')
-        result_image = os.path.join(output_path, 'result_with_boxes.jpg')
+def warmup_model():
+    """合成画像で1回推論する（ワーカー使用時は各ワーカーの読み込みで行う）"""
+    if not SERVE_WITH_WORKERS:
+        run_infer(warmup_image(), get_prompt("OCR"), BASE_SIZE, IMAGE_SIZE, False, max_new_tokens=16)
+
+def unload_model():
+    """モデル・トークナイザー（ワーカー使用時は推論ワーカー）を手放す（次の推論で再び読み込まれる）"""
+    global tokenizer, model, worker_pool, prompt_tokenizer, infer_tokenizer, dtype_guard
+    if worker_pool is not None:
+        worker_pool.close()
+    # 登録フックがガード経由でモデルを参照し続けるため、先に外す
+    if dtype_guard is not None:
+        dtype_guard.remove()
+    tokenizer = model = worker_pool = prompt_tokenizer = infer_tokenizer = dtype_guard = None
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+# モデルの読み込みと準備状態（サーバー起動時にOCR_MODEL_LOADINGに従って読み込む）
+models = ModelRegistry().register(APP_NAME, load_model, warmup_model, unload_model)
+
+def infer_page(image, info, prompt, crop_mode, degraded=False, trace=None):
+    """
+    前処理済みの画像1枚を推論し、(テキスト, 参照領域（画像の画素座標）, 成功したか, 生成結果) を返す
+
+    自動モードではテキスト密度から解像度を選び、選んだ値をinfoに書き込む
+    """
+    base_size, image_size, crop = resolve_mode(crop_mode, info, degraded)
+    info.update(base_size=base_size, image_size=image_size, crop_mode=crop)
+    # テキスト密度から生成トークン数の上限を決める
+    max_new_tokens = adaptive_max_new_tokens(info, MAX_NEW_TOKENS, cap=MAX_NEW_TOKENS)
+    print(f"推論を開始します... ({base_size}/{image_size}/{crop}, 最大{max_new_tokens}トークン)")
+    # 読み込み中はここで待つ（キャッシュにある結果は読み込み中でも返せる）
+    models.require(APP_NAME)
+    if worker_pool is not None:
+        request = {
+            "image": image, "prompt": prompt, "base_size": base_size, "image_size": image_size,
+            "crop": crop, "max_new_tokens": max_new_tokens,
+        }
+        return worker_pool.call(request, trace)
+    return run_infer(image, prompt, base_size, image_size, crop, max_new_tokens)
+
+def ocr_tiled(image, prompt, crop_mode):
+    """
+    大きな画像をタイルに分割して並列に推論し、(テキスト, 参照領域, 成功したか, 生成結果, 処理パラメータ) を返す
 
-        result_text = ""
-        result_img = None
+    参照領域は各タイルの参照領域を分割前の画像（余白除去・縮小後）の画素座標に移したもの
+    """
+    def ocr_tile(tile):
+        tile_image, info = preprocess_image(tile, max_pixels=MAX_PIXELS, trim=False)
+        text, regions, found, generation = infer_page(tile_image, info, prompt, crop_mode)
+        # タイル画像は前処理で縮小されることがあるため、いったん相対座標に戻す
+        scale = (tile.width / tile_image.width, tile.height / tile_image.height)
+        regions = [
+            dict(region, boxes=[
+                [x1 * scale[0], y1 * scale[1], x2 * scale[0], y2 * scale[1]] for x1, y1, x2, y2 in region["boxes"]
+            ])
+            for region in regions
+        ]
+        return {"text": text if found else "", "regions": regions, "found": found, "generation": generation}
+
+    with stage("tiles"):
+        tiled = ocr_tiles(image, MAX_PIXELS, ocr_tile, max_workers=PARALLELISM)
+
+    results = []
+    regions = []
+    for tile in tiled["tiles"]:
+        result = tile["result"]
+        if result is None:
+            continue
+        results.append(result)
+        left, top = tile["box"][:2]
+        regions.extend(
+            dict(region, boxes=[
+                [int(left + x1), int(top + y1), int(left + x2), int(top + y2)] for x1, y1, x2, y2 in region["boxes"]
+            ])
+            for region in result["regions"]
+        )
 
-        # テキスト結果を読み込み
-        if os.path.exists(result_file):
-            with open(result_file, 'r', encoding='utf-8') as f:
-                result_text = f.read()
-            print(f"結果を読み込みました: {result_file}")
-        else:
-            result_text = "結果ファイルが見つかりませんでした。"
+    generation = combine_generation([result["generation"] for result in results])
+    for trace in active_traces():
+        if trace is not None:
+            trace.set("tiles", len(results))
+            trace.set("generated_tokens", generation["generated_tokens"])
+            trace.set("finish_reason", generation["finish_reason"])
+    info = dict(tiled["tiling"], original_size=[image.width, image.height], tiled=True)
+    info["tile_results"] = [
+        {
+            "row": tile["row"], "col": tile["col"], "box": tile["box"], "skipped": tile["skipped"],
+            "finish_reason": tile["result"]["generation"]["finish_reason"] if tile["result"] else None,
+        }
+        for tile in tiled["tiles"]
+    ]
+    # 余白だけの画像はタイルがすべて飛ばされるため、推論したタイルがなくても成功とする
+    found = not results or any(result["found"] for result in results)
+    return tiled["text"], regions, found, generation, info
+
+def ocr_image(image, task, crop_mode, trace=None, degraded=False):
+    """
+    1枚の画像を処理する（失敗時は例外を送出）
+
+    戻り値: {"text": 結果テキスト, "regions": 参照領域（前処理後の画像の画素座標）,
+            "blocks": 読み順のブロック（種類・アップロードされた画像上の座標・テキスト）, "preprocess": 前処理・解像度パラメータ, "generation": 生成トークン数の上限・生成トークン数・終了理由,
+            "cached": キャッシュから返したか}
+    検出結果画像はannotated_image(image, result["blocks"])で必要になった時点でリクエストの画像に描画する
+    traceを渡した場合は各段階の所要時間を記録する（終了処理は呼び出し側で行う）
+    degradedの場合は画素数予算を下げて処理し、結果はキャッシュしない
+    キャッシュにない画像は知覚ハッシュでほぼ同一の画像の結果を探す（見つかればnear_duplicateに距離を付けて返す）
+    画素数予算に比べて大きな画像はタイルに分割して推論する（縮退モードでは分割せず縮小する）
+    """
+    own_trace = trace is None
+    if own_trace:
+        trace = RequestTrace(APP_NAME)
+    status = "error"
 
-        # バウンディングボックス付き画像を読み込み
-        if os.path.exists(result_image):
-            result_img = result_image
-            print(f"結果画像を読み込みました: {result_image}")
+    try:
+        with track(trace):
+            with stage("upload_decode"):
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+            source = image
+
+            prompt = get_prompt(task)
+            with stage("cache_lookup"):
+                settings = {
+                    "model": model_name,
+                    "task": task,
+                    "prompt": prompt,
+                    "crop_mode": crop_mode,
+                    "base_size": BASE_SIZE,
+                    "image_size": IMAGE_SIZE,
+                    "max_pixels": MAX_PIXELS,
+                    "quantization": QUANTIZATION,
+                    "max_new_tokens": MAX_NEW_TOKENS,
+                    "generation": generation_settings(),
+                    "tiling": tiling_settings(),
+                    "preprocess": preprocess_settings(),
+                    "layout": LAYOUT_VERSION,
+                }
+                cache_key = result_cache.make_key(image, **settings)
+                cached = result_cache.get(cache_key)
+            if cached is not None:
+                print(f"キャッシュから結果を返します: {result_cache.stats()}")
+                status = "cached"
+                return dict(cached, cached=True)
+
+            with stage("near_duplicate_lookup"):
+                near, fingerprint = near_duplicates.find(image, settings, result_cache)
+            if near is not None:
+                print(f"ほぼ同一の画像の結果を返します: {near['near_duplicate']}")
+                status = "near_duplicate"
+                # ブロックの座標はこの画像の大きさに合わせる（検出結果画像もこの画像に描画する）
+                near["blocks"] = rescale_blocks(
+                    near["blocks"], near["preprocess"]["original_size"], [image.width, image.height]
+                )
+                return dict(near, cached=True)
+
+            if not degraded and needs_tiling(image, MAX_PIXELS):
+                print(f"画像処理を開始します... タスク: {task}, クロップ: {crop_mode} (タイル分割)")
+                result_text, regions, found, generation, info = ocr_tiled(image, prompt, crop_mode)
+            else:
+                # 余白除去・画素数予算への縮小を行い、自動モードではテキスト密度から解像度を選ぶ
+                with stage("preprocess"):
+                    max_pixels = degraded_pixels(MAX_PIXELS) if degraded else MAX_PIXELS
+                    image, info = preprocess_image(image, max_pixels=max_pixels)
+                if degraded:
+                    info["degraded"] = True
+
+                print(f"画像処理を開始します... タスク: {task}, クロップ: {crop_mode}")
+                result_text, regions, found, generation = infer_page(
+                    image, info, prompt, crop_mode, degraded, trace
+                )
+        result = {
+            "text": result_text, "regions": regions, "blocks": layout_blocks(regions, info),
+            "preprocess": info, "generation": generation
+        }
+
+        # 正常に結果が得られた場合のみキャッシュする
+        if found:
+            if not degraded:
+                result_cache.put(cache_key, result)
+                near_duplicates.add(fingerprint, settings, cache_key)
+            status = "ok"
+            # OCR_ARCHIVE_DIRを指定した場合のみ従来の形式でディスクにも保存する
+            if ARCHIVE_DIR:
+                archive_artifacts(result_text, annotated_image(source, result["blocks"]))
 
         print("処理が完了しました")
-        return result_text, result_img
+        return dict(result, cached=False)
+    finally:
+        if own_trace:
+            trace.finish(status)
+
+def process_image_gradio(image, task, crop_mode, request: gr.Request = None):
+    """
+    Gradio用の画像処理関数
+
+    (テキスト, 前処理・生成の情報, 読み順のブロック, 検出結果画像の描画に使う結果) を返す
+    （画像はrender_boxes_gradioで描画する）
+    requestはGradioが型注釈を見て渡す接続情報（受付制御のクライアント識別に使用）
+    """
+    if image is None:
+        return "エラー: 画像がアップロードされていません", None, None, None
 
+    try:
+        with admission.admit(client_id(request)) as ticket:
+            result = ocr_image(image, task, crop_mode, degraded=ticket.degraded)
+            ticket.measured = not result["cached"]
+        artifacts = {"image": image, "blocks": result["blocks"]}
+        info = dict(result["preprocess"], generation=result["generation"])
+        return result["text"], info, result["blocks"], artifacts
+
+    except (AdmissionRejected, ModelNotReady) as e:
+        return f"エラー: {e}", None, None, None
     except Exception as e:
         import traceback
         error_msg = f"エラーが発生しました: {str(e)}\n\n詳細:\n{traceback.format_exc()}"
         print(error_msg)
-        return error_msg, None
-    finally:
-        # 一時ファイルのクリーンアップ
-        if os.path.exists(temp_image):
-            try:
-                os.remove(temp_image)
-            except:
-                pass
-
-# Google AdSense設定（環境変数から取得）
-ADSENSE_CLIENT_ID = os.environ.get("ADSENSE_CLIENT_ID", "")
-ADSENSE_SLOT_TOP = os.environ.get("ADSENSE_SLOT_TOP", "")
-ADSENSE_SLOT_BOTTOM = os.environ.get("ADSENSE_SLOT_BOTTOM", "")
-
-# AdSense広告HTML（設定されている場合のみ表示）
-def get_adsense_top():
-    if ADSENSE_CLIENT_ID and ADSENSE_SLOT_TOP:
-        return f"""
-        <div class="adsense-banner-top" style="text-align: center; margin: 20px 0;">
-          <ins class="adsbygoogle"
-               style="display:block"
-               data-ad-client="ca-pub-{ADSENSE_CLIENT_ID}"
-               data-ad-slot="{ADSENSE_SLOT_TOP}"
-               data-ad-format="auto"
-               data-full-width-responsive="true"></ins>
-          <script>
-               (adsbygoogle = window.adsbygoogle || []).push({{}});
-          </script>
-        </div>
-        """
-    return ""
-
-def get_adsense_bottom():
-    if ADSENSE_CLIENT_ID and ADSENSE_SLOT_BOTTOM:
-        return f"""
-        <div class="adsense-banner-bottom" style="text-align: center; margin: 20px 0;">
-          <ins class="adsbygoogle"
-               style="display:block"
-               data-ad-client="ca-pub-{ADSENSE_CLIENT_ID}"
-               data-ad-slot="{ADSENSE_SLOT_BOTTOM}"
-               data-ad-format="auto"
-               data-full-width-responsive="true"></ins>
-          <script>
-               (adsbygoogle = window.adsbygoogle || []).push({{}});
-          </script>
-        </div>
-        """
-    return ""
-
-def get_adsense_script():
-    if ADSENSE_CLIENT_ID:
-        return f"""
-        <script async src="https://pagead2.googlesyndication.com/pagead/js/adsbygoogle.js?client=ca-pub-{ADSENSE_CLIENT_ID}"
-             crossorigin="anonymous"></script>
-        """
-    return ""
-
-# Gradioインターフェースの作成
-with gr.Blocks(title="DeepSeek-OCR Chat Tool", head=get_adsense_script()) as demo:
-    # トップバナー広告
-    if get_adsense_top():
-        gr.HTML(get_adsense_top())
-
-    gr.Markdown(
-        """
-        # DeepSeek-OCR チャットツール
-
-        画像をアップロードして、OCR処理またはMarkdown変換を行います。
-        """
-    )
+        return error_msg, None, None, None
 
-    with gr.Row():
-        with gr.Column():
-            image_input = gr.Image(
-                type="pil",
-                label="画像をアップロード"
-            )
+def render_boxes_gradio(artifacts, show_boxes):
+    """検出結果画像の表示が選ばれている場合のみ描画する（テキストの表示を待たせない）"""
+    if not show_boxes or not artifacts:
+        return None
+    return annotated_image(artifacts["image"], artifacts["blocks"])
 
-            task_radio = gr.Radio(
-                choices=["OCR", "Markdown"],
-                value="OCR",
-                label="処理タイプ"
-            )
+# 一括処理で同時に処理するページ数（全ページで1つのモデルを共有する）
+PAGE_WORKERS = int(os.environ.get("OCR_PAGE_WORKERS", str(PARALLELISM)))
 
-            crop_mode_radio = gr.Radio(
-                choices=["有効", "無効"],
-                value="有効",
-                label="クロップモード"
-            )
+def process_documents_gradio(files, task, crop_mode, request: gr.Request = None):
+    """
+    複数の画像・PDFをページ順に処理し、結合したテキストと処理時間を返す
 
-            submit_btn = gr.Button("処理実行", variant="primary")
+    受付制御はページ単位で行う（混雑時に拒否されたページはエラーとして記録される）
+    """
+    client = client_id(request)
 
-        with gr.Column():
-            output_text = gr.Textbox(
-                label="OCR結果テキスト",
-                lines=15,
-                max_lines=30,
-                placeholder="結果がここに表示されます...",
-                show_copy_button=True
-            )
+    def ocr_page(image):
+        with admission.admit(client) as ticket:
+            result = ocr_image(image, task, crop_mode, degraded=ticket.degraded)
+            ticket.measured = not result["cached"]
+        return result["text"]
 
-            output_image = gr.Image(
-                label="検出結果（バウンディングボックス付き）",
-                type="filepath"
-            )
+    try:
+        return process_documents(files, ocr_page, max_workers=PAGE_WORKERS)
+    except Exception as e:
+        import traceback
+        error_msg = f"エラーが発生しました: {str(e)}\n\n詳細:\n{traceback.format_exc()}"
+        print(error_msg)
+        return error_msg, ""
+
+# APIで受け付けるパラメータ値（英語表記も可）
+API_TASKS = {"ocr": "OCR", "markdown": "Markdown"}
+API_CROP_MODES = {"auto": "自動", "on": "有効", "off": "無効", "自動": "自動", "有効": "有効", "無効": "無効"}
+
+def api_result(image, params, trace=None, degraded=False):
+    """APIで返す結果（検出結果画像を除く）と、boxes=1の場合のみ検出結果画像を返す"""
+    task = API_TASKS.get(params.get("task", "ocr").lower())
+    crop_mode = API_CROP_MODES.get(params.get("crop_mode", "auto").lower())
+    if task is None:
+        raise ValueError("taskにはocrまたはmarkdownを指定してください")
+    if crop_mode is None:
+        raise ValueError("crop_modeにはauto、onまたはoffを指定してください")
+
+    result = ocr_image(image, task, crop_mode, trace, degraded=degraded)
+    response = {
+        "model": model_name,
+        "task": task,
+        "text": result["text"],
+        # Markdown（参照領域付き）では領域ごとの種類・座標・テキストを読み順に返す（検出結果画像は不要）
+        "blocks": result["blocks"],
+        "preprocess": result["preprocess"],
+        "cached": result["cached"],
+        # ほぼ同一の画像の結果を返した場合はハッシュのハミング距離（それ以外はNone）
+        "near_duplicate": result.get("near_duplicate"),
+        "degraded": degraded and not result["cached"],
+        # finish_reason: stop（最後まで生成）/ length（上限で打ち切り）/ repetition（繰り返しで打ち切り）
+        "generation": result["generation"],
+        "truncated": result["generation"]["finish_reason"] == FINISH_LENGTH,
+        "early_stopped": result["generation"]["finish_reason"] == FINISH_REPETITION,
+        "boxes_image": None
+    }
+    return response, annotated_image(image, result["blocks"]) if boxes_requested(params) else None
+
+def api_ocr(image, params, trace=None, ticket=None):
+    """
+    HTTP API用のOCR処理（task=ocr|markdown, crop_mode=auto|on|off, boxes=1で検出結果画像を付与）
 
-    gr.Markdown(
-        """
-        ### 使い方
-        1. 画像をアップロード
-        2. 処理タイプを選択（OCRまたはMarkdown）
-        3. クロップモードを設定
-        4. 「処理実行」ボタンをクリック
-        5. 結果がWeb上に表示され、`./output` ディレクトリにも保存されます
-
-        ### 出力ファイル
-        - `output/result.mmd`: OCR結果のテキスト
-        - `output/result_with_boxes.jpg`: バウンディングボックス付き画像
-        - `output/images/`: 抽出された画像（ある場合）
-        """
-    )
+    受付判定はAPI側で済んでおり、ticketが縮退モードなら軽い設定で処理する
+    """
+    response, result_image = api_result(image, params, trace, degraded=ticket is not None and ticket.degraded)
+    if result_image is not None:
+        response["boxes_image"] = encode_image_base64(result_image)
+    return response
+
+def job_ocr(image, params, trace):
+    """非同期ジョブ用のOCR処理（検出結果画像はBase64にせずファイルとして保存する）"""
+    # ジョブは急がないため、起動直後のモデルの読み込みは完了まで待つ
+    models.require(APP_NAME, timeout=None)
+    return api_result(image, params, trace)
+
+def api_health():
+    workers = worker_pool.stats() if worker_pool is not None else None
+    return {
+        "ready": models.ready() and (workers is None or any(worker["healthy"] for worker in workers)),
+        "model": model_name,
+        "loading": models.status()[APP_NAME],
+        "device": device_info,
+        "quantization": QUANTIZATION,
+        "threads": applied_profile(),
+        "admission": admission.stats() if admission is not None else None,
+        "prompt": prompt_tokenizer.stats() if prompt_tokenizer is not None else None,
+        "workers": workers
+    }
+
+def create_demo():
+    """Gradioインターフェースを作成する"""
+    with gr.Blocks(title="DeepSeek-OCR Chat Tool", head=get_adsense_script()) as demo:
+        # トップバナー広告
+        if get_adsense_top():
+            gr.HTML(get_adsense_top())
+
+        gr.Markdown(
+            """
+            # DeepSeek-OCR チャットツール
+
+            画像をアップロードして、OCR処理またはMarkdown変換を行います。
+            """
+        )
 
-    submit_btn.click(
-        fn=process_image_gradio,
-        inputs=[image_input, task_radio, crop_mode_radio],
-        outputs=[output_text, output_image]
-    )
+        with gr.Tabs():
+            with gr.Tab("画像1枚"):
+                with gr.Row():
+                    with gr.Column():
+                        image_input = gr.Image(
+                            type="pil",
+                            label="画像をアップロード"
+                        )
+
+                        task_radio = gr.Radio(
+                            choices=["OCR", "Markdown"],
+                            value="OCR",
+                            label="処理タイプ"
+                        )
+
+                        crop_mode_radio = gr.Radio(
+                            choices=["自動", "有効", "無効"],
+                            value="自動",
+                            label="クロップモード"
+                        )
+
+                        submit_btn = gr.Button("処理実行", variant="primary")
+
+                    with gr.Column():
+                        output_text = gr.Textbox(
+                            label="OCR結果テキスト",
+                            lines=15,
+                            max_lines=30,
+                            placeholder="結果がここに表示されます...",
+                            show_copy_button=True
+                        )
+
+                        show_boxes = gr.Checkbox(
+                            value=True,
+                            label="検出結果画像を表示（Markdownの参照領域がある場合のみ）"
+                        )
+
+                        output_image = gr.Image(
+                            label="検出結果（バウンディングボックス付き）",
+                            type="pil"
+                        )
+
+                        result_artifacts = gr.State(None)
+
+                        layout_output = gr.JSON(
+                            label="レイアウト（読み順のブロック: 種類・座標・テキスト）"
+                        )
+
+                        preprocess_info = gr.JSON(
+                            label="前処理・解像度・生成トークン数"
+                        )
+
+            with gr.Tab("一括処理（複数画像・PDF）"):
+                with gr.Row():
+                    with gr.Column():
+                        files_input = gr.File(
+                            file_count="multiple",
+                            file_types=["image", ".pdf"],
+                            label="画像・PDFをアップロード（複数可）"
+                        )
+
+                        batch_task_radio = gr.Radio(
+                            choices=["OCR", "Markdown"],
+                            value="Markdown",
+                            label="処理タイプ"
+                        )
+
+                        batch_crop_mode_radio = gr.Radio(
+                            choices=["自動", "有効", "無効"],
+                            value="自動",
+                            label="クロップモード"
+                        )
+
+                        batch_btn = gr.Button("一括処理実行", variant="primary")
+
+                        batch_timings = gr.Markdown()
+
+                    with gr.Column():
+                        batch_output = gr.Textbox(
+                            label="結合された結果（ページ順）",
+                            lines=15,
+                            max_lines=30,
+                            placeholder="結果がここに表示されます...",
+                            show_copy_button=True
+                        )
+
+        gr.Markdown(
+            """
+            ### 使い方
+            1. 画像をアップロード
+            2. 処理タイプを選択（OCRまたはMarkdown）
+            3. クロップモードを設定（「自動」では画像の文字量に応じて解像度とクロップを選択）
+            4. 「処理実行」ボタンをクリック
+            5. 結果がWeb上に表示されます
+            6. 複数の画像やPDFは「一括処理」タブでまとめて処理できます（ページ順に結合されます）
+
+            ### 出力について
+            - 結果はメモリ上で作成され、検出結果画像は表示するときにだけ描画されます
+            - Markdownでは参照領域を読み順のブロック（種類・元の画像上の座標・テキスト）としても表示します（APIのblocks）
+            - ディスクへの保存は OCR_ARCHIVE_DIR を設定した場合のみ行われます
+            - 複数のリクエストを同時に処理しても結果が混ざることはありません
+            """
+        )
+
+        submit_btn.click(
+            fn=process_image_gradio,
+            inputs=[image_input, task_radio, crop_mode_radio],
+            outputs=[output_text, preprocess_info, layout_output, result_artifacts],
+            concurrency_limit=PARALLELISM
+        ).then(
+            fn=render_boxes_gradio,
+            inputs=[result_artifacts, show_boxes],
+            outputs=[output_image]
+        )
+
+        show_boxes.change(
+            fn=render_boxes_gradio,
+            inputs=[result_artifacts, show_boxes],
+            outputs=[output_image]
+        )
+
+        batch_btn.click(
+            fn=process_documents_gradio,
+            inputs=[files_input, batch_task_radio, batch_crop_mode_radio],
+            outputs=[batch_output, batch_timings]
+        )
+
+        # ボトムバナー広告
+        if get_adsense_bottom():
+            gr.HTML(get_adsense_bottom())
+
+    return demo
 
-    # ボトムバナー広告
-    if get_adsense_bottom():
-        gr.HTML(get_adsense_bottom())
+# 統合アプリ・推論ワーカーから読み込まれた場合はUIを作らない
+demo = None if EMBEDDED else create_demo()
 
 if __name__ == "__main__":
     # Cloud Run環境ではPORT環境変数を使用
     port = int(os.environ.get("PORT", 7860))
-    demo.launch(share=False, server_name="0.0.0.0", server_port=port)
+    # モデルはOCR_MODEL_LOADINGに従って読み込む（既定ではUI・ヘルスチェックを先に起動し、裏で読み込む）
+    models.start_from_env()
+    # 長いドキュメント向けの非同期ジョブ（/api/jobs、完了まで/api/ocrと同じ受付制御の件数に数える）
+    jobs = JobQueue(APP_NAME, job_ocr, decode_image, admission=admission).start()
+    register_jobs(APP_NAME, jobs)
+    # Gradio UIとHTTP API（/api/ocr, /api/jobs, /healthz）を同じサーバーで提供
+    api = create_api(api_ocr, api_health, title="DeepSeek-OCR API", app_name=APP_NAME, admission=admission, jobs=jobs)
+    serve(demo, api, port)
 
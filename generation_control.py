@@ -0,0 +1,260 @@
+"""
+生成トークン数の上限の調整と、繰り返しによる早期終了
+
+- 前処理で推定したテキスト密度から1枚ごとにmax_new_tokensを決める
+  （名刺・ラベルのような短い画像で長い幻覚が続くのを防ぎ、文字の多いページは途中で切らない）
+- 生成結果の末尾が長い範囲にわたって同じ行の繰り返しだけになったら、その行の生成を打ち切る
+  （繰り返し部分は1回分だけ残す。表の「0」「同上」のような正当な繰り返しを切らないよう、
+  複数トークンの行は8回以上、1〜数トークンの繰り返しはさらに長い範囲を条件とする）
+- 終了トークンで最後まで生成した行は繰り返しがあってもそのまま返す
+- 結果には終了理由（stop: 終了トークン / length: 上限到達 / repetition: 繰り返しで打ち切り / cancelled: 切断などで中断）を付ける
+
+    OCR_ADAPTIVE_MAX_TOKENS=0 python app.py   # 従来どおり固定の上限を使う
+    OCR_REPETITION_STOP=0 python app.py       # 繰り返しの検出を行わない
+"""
+import math
+import os
+import threading
+from contextlib import contextmanager
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+# 1の場合はテキスト密度から生成トークン数の上限を決める
+ADAPTIVE_MAX_TOKENS = os.environ.get("OCR_ADAPTIVE_MAX_TOKENS", "1") == "1"
+# テキスト密度1.0あたりの推定トークン数と、推定値に掛ける余裕
+TOKENS_PER_DENSITY = float(os.environ.get("OCR_TOKENS_PER_DENSITY", "12000"))
+MAX_TOKENS_MARGIN = float(os.environ.get("OCR_MAX_TOKENS_MARGIN", "1.5"))
+# 調整後の上限の下限・上限
+MIN_NEW_TOKENS = int(os.environ.get("OCR_MIN_NEW_TOKENS", "64"))
+MAX_NEW_TOKENS_CAP = int(os.environ.get("OCR_MAX_NEW_TOKENS_CAP", "2048"))
+
+# 1の場合は繰り返しを検出して生成を打ち切る
+REPETITION_STOP = os.environ.get("OCR_REPETITION_STOP", "1") == "1"
+# 行の繰り返しとみなす周期の最小・最大トークン数（1行分の長さの目安）と、必要な繰り返し回数
+REPETITION_MIN_PERIOD = int(os.environ.get("OCR_REPETITION_MIN_PERIOD", "4"))
+REPETITION_MAX_PERIOD = int(os.environ.get("OCR_REPETITION_MAX_PERIOD", "128"))
+REPETITION_MIN_REPEATS = int(os.environ.get("OCR_REPETITION_MIN_REPEATS", "8"))
+# 新しい内容のない繰り返し部分全体に必要な最小トークン数（同じ行が続く表を誤検出しないための範囲）
+REPETITION_MIN_TOKENS = int(os.environ.get("OCR_REPETITION_MIN_TOKENS", "256"))
+# 周期がREPETITION_MIN_PERIOD未満のトークン単位の繰り返し（"0 0 0 ..."など）に必要な最小トークン数
+TOKEN_LOOP_MIN_TOKENS = int(os.environ.get("OCR_TOKEN_LOOP_MIN_TOKENS", "512"))
+# 何トークンごとに繰り返しを確認するか
+REPETITION_CHECK_INTERVAL = 4
+
+FINISH_STOP = "stop"
+FINISH_LENGTH = "length"
+FINISH_REPETITION = "repetition"
+FINISH_CANCELLED = "cancelled"
+
+
+def adaptive_max_new_tokens(info, default, cap=MAX_NEW_TOKENS_CAP):
+    """前処理の結果（preprocess_imageのinfo）から生成トークン数の上限を決める"""
+    if not ADAPTIVE_MAX_TOKENS or not info or "text_density" not in info:
+        return default
+    estimated = info["text_density"] * TOKENS_PER_DENSITY * MAX_TOKENS_MARGIN
+    return int(min(cap, max(MIN_NEW_TOKENS, math.ceil(estimated))))
+
+
+def generation_settings():
+    """キャッシュキーに含める生成の設定値"""
+    return {
+        "adaptive": ADAPTIVE_MAX_TOKENS,
+        "tokens_per_density": TOKENS_PER_DENSITY,
+        "margin": MAX_TOKENS_MARGIN,
+        "min": MIN_NEW_TOKENS,
+        "cap": MAX_NEW_TOKENS_CAP,
+        "repetition": [REPETITION_STOP, REPETITION_MIN_PERIOD, REPETITION_MAX_PERIOD, REPETITION_MIN_REPEATS,
+                       REPETITION_MIN_TOKENS, TOKEN_LOOP_MIN_TOKENS],
+    }
+
+
+def find_repetition(ids, max_period=REPETITION_MAX_PERIOD, min_repeats=REPETITION_MIN_REPEATS,
+                    min_tokens=REPETITION_MIN_TOKENS, min_period=1):
+    """
+    トークン列の末尾が同じ列の繰り返しになっていれば (繰り返しの開始位置, 周期) を返す（なければNone）
+    """
+    length = len(ids)
+    for period in range(max(1, min_period), max_period + 1):
+        if period * min_repeats > length:
+            break
+        span = max(period * min_repeats, min_tokens)
+        if span > length:
+            continue
+        if all(ids[i] == ids[i - period] for i in range(length - span + period, length)):
+            start = length - span
+            while start > 0 and ids[start - 1] == ids[start - 1 + period]:
+                start -= 1
+            return start, period
+    return None
+
+
+def find_loop(ids):
+    """
+    生成を打ち切る繰り返しを探す（なければNone）
+
+    - 行の繰り返し: 複数トークンの同じ列がREPETITION_MIN_REPEATS回以上続き、
+      末尾のREPETITION_MIN_TOKENSトークンに新しい内容がない
+    - トークン単位の繰り返し: 周期の短い列が末尾のTOKEN_LOOP_MIN_TOKENSトークンを占める
+    """
+    loop = find_repetition(ids, min_period=REPETITION_MIN_PERIOD)
+    if loop is not None:
+        start, period = loop
+        unit = ids[start:start + period]
+        # 1〜数トークンの繰り返しは周期の倍数でも一致するため、行の繰り返しとはみなさない
+        if not any(
+            period % short == 0 and all(unit[i] == unit[i - short] for i in range(short, period))
+            for short in range(1, REPETITION_MIN_PERIOD)
+        ):
+            return loop
+    return find_repetition(ids, max_period=REPETITION_MIN_PERIOD - 1, min_tokens=TOKEN_LOOP_MIN_TOKENS)
+
+
+class GenerationMonitor(StoppingCriteria):
+    """
+    generateに渡す終了条件（バッチの行ごとに上限トークン数と繰り返しを判定する）
+
+    prompt_lengthは入力のトークン数（左詰めのパディングを含む）、limitsは行ごとの上限
+    end_token_idsは終了・パディングのトークン（生成を終えた行の判定に使う）
+    """
+
+    def __init__(self, prompt_length, limits, end_token_ids, repetition=REPETITION_STOP):
+        self.prompt_length = prompt_length
+        self.limits = list(limits)
+        self.end_token_ids = {token_id for token_id in end_token_ids if token_id is not None}
+        self.repetition = repetition
+        self.loops = {}
+        self.finished = set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        generated = input_ids.shape[1] - self.prompt_length
+        done = [generated >= limit for limit in self.limits]
+        check = self.repetition and generated >= REPETITION_MIN_TOKENS and generated % REPETITION_CHECK_INTERVAL == 0
+        for row in range(input_ids.shape[0]):
+            if row in self.loops:
+                done[row] = True
+            elif check and not done[row] and row not in self.finished:
+                ids = input_ids[row, self.prompt_length:].tolist()
+                # 終了トークンを出力した行（以降はパディング）は最後まで生成したものとして扱う
+                if any(token_id in self.end_token_ids for token_id in ids):
+                    self.finished.add(row)
+                    continue
+                loop = find_loop(ids)
+                if loop is not None:
+                    self.loops[row] = loop
+                    done[row] = True
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    def finalize(self, row, ids):
+        """
+        生成部分のトークン列から (デコードするトークン列, 生成トークン数, 終了理由) を返す
+
+        繰り返しで打ち切った行のみ繰り返し部分を1回分だけ残す（最後まで生成した行は削らない）
+        """
+        loop = self.loops.get(row)
+        if loop is not None:
+            start, period = loop
+            ids = ids[:start + period]
+            return ids, len(ids), FINISH_REPETITION
+        # 上限に達した行は終了トークンを出力していない（以降はパディングで埋められる）
+        tokens = [token_id for token_id in ids.tolist() if token_id not in self.end_token_ids]
+        if len(tokens) >= self.limits[row]:
+            return ids, len(tokens), FINISH_LENGTH
+        return ids, len(tokens), FINISH_STOP
+
+
+class StopFlag(StoppingCriteria):
+    """外部から生成を打ち切る終了条件（クライアントの切断時などに別スレッドからset()する）"""
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self._event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+def stopping_criteria(monitor, existing=None):
+    """generateに渡すStoppingCriteriaListを作る（既存の条件があれば残す）"""
+    criteria = StoppingCriteriaList(existing or [])
+    criteria.append(monitor)
+    return criteria
+
+
+class GenerationLimit:
+    """limit_generation()の中で呼ばれたgenerateの結果（終了理由・生成トークン数）"""
+
+    def __init__(self, max_new_tokens):
+        self.max_new_tokens = max_new_tokens
+        self.generated_tokens = None
+        self.finish_reason = None
+
+    def summary(self):
+        return {
+            "max_new_tokens": self.max_new_tokens,
+            "generated_tokens": self.generated_tokens,
+            "finish_reason": self.finish_reason,
+        }
+
+
+_local = threading.local()
+
+
+@contextmanager
+def limit_generation(max_new_tokens):
+    """
+    現在のスレッドで呼ばれるgenerate（install_generate_limitで差し替えたもの）に上限と終了条件を適用する
+
+    model.inferのように内部でgenerateを呼び、引数を渡せない処理に使う
+    """
+    limit = GenerationLimit(max_new_tokens)
+    previous = getattr(_local, "limit", None)
+    _local.limit = limit
+    try:
+        yield limit
+    finally:
+        _local.limit = previous
+
+
+def install_generate_limit(model, end_token_ids):
+    """
+    model.generateを差し替え、limit_generation()の中では上限トークン数と繰り返しの検出を適用する
+
+    バッチサイズ1の呼び出しを前提とし、繰り返し部分を取り除いた出力を返す
+    """
+    original = model.generate
+
+    def generate(*args, **kwargs):
+        limit = getattr(_local, "limit", None)
+        if limit is None:
+            return original(*args, **kwargs)
+        input_ids = args[0] if args else kwargs["input_ids"]
+        prompt_length = input_ids.shape[-1]
+        max_new_tokens = min(kwargs.get("max_new_tokens") or limit.max_new_tokens, limit.max_new_tokens)
+        monitor = GenerationMonitor(prompt_length, [max_new_tokens], end_token_ids)
+        kwargs["max_new_tokens"] = max_new_tokens
+        kwargs["stopping_criteria"] = stopping_criteria(monitor, kwargs.get("stopping_criteria"))
+        output = original(*args, **kwargs)
+
+        ids, limit.generated_tokens, limit.finish_reason = monitor.finalize(0, output[0, prompt_length:])
+        return torch.cat([output[:1, :prompt_length], ids.unsqueeze(0)], dim=1)
+
+    model.generate = generate
+    return model
+
+
+def combine_generation(summaries):
+    """タイルごとの生成結果をまとめる（終了理由は打ち切りを優先して1つ選ぶ）"""
+    summaries = [summary for summary in summaries if summary]
+    reasons = {summary.get("finish_reason") for summary in summaries}
+    reason = next((r for r in (FINISH_LENGTH, FINISH_REPETITION, FINISH_STOP) if r in reasons), None)
+    return {
+        "max_new_tokens": sum(summary.get("max_new_tokens") or 0 for summary in summaries),
+        "generated_tokens": sum(summary.get("generated_tokens") or 0 for summary in summaries),
+        "finish_reason": reason,
+    }
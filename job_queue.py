@@ -0,0 +1,342 @@
+"""
+長時間のOCRを非同期に処理するジョブキュー
+
+    POST /api/jobs            画像を登録してすぐにジョブIDを返す（202）
+    GET  /api/jobs/{id}        状態・進捗・結果のメタデータ
+    GET  /api/jobs/{id}/events 状態の変化をServer-Sent Eventsで通知
+    GET  /api/jobs/{id}/result 結果テキスト（result.mmd）
+    GET  /api/jobs/{id}/image  検出結果画像（result_with_boxes.jpg、boxes=1で登録し参照領域がある場合のみ）
+
+- ジョブの状態はSQLite、入力画像と結果はジョブごとのディレクトリに保存する（OCR_JOB_DIR）
+- 処理中に再起動した場合、起動時に未完了のジョブを再投入する（最大OCR_JOB_MAX_ATTEMPTS回）
+- 期限切れのジョブは起動時と、ジョブの登録時（OCR_JOB_PURGE_INTERVAL秒に1回まで）に削除する
+- 入力画像は成功した時点で削除する（結果だけを保持期間まで残す）
+- 同じIdempotency-Key（未指定時は画像とパラメータのハッシュ）の再送信は既存のジョブを返す
+- admissionを渡した場合、登録したジョブは完了まで同期APIと同じ受付制御の処理中の件数に数える
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import RequestTrace
+
+# ジョブの保存先
+JOB_DIR = os.environ.get("OCR_JOB_DIR", "./output/jobs")
+# ジョブを同時に処理する数（同期APIと同じモデルを共有する）
+JOB_WORKERS = int(os.environ.get("OCR_JOB_WORKERS", "1"))
+# 待機中・処理中のジョブ数の上限（超えた分は503で拒否）
+JOB_MAX_PENDING = int(os.environ.get("OCR_JOB_MAX_PENDING", "100"))
+# 再起動などで中断されたジョブを再実行する回数の上限
+JOB_MAX_ATTEMPTS = int(os.environ.get("OCR_JOB_MAX_ATTEMPTS", "2"))
+# 完了したジョブを保持する時間（時間）
+JOB_RETENTION_HOURS = float(os.environ.get("OCR_JOB_RETENTION_HOURS", "24"))
+# 期限切れのジョブを削除する間隔（秒、ジョブの登録時に確認する）
+JOB_PURGE_INTERVAL = float(os.environ.get("OCR_JOB_PURGE_INTERVAL", "600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINAL_STATUSES = (SUCCEEDED, FAILED)
+
+RESULT_TEXT = "result.mmd"
+RESULT_IMAGE = "result_with_boxes.jpg"
+INPUT_FILE = "input"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    idempotency_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT,
+    params TEXT NOT NULL,
+    client TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    result TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_idempotency_key ON jobs (idempotency_key);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+"""
+
+
+class JobQueueFull(Exception):
+    """待機中のジョブが上限に達している"""
+
+
+_local = threading.local()
+
+
+def report_progress(fraction, message=None):
+    """処理中のジョブの進捗を記録する（ジョブの外から呼ばれた場合は何もしない）"""
+    reporter = getattr(_local, "reporter", None)
+    if reporter is not None:
+        reporter(fraction, message)
+
+
+class JobStore:
+    """ジョブの状態（SQLite）と入力・結果のファイル"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, "jobs.sqlite3"), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+
+    def job_dir(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            cursor = self._db.execute(sql, args)
+            self._db.commit()
+            return cursor
+
+    def _query(self, sql, args=()):
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, args).fetchall()]
+
+    def create(self, data, params, client, idempotency_key):
+        job_id = uuid.uuid4().hex
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        with open(os.path.join(self.job_dir(job_id), INPUT_FILE), "wb") as f:
+            f.write(data)
+        self._execute(
+            "INSERT INTO jobs (id, idempotency_key, status, params, client, created) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, idempotency_key, QUEUED, json.dumps(params, ensure_ascii=False), client, time.time()),
+        )
+        return self.get(job_id)
+
+    def get(self, job_id):
+        rows = self._query("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def find_reusable(self, idempotency_key):
+        """同じキーで失敗していないジョブ（再送信にはこれを返す）"""
+        rows = self._query(
+            "SELECT * FROM jobs WHERE idempotency_key = ? AND status != ? ORDER BY created DESC LIMIT 1",
+            (idempotency_key, FAILED),
+        )
+        return rows[0] if rows else None
+
+    def unfinished(self):
+        return self._query("SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created", (QUEUED, RUNNING))
+
+    def count_pending(self):
+        return self._query("SELECT COUNT(*) AS n FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING))[0]["n"]
+
+    def counts(self):
+        return {row["status"]: row["n"] for row in self._query("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")}
+
+    def update(self, job_id, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        self._execute(f"UPDATE jobs SET {assignments} WHERE id = ?", tuple(fields.values()) + (job_id,))
+
+    def read_input(self, job_id):
+        with open(os.path.join(self.job_dir(job_id), INPUT_FILE), "rb") as f:
+            return f.read()
+
+    def remove_input(self, job_id):
+        try:
+            os.remove(os.path.join(self.job_dir(job_id), INPUT_FILE))
+        except OSError:
+            pass
+
+    def file_path(self, job_id, name):
+        path = os.path.join(self.job_dir(job_id), name)
+        return path if os.path.exists(path) else None
+
+    def purge(self, older_than):
+        """完了から一定時間が経ったジョブを削除する"""
+        rows = self._query(
+            "SELECT id FROM jobs WHERE status IN (?, ?) AND finished < ?", (SUCCEEDED, FAILED, older_than)
+        )
+        for row in rows:
+            shutil.rmtree(self.job_dir(row["id"]), ignore_errors=True)
+            self._execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+        return len(rows)
+
+
+class JobQueue:
+    """
+    ジョブをバックグラウンドのスレッドで処理する
+
+    job_fn(image, params, trace) -> (JSON化可能な結果のdict（"text"を含む）, 検出結果画像またはNone)
+    decode_fn(data) -> PIL Image
+    admission: 同期APIと共有するAdmissionController（ジョブは急がないため縮退モードは適用しない）
+    """
+
+    def __init__(self, app_name, job_fn, decode_fn, directory=JOB_DIR, workers=JOB_WORKERS,
+                 max_pending=JOB_MAX_PENDING, admission=None):
+        self.app_name = app_name
+        self.job_fn = job_fn
+        self.decode_fn = decode_fn
+        self.store = JobStore(directory)
+        self.max_pending = max_pending
+        self.admission = admission
+        # 登録したジョブの受付（ジョブIDごと、完了時に解放する）
+        self._tickets = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=f"{app_name}-job")
+        self._submit_lock = threading.Lock()
+        self._purge_lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def purge_expired(self):
+        """保持期間を過ぎたジョブを削除する"""
+        self._last_purge = time.time()
+        return self.store.purge(self._last_purge - JOB_RETENTION_HOURS * 3600)
+
+    def _maybe_purge(self):
+        """前回の削除からOCR_JOB_PURGE_INTERVAL秒経っていれば期限切れのジョブを削除する（実行中なら待たない）"""
+        if time.time() - self._last_purge < JOB_PURGE_INTERVAL or not self._purge_lock.acquire(blocking=False):
+            return
+        try:
+            if time.time() - self._last_purge >= JOB_PURGE_INTERVAL:
+                purged = self.purge_expired()
+                if purged:
+                    print(f"[{self.app_name}] ジョブキュー: 期限切れ{purged}件を削除")
+        finally:
+            self._purge_lock.release()
+
+    def start(self):
+        """古いジョブを削除し、前回の起動で完了しなかったジョブを再投入する"""
+        purged = self.purge_expired()
+        resumed = 0
+        for job in self.store.unfinished():
+            if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                self.store.update(job["id"], status=FAILED, finished=time.time(),
+                                  error="処理中に中断されたため再試行の上限に達しました")
+                continue
+            self.store.update(job["id"], status=QUEUED, progress=0.0, message="再起動後に再投入しました")
+            self._executor.submit(self._run, job["id"])
+            resumed += 1
+        if purged or resumed:
+            print(f"[{self.app_name}] ジョブキュー: 期限切れ{purged}件を削除、未完了{resumed}件を再投入")
+        return self
+
+    @staticmethod
+    def idempotency_key(data, params, header=None):
+        if header:
+            return f"key:{header}"
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        return f"sha256:{digest.hexdigest()}"
+
+    def submit(self, data, params, client=None, idempotency_key=None):
+        """
+        ジョブを登録して (ジョブ, 新規に登録したか) を返す
+
+        同じキーで失敗していないジョブがあればそれを返し、待機中のジョブが上限ならJobQueueFullを送出する
+        受付制御で拒否された場合はAdmissionRejectedを送出する
+        """
+        self._maybe_purge()
+        key = self.idempotency_key(data, params, idempotency_key)
+        with self._submit_lock:
+            existing = self.store.find_reusable(key)
+            if existing is not None:
+                return existing, False
+            if self.max_pending and self.store.count_pending() >= self.max_pending:
+                raise JobQueueFull(f"処理待ちのジョブが上限（{self.max_pending}件）に達しています")
+            ticket = self.admission.acquire(client) if self.admission is not None else None
+            try:
+                job = self.store.create(data, params, client, key)
+            except BaseException:
+                if ticket is not None:
+                    ticket.measured = False
+                    self.admission.release(ticket)
+                raise
+            if ticket is not None:
+                self._tickets[job["id"]] = ticket
+        self._executor.submit(self._run, job["id"])
+        return job, True
+
+    def _run(self, job_id):
+        ticket = self._tickets.pop(job_id, None)
+        status = None
+        try:
+            status = self._process(job_id)
+        finally:
+            if ticket is not None:
+                ticket.measured = status == "ok"
+                self.admission.release(ticket)
+
+    def _process(self, job_id):
+        """ジョブを1件処理して状態（RequestTrace.finishに渡したもの）を返す"""
+        job = self.store.get(job_id)
+        if job is None or job["status"] in FINAL_STATUSES:
+            return None
+        self.store.update(job_id, status=RUNNING, started=time.time(), attempts=job["attempts"] + 1,
+                          progress=0.0, message="処理中")
+
+        def reporter(fraction, message=None):
+            self.store.update(job_id, progress=round(min(max(fraction, 0.0), 1.0), 4), message=message or "処理中")
+
+        trace = RequestTrace(self.app_name)
+        status = "error"
+        _local.reporter = reporter
+        try:
+            image = self.decode_fn(self.store.read_input(job_id))
+            result, result_image = self.job_fn(image, json.loads(job["params"]), trace)
+
+            directory = self.store.job_dir(job_id)
+            with open(os.path.join(directory, RESULT_TEXT), "w", encoding="utf-8") as f:
+                f.write(result.get("text") or "")
+            if result_image is not None:
+                result_image.convert("RGB").save(os.path.join(directory, RESULT_IMAGE), quality=90)
+            result = dict(result, stages_ms=trace.summary())
+            self.store.update(job_id, status=SUCCEEDED, progress=1.0, message="完了", finished=time.time(),
+                              result=json.dumps(result, ensure_ascii=False, default=str))
+            # 成功したジョブは再実行しないため入力画像は不要
+            self.store.remove_input(job_id)
+            status = "cached" if result.get("cached") else "ok"
+        except Exception as e:
+            print(f"[{self.app_name}] ジョブ{job_id}でエラーが発生しました: {e}")
+            self.store.update(job_id, status=FAILED, message="失敗", finished=time.time(),
+                              error=f"{type(e).__name__}: {e}")
+        finally:
+            _local.reporter = None
+            trace.finish(status)
+        return status
+
+    def describe(self, job, base_url=""):
+        """APIで返すジョブの状態"""
+        info = {
+            "job_id": job["id"],
+            "status": job["status"],
+            "progress": job["progress"],
+            "message": job["message"],
+            "attempts": job["attempts"],
+            "created": job["created"],
+            "started": job["started"],
+            "finished": job["finished"],
+            "error": job["error"],
+            "status_url": f"{base_url}/api/jobs/{job['id']}",
+            "events_url": f"{base_url}/api/jobs/{job['id']}/events",
+        }
+        if job["status"] == SUCCEEDED:
+            result = json.loads(job["result"] or "{}")
+            # 本文は/resultから取得する（状態の問い合わせを軽く保つ）
+            result.pop("text", None)
+            info["result"] = result
+            info["result_url"] = f"{base_url}/api/jobs/{job['id']}/result"
+            if self.store.file_path(job["id"], RESULT_IMAGE):
+                info["image_url"] = f"{base_url}/api/jobs/{job['id']}/image"
+        return info
+
+    def stats(self):
+        return self.store.counts()
@@ -0,0 +1,400 @@
+"""
+リクエストごとの処理段階別の計測と、Prometheus形式のメトリクス出力
+
+    trace = RequestTrace("qwen3-vl")
+    with track(trace):
+        with stage("preprocess"):
+            ...
+    trace.finish()
+
+stage()は現在のスレッドで有効なすべてのトレースに記録するため、
+バッチ推論では同じバッチに含まれる全リクエストに同じ段階時間が記録される
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# リクエストごとの計測結果をJSON Lines形式で追記するファイル（未指定時は出力しない）
+JSONL_PATH = os.environ.get("OCR_METRICS_JSONL", "")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+RATE_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0)
+TOKEN_BUCKETS = (8, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+BYTES_BUCKETS = tuple(gib * 1024 ** 3 for gib in (0.5, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    inner = ",".join(f'{key}="{str(value)}"' for key, value in labels)
+    return "{" + inner + "}"
+
+
+class Histogram:
+    """ラベル付きのヒストグラム（Prometheusのhistogram型）"""
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, dict(series, counts=list(series["counts"]))) for key, series in self._series.items()]
+        for key, series in sorted(items):
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', f'{bound:g}'),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class Counter:
+    """ラベル付きのカウンター（Prometheusのcounter型）"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    """ヒストグラムと、値を都度取得するカウンター/ゲージをまとめて出力する"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(name, help_text, buckets)
+            return self.histograms[name]
+
+    def counter(self, name, help_text):
+        with self._lock:
+            if name not in self.counters:
+                self.counters[name] = Counter(name, help_text)
+            return self.counters[name]
+
+    def register_collector(self, name, help_text, metric_type, fn):
+        """
+        fn() -> {ラベルのdict（tupleで表現）: 値} を出力時に呼び出す
+
+        同じ名前で複数回登録した場合（アプリごとのラベル違い）は1つのメトリクスにまとめて出力する
+        """
+        with self._lock:
+            self._collectors.append((name, help_text, metric_type, fn))
+
+    def render(self):
+        lines = []
+        for histogram in list(self.histograms.values()):
+            lines.extend(histogram.render())
+        for counter in list(self.counters.values()):
+            lines.extend(counter.render())
+        # HELP/TYPEはメトリクス名ごとに1回だけ出力する（重複するとPrometheusが取り込みを拒否する）
+        families = {}
+        for name, help_text, metric_type, fn in list(self._collectors):
+            families.setdefault(name, (help_text, metric_type, []))[2].append(fn)
+        for name, (help_text, metric_type, fns) in families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for fn in fns:
+                try:
+                    values = fn()
+                except Exception as e:
+                    print(f"メトリクスの取得に失敗しました ({name}): {e}")
+                    continue
+                for labels, value in values.items():
+                    lines.append(f"{name}{_format_labels(tuple(sorted(labels)))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram("ocr_stage_seconds", "処理段階ごとの所要時間（秒）")
+REQUEST_SECONDS = REGISTRY.histogram("ocr_request_seconds", "リクエスト全体の所要時間（秒）")
+TOKENS_PER_SECOND = REGISTRY.histogram("ocr_decode_tokens_per_second", "デコード速度（トークン/秒）", RATE_BUCKETS)
+GENERATED_TOKENS = REGISTRY.histogram("ocr_generated_tokens", "生成トークン数", TOKEN_BUCKETS)
+FINISH_REASONS = REGISTRY.counter("ocr_generation_finish_total", "生成の終了理由（stop/length/repetition）ごとの件数")
+PEAK_RSS_BYTES = REGISTRY.histogram("ocr_peak_rss_bytes", "リクエスト処理中のピークRSS（バイト）", BYTES_BUCKETS)
+
+
+def register_cache(app, cache):
+    """結果キャッシュのヒット・ミス・追い出し件数をメトリクスとして公開"""
+
+    def collect():
+        stats = cache.stats()
+        return {
+            (("app", app), ("event", event)): stats[event]
+            for event in ("hits", "disk_hits", "misses", "evictions", "disk_evictions")
+        }
+
+    def collect_bytes():
+        return {(("app", app),): cache.stats()["bytes"]}
+
+    REGISTRY.register_collector("ocr_cache_events_total", "結果キャッシュのイベント数", "counter", collect)
+    REGISTRY.register_collector("ocr_cache_memory_bytes", "メモリ上の結果キャッシュのサイズ（pickle換算）", "gauge", collect_bytes)
+
+
+def register_near_duplicates(app, index):
+    """ほぼ同一画像の索引のヒット・誤一致の防止・ミスの件数と登録件数をメトリクスとして公開"""
+
+    def collect_events():
+        stats = index.stats()
+        return {
+            (("app", app), ("event", event)): stats[event]
+            for event in ("hits", "rejected", "misses", "skipped", "evictions")
+        }
+
+    def collect_entries():
+        return {(("app", app),): index.stats()["entries"]}
+
+    REGISTRY.register_collector(
+        "ocr_near_duplicate_events_total", "ほぼ同一画像の索引のイベント数", "counter", collect_events
+    )
+    REGISTRY.register_collector("ocr_near_duplicate_entries", "ほぼ同一画像の索引の登録件数", "gauge", collect_entries)
+
+
+def register_admission(app, admission):
+    """受付制御の受付・縮退・拒否の件数と、処理中の件数・推定待ち時間をメトリクスとして公開"""
+
+    def collect_events():
+        stats = admission.stats()
+        return {
+            (("app", app), ("result", result)): stats[result]
+            for result in ("accepted", "degraded", "queue_full", "client_limit", "slo")
+        }
+
+    def collect_in_flight():
+        return {(("app", app),): admission.stats()["in_flight"]}
+
+    def collect_estimate():
+        return {(("app", app),): admission.stats()["estimated_seconds"]}
+
+    REGISTRY.register_collector("ocr_admission_total", "受付制御の判定結果の件数", "counter", collect_events)
+    REGISTRY.register_collector("ocr_admission_in_flight", "処理中・待機中のリクエスト数", "gauge", collect_in_flight)
+    REGISTRY.register_collector(
+        "ocr_admission_estimated_seconds", "新しいリクエストの完了までの推定時間（秒）", "gauge", collect_estimate
+    )
+
+
+def register_jobs(app, jobs):
+    """非同期ジョブの状態ごとの件数をメトリクスとして公開"""
+
+    def collect():
+        counts = jobs.stats()
+        return {
+            (("app", app), ("status", status)): counts.get(status, 0)
+            for status in ("queued", "running", "succeeded", "failed")
+        }
+
+    REGISTRY.register_collector("ocr_jobs", "非同期ジョブの状態ごとの件数", "gauge", collect)
+
+
+class _RSSTracker:
+    """/proc/self/statusからRSSを読み、処理中のリクエストがなければピーク値をリセットする"""
+
+    lock = threading.Lock()
+    in_flight = 0
+
+    @staticmethod
+    def _read_status(field):
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    @classmethod
+    def begin(cls):
+        with cls.lock:
+            cls.in_flight += 1
+            if cls.in_flight == 1:
+                # clear_refsに5を書き込むとピークRSS（VmHWM）が現在値にリセットされる（Linux 4.0以降）
+                try:
+                    with open("/proc/self/clear_refs", "w") as f:
+                        f.write("5")
+                except OSError:
+                    pass
+
+    @classmethod
+    def end(cls):
+        with cls.lock:
+            cls.in_flight -= 1
+        peak = cls._read_status("VmHWM:")
+        if peak is None:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return peak, cls._read_status("VmRSS:")
+
+
+class RequestTrace:
+    """1リクエスト分の段階別の所要時間と付随情報"""
+
+    _jsonl_lock = threading.Lock()
+
+    def __init__(self, app):
+        self.app = app
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.values = {}
+        self.finished = False
+        _RSSTracker.begin()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def summary(self):
+        """段階ごとの所要時間（ミリ秒）"""
+        return {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()}
+
+    def finish(self, status="ok"):
+        if self.finished:
+            return
+        self.finished = True
+        total = time.perf_counter() - self.started
+        peak_rss, rss = _RSSTracker.end()
+        self.values.update(peak_rss_bytes=peak_rss, rss_bytes=rss)
+
+        for name, seconds in self.stages.items():
+            STAGE_SECONDS.observe(seconds, app=self.app, stage=name)
+        REQUEST_SECONDS.observe(total, app=self.app, status=status)
+        if peak_rss is not None:
+            PEAK_RSS_BYTES.observe(peak_rss, app=self.app)
+
+        reason = self.values.get("finish_reason")
+        if reason:
+            FINISH_REASONS.inc(app=self.app, reason=reason)
+
+        tokens = self.values.get("generated_tokens")
+        # prefillとdecodeを分けて計測できない場合はgenerate全体の時間で近似する
+        decode = self.stages.get("decode") or self.stages.get("generate")
+        if tokens:
+            GENERATED_TOKENS.observe(tokens, app=self.app)
+            if decode:
+                rate = tokens / decode
+                self.values["tokens_per_second"] = round(rate, 2)
+                TOKENS_PER_SECOND.observe(rate, app=self.app)
+
+        if JSONL_PATH:
+            record = {
+                "time": time.time(),
+                "app": self.app,
+                "status": status,
+                "total_ms": round(total * 1000, 2),
+                "stages_ms": self.summary(),
+            }
+            record.update(self.values)
+            with self._jsonl_lock:
+                with open(JSONL_PATH, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+_local = threading.local()
+
+
+def active_traces():
+    return getattr(_local, "traces", ())
+
+
+@contextmanager
+def track(*traces):
+    """
+    現在のスレッドで記録先とするトレースを設定（バッチ推論では複数）
+
+    バッチの各行と対応付けられるよう、Noneも位置を保ったまま保持する
+    """
+    previous = active_traces()
+    _local.traces = traces
+    try:
+        yield
+    finally:
+        _local.traces = previous
+
+
+@contextmanager
+def stage(name):
+    """有効なすべてのトレースに段階の所要時間を記録（トレースがなければ何もしない）"""
+    traces = [trace for trace in active_traces() if trace is not None]
+    if not traces:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        for trace in traces:
+            trace.add(name, elapsed)
+
+
+class PrefillTimer:
+    """
+    generateに渡すストリーマー（最初の生成トークンまでをprefill、以降をdecodeとして記録）
+
+    innerに別のストリーマーを渡すとput/endをそのまま転送する
+    """
+
+    def __init__(self, traces, inner=None):
+        self.traces = [trace for trace in traces if trace is not None]
+        self.inner = inner
+        self.started = time.perf_counter()
+        self.first_token = None
+        self._calls = 0
+
+    def put(self, value):
+        # 最初の呼び出しはプロンプト、2回目が最初の生成トークン
+        self._calls += 1
+        if self._calls == 2:
+            self.first_token = time.perf_counter()
+        if self.inner is not None:
+            self.inner.put(value)
+
+    def end(self):
+        finished = time.perf_counter()
+        first = self.first_token or finished
+        for trace in self.traces:
+            trace.add("prefill", first - self.started)
+            trace.add("decode", finished - first)
+        if self.inner is not None:
+            self.inner.end()
@@ -0,0 +1,212 @@
+"""
+モデルの遅延読み込み・バックグラウンド読み込みと準備状態の管理
+
+モジュールの読み込み（import）ではモデルを読み込まず、サーバーの起動と同時にバックグラウンドで読み込む。
+読み込み中もUI・ヘルスチェックは応答し、/healthzは準備が整うまで503を返す（/livezは常に200）。
+読み込み中に届いた推論リクエストは読み込みの完了を待つ（OCR_MODEL_WAIT_SECONDSを超えたら503）
+
+    OCR_MODEL_LOADING=background python app.py   # 既定: 起動直後から応答し、裏でモデルを読み込む
+    OCR_MODEL_LOADING=lazy python app.py         # 最初の推論リクエストで読み込む
+    OCR_MODEL_LOADING=eager python app.py        # 従来どおりモデルを読み込み終えてから起動する
+    OCR_WARMUP=1 python app.py                   # 読み込み後に合成画像で1回推論しておく
+
+ベンチマークなどモジュールをimportして使うツールは、最初の推論で読み込まれる（load_all()で明示的にも読み込める）
+"""
+import ctypes
+import gc
+import os
+import threading
+import time
+
+from PIL import Image, ImageDraw
+
+# background: 起動時に裏で読み込む / lazy: 最初の推論で読み込む / eager: 読み込み終えてから起動する
+MODEL_LOADING = os.environ.get("OCR_MODEL_LOADING", "background")
+# 1の場合は読み込み後に合成画像で推論し、初回リクエストの遅さ（カーネルの初期化など）を解消する
+WARMUP = os.environ.get("OCR_WARMUP", "0") == "1"
+# 読み込み中に届いた推論リクエストが待つ最長時間（秒）
+MODEL_WAIT_SECONDS = float(os.environ.get("OCR_MODEL_WAIT_SECONDS", "300"))
+# 準備中の503に付けるRetry-After（秒）
+RETRY_AFTER_SECONDS = 10
+
+IDLE = "idle"
+LOADING = "loading"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+WARMUP_LINES = ("Warmup 2024-01-01", "Invoice No. 12345", "合計 ¥1,000")
+
+
+class ModelNotReady(Exception):
+    """モデルの読み込みが終わっていない（または失敗した）"""
+
+    status = 503
+
+    def __init__(self, message, retry_after=RETRY_AFTER_SECONDS):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def warmup_image(size=(640, 320)):
+    """ウォームアップ用の合成画像（白地に数行の文字）"""
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    for index, line in enumerate(WARMUP_LINES):
+        draw.text((32, 32 + index * 48), line, fill="black")
+    return image
+
+
+def release_memory():
+    """解放したモデルのメモリをOSに返す（glibcのmalloc_trimが使える場合のみ）"""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class _Entry:
+    def __init__(self, name, load_fn, warmup_fn, unload_fn):
+        self.name = name
+        self.load_fn = load_fn
+        self.warmup_fn = warmup_fn
+        self.unload_fn = unload_fn
+        self.state = IDLE
+        self.error = None
+        self.done = threading.Event()
+        self.load_seconds = None
+        self.warmup_seconds = None
+
+
+class ModelRegistry:
+    """
+    名前ごとのモデルの読み込み関数と準備状態
+
+    load_fn()はモデルを読み込んでモジュールの変数などに設定する（1回だけ呼ばれる、失敗時は次の要求で再試行）
+    warmup_fn()は読み込み後に1回だけ呼ばれる（OCR_WARMUP=1の場合のみ）
+    unload_fn()はモデルへの参照を手放す（unload()で呼ばれ、次の要求で再び読み込まれる）
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, load_fn, warmup_fn=None, unload_fn=None):
+        self._entries[name] = _Entry(name, load_fn, warmup_fn, unload_fn)
+        return self
+
+    def _begin(self, entry):
+        """読み込みを始める場合はTrue（読み込み中・完了済みの場合はFalse）"""
+        with self._lock:
+            if entry.state not in (IDLE, FAILED):
+                return False
+            entry.state = LOADING
+            entry.error = None
+            entry.done = threading.Event()
+            return True
+
+    def _load(self, entry):
+        started = time.perf_counter()
+        print(f"[{entry.name}] モデルを読み込んでいます...")
+        try:
+            entry.load_fn()
+            entry.load_seconds = round(time.perf_counter() - started, 3)
+            if WARMUP and entry.warmup_fn is not None:
+                entry.state = WARMING
+                started = time.perf_counter()
+                entry.warmup_fn()
+                entry.warmup_seconds = round(time.perf_counter() - started, 3)
+            entry.state = READY
+            warmup = f", ウォームアップ {entry.warmup_seconds}秒" if entry.warmup_seconds is not None else ""
+            print(f"[{entry.name}] モデルの準備ができました (読み込み {entry.load_seconds}秒{warmup})")
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            entry.error = f"{type(e).__name__}: {e}"
+            entry.state = FAILED
+            print(f"[{entry.name}] モデルの読み込みに失敗しました: {entry.error}")
+        finally:
+            entry.done.set()
+
+    def start(self, name=None):
+        """バックグラウンドのスレッドで読み込みを始める（nameを省略した場合はすべて）"""
+        for entry in self._select(name):
+            if self._begin(entry):
+                threading.Thread(target=self._load, args=(entry,), name=f"{entry.name}-load", daemon=True).start()
+        return self
+
+    def load_all(self):
+        """すべてのモデルを現在のスレッドで読み込む（読み込み中のものは完了を待つ）"""
+        for entry in self._entries.values():
+            if self._begin(entry):
+                self._load(entry)
+            else:
+                entry.done.wait()
+            if entry.state == FAILED:
+                raise RuntimeError(f"[{entry.name}] モデルの読み込みに失敗しました: {entry.error}")
+        return self
+
+    def start_from_env(self):
+        """OCR_MODEL_LOADINGに従ってサーバー起動時の読み込みを行う"""
+        if MODEL_LOADING == "eager":
+            return self.load_all()
+        if MODEL_LOADING == "background":
+            return self.start()
+        if MODEL_LOADING != "lazy":
+            raise ValueError(f"OCR_MODEL_LOADINGにはbackground、lazyまたはeagerを指定してください: {MODEL_LOADING}")
+        return self
+
+    def require(self, name, timeout=MODEL_WAIT_SECONDS):
+        """
+        モデルの準備ができるまで待つ（未読み込みなら読み込みを始める）
+
+        timeout秒以内に準備ができない場合、または読み込みに失敗した場合はModelNotReadyを送出する
+        （Noneの場合は完了まで待つ）
+        """
+        entry = self._entries[name]
+        # ウォームアップ中は読み込みが済んでいる（ウォームアップの推論自体もここを通る）
+        if entry.state in (READY, WARMING):
+            return
+        self.start(name)
+        if not entry.done.wait(timeout):
+            raise ModelNotReady(f"モデルを読み込んでいます（{entry.state}）。しばらくしてから再試行してください")
+        if entry.state != READY:
+            raise ModelNotReady(f"モデルの読み込みに失敗しました: {entry.error}")
+
+    def unload(self, name):
+        """
+        読み込み済みのモデルを解放する（解放した場合はTrue）
+
+        推論中のリクエストがないことは呼び出し側で保証する
+        """
+        entry = self._entries[name]
+        with self._lock:
+            if entry.state != READY or entry.unload_fn is None:
+                return False
+            entry.state = IDLE
+        entry.unload_fn()
+        release_memory()
+        print(f"[{entry.name}] モデルを解放しました")
+        return True
+
+    def loaded(self, name):
+        """読み込み済み・読み込み中（メモリを使っている）か"""
+        return self._entries[name].state in (LOADING, WARMING, READY)
+
+    def ready(self, name=None):
+        return all(entry.state == READY for entry in self._select(name))
+
+    def status(self):
+        return {
+            entry.name: {
+                "state": entry.state,
+                "error": entry.error,
+                "load_seconds": entry.load_seconds,
+                "warmup_seconds": entry.warmup_seconds,
+            }
+            for entry in self._entries.values()
+        }
+
+    def _select(self, name):
+        return list(self._entries.values()) if name is None else [self._entries[name]]
@@ -0,0 +1,213 @@
+"""
+DeepSeek-OCRの出力（検出結果画像・Markdown）をファイルを介さずにメモリ上で作る
+
+model.infer(eval_mode=True)が返す生の出力から、save_results=Trueで書き出されるresult.mmdと同じテキストと、
+参照領域（ラベルと座標、続くテキスト）を取り出す。APIには画像の代わりに、参照領域を読み順に並べたブロック
+（種類・元の画像上の座標・テキスト）を返す（layout_blocks）。バウンディングボックス付きの画像は、
+表示・保存が必要になった時点でリクエストの画像にブロックを描画する（結果・キャッシュには画像を持たない）
+
+    OCR_ARCHIVE_DIR=./output/archive python deepseekuse_gradio.py   # 結果を従来の形式でディスクにも保存する
+"""
+import ast
+import os
+import re
+import time
+import uuid
+import zlib
+
+from PIL import Image, ImageDraw
+
+# 結果（result.mmd・result_with_boxes.jpg）を保存するディレクトリ（未指定時は保存しない）
+ARCHIVE_DIR = os.environ.get("OCR_ARCHIVE_DIR", "")
+
+RESULT_TEXT = "result.mmd"
+RESULT_IMAGE = "result_with_boxes.jpg"
+
+# <|ref|>ラベル<|/ref|><|det|>[[x1, y1, x2, y2], ...]<|/det|> （座標は画像の幅・高さを999とした値）
+REF_PATTERN = re.compile(r"(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)", re.DOTALL)
+COORDINATE_SCALE = 999
+# 生の出力の末尾に残る終了トークン
+STOP_STRING = "<｜end▁of▁sentence｜>"
+# 参照領域の塗りつぶしの不透明度
+FILL_ALPHA = 40
+# ブロックの形式（変更した場合はキャッシュキーを変えて古い結果を使わないようにする）
+LAYOUT_VERSION = 2
+# タイルの重なり部分で同じ領域が重複したとみなすIoU
+DUPLICATE_IOU = 0.7
+
+
+def _parse_boxes(det):
+    try:
+        boxes = ast.literal_eval(det.strip())
+    except (ValueError, SyntaxError):
+        return []
+    if boxes and not isinstance(boxes[0], (list, tuple)):
+        boxes = [boxes]
+    return [[float(value) for value in box] for box in boxes if len(box) == 4]
+
+
+def _clean_text(text):
+    return text.replace("\\coloneqq", ":=").replace("\\eqqcolon", "=:")
+
+
+def parse_output(raw):
+    """
+    生の出力から (result.mmdと同じテキスト, 参照領域のリスト) を返す
+
+    参照領域は {"label": ラベル, "boxes": [[x1, y1, x2, y2], ...], "text": テキスト} （座標は0〜999の相対値）
+    テキストは参照の直後から次の参照までの出力（その領域の内容）
+    画像の参照は![](images/N.jpg)に、それ以外の参照は取り除く（model.inferの保存処理と同じ）
+    """
+    text = raw[:-len(STOP_STRING)] if raw.endswith(STOP_STRING) else raw
+    text = text.strip()
+    matches = list(REF_PATTERN.finditer(text))
+    regions = []
+    for index, found in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        regions.append({
+            "label": found.group(2),
+            "boxes": _parse_boxes(found.group(3)),
+            "text": _clean_text(text[found.end():end]).strip(),
+        })
+
+    image_index = 0
+    for match, label, _det in REF_PATTERN.findall(text):
+        if label == "image":
+            text = text.replace(match, f"![](images/{image_index}.jpg)\n")
+            image_index += 1
+        else:
+            text = _clean_text(text.replace(match, ""))
+    return text, regions
+
+
+def place_regions(regions, box):
+    """相対座標の参照領域を、画像上の範囲box（left, top, right, bottom）の画素座標に変換する"""
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+    return [
+        dict(region, boxes=[
+            [
+                int(left + x1 / COORDINATE_SCALE * width), int(top + y1 / COORDINATE_SCALE * height),
+                int(left + x2 / COORDINATE_SCALE * width), int(top + y2 / COORDINATE_SCALE * height),
+            ]
+            for x1, y1, x2, y2 in region["boxes"]
+        ])
+        for region in regions
+    ]
+
+
+def _iou(a, b):
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    overlap = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - overlap
+    return overlap / union if union > 0 else 0.0
+
+
+def layout_blocks(regions, info):
+    """
+    画素座標の参照領域を、読み順に並べたブロック {"type", "bbox", "text"} のリストにする
+
+    座標は前処理（余白除去・縮小）前の、アップロードされた画像上の画素座標に戻す（infoは前処理の情報）。
+    参照領域の順序はモデルの出力順（読み順）のまま。座標が複数ある参照は1つのブロックにまとめ、
+    bboxには全体を囲む範囲、boxesに個々の範囲を入れる。タイルの重なり部分で重複したブロックは取り除く
+    """
+    if not regions:
+        return []
+    trimmed = info.get("trimmed_box")
+    left, top = trimmed[:2] if trimmed else (0, 0)
+    source_width = (trimmed[2] - trimmed[0]) if trimmed else info["original_size"][0]
+    source_height = (trimmed[3] - trimmed[1]) if trimmed else info["original_size"][1]
+    scale_x = source_width / max(1, info["size"][0])
+    scale_y = source_height / max(1, info["size"][1])
+
+    blocks = []
+    for region in regions:
+        boxes = [
+            [
+                int(round(left + x1 * scale_x)), int(round(top + y1 * scale_y)),
+                int(round(left + x2 * scale_x)), int(round(top + y2 * scale_y)),
+            ]
+            for x1, y1, x2, y2 in region["boxes"]
+        ]
+        if not boxes:
+            continue
+        bbox = [min(box[0] for box in boxes), min(box[1] for box in boxes),
+                max(box[2] for box in boxes), max(box[3] for box in boxes)]
+        if any(
+            block["type"] == region["label"] and _iou(block["bbox"], bbox) >= DUPLICATE_IOU for block in blocks
+        ):
+            continue
+        block = {"type": region["label"], "bbox": bbox, "text": region.get("text", "")}
+        if len(boxes) > 1:
+            block["boxes"] = boxes
+        blocks.append(block)
+    return blocks
+
+
+def rescale_blocks(blocks, from_size, to_size):
+    """別の大きさの画像のブロックの座標を、to_size（幅, 高さ）の画像の座標に合わせる（ほぼ同一画像の結果の流用時）"""
+    scale_x = to_size[0] / max(1, from_size[0])
+    scale_y = to_size[1] / max(1, from_size[1])
+
+    def scale(box):
+        return [int(round(box[0] * scale_x)), int(round(box[1] * scale_y)),
+                int(round(box[2] * scale_x)), int(round(box[3] * scale_y))]
+
+    rescaled = []
+    for block in blocks:
+        block = dict(block, bbox=scale(block["bbox"]))
+        if "boxes" in block:
+            block["boxes"] = [scale(box) for box in block["boxes"]]
+        rescaled.append(block)
+    return rescaled
+
+
+def _label_color(label):
+    seed = zlib.crc32(label.encode("utf-8"))
+    return (seed & 0xFF, (seed >> 8) & 0xFF, (seed >> 16) & 0xFF)
+
+
+def render_boxes(image, regions):
+    """画素座標の参照領域を画像に描画する（ラベルごとに同じ色を使う）"""
+    image = image.convert("RGB")
+    overlay = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    overlay_draw = ImageDraw.Draw(overlay)
+    for region in regions:
+        color = _label_color(region["label"])
+        for x1, y1, x2, y2 in region["boxes"]:
+            width = 4 if region["label"] == "title" else 2
+            draw.rectangle([x1, y1, x2, y2], outline=color, width=width)
+            overlay_draw.rectangle([x1, y1, x2, y2], fill=color + (FILL_ALPHA,))
+            draw.text((x1, max(0, y1 - 12)), region["label"], fill=color)
+    image.paste(overlay, (0, 0), overlay)
+    return image
+
+
+def annotated_image(image, blocks):
+    """アップロードされた画像にブロックを描画した検出結果画像（ブロックがない場合はNone）"""
+    if image is None or not blocks:
+        return None
+    return render_boxes(image, [{"label": block["type"], "boxes": block.get("boxes") or [block["bbox"]]}
+                                for block in blocks])
+
+
+def boxes_requested(params):
+    """APIのパラメータで検出結果画像が要求されているか（boxes=1）"""
+    return str(params.get("boxes", "")).lower() in ("1", "true")
+
+
+def archive_artifacts(text, image, directory=ARCHIVE_DIR):
+    """結果を従来のファイル形式で保存し、保存先のディレクトリを返す（保存しない設定ではNone）"""
+    if not directory:
+        return None
+    path = os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}")
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, RESULT_TEXT), "w", encoding="utf-8") as f:
+        f.write(text)
+    if image is not None:
+        image.save(os.path.join(path, RESULT_IMAGE), quality=90)
+    return path
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class OCRResultCache:
+    """
+    画像内容とOCR設定をキーにした結果キャッシュ
+
+    - メモリ上のLRU（件数とバイト数（pickleしたサイズ）の上限付き）
+    - 任意でディスク上の永続キャッシュ（再起動後も有効）
+    ディスクキャッシュはpickleで保存するため、信頼できるディレクトリのみを指定すること
+    """
+
+    def __init__(self, max_entries=256, disk_dir=None, max_disk_entries=10000, name="ocr", max_bytes=0):
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self.disk_dir = disk_dir or None
+        self.max_disk_entries = max(0, int(max_disk_entries))
+        self.name = name
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "disk_evictions": 0,
+        }
+        self._disk_count = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_count = len(self._disk_files())
+
+    @staticmethod
+    def make_key(image, **params):
+        """正規化した画像のピクセル列と処理パラメータからキャッシュキーを生成"""
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        digest = hashlib.sha256()
+        digest.update(f"{image.width}x{image.height}:".encode("ascii"))
+        digest.update(image.tobytes())
+        digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        return digest.hexdigest()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 or bool(self.disk_dir)
+
+    def get(self, key):
+        """キャッシュを検索し、見つからなければNoneを返す"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return self._entries[key]
+
+        value, size = self._disk_get(key)
+        with self._lock:
+            if value is None:
+                self._counters["misses"] += 1
+                return None
+            self._counters["disk_hits"] += 1
+            self._memory_put(key, value, size)
+        return value
+
+    def put(self, key, value):
+        if not self.enabled or value is None:
+            return
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._memory_put(key, value, len(data))
+        self._disk_put(key, data)
+
+    def stats(self):
+        """ヒット・ミス・追い出し件数と現在のエントリ数"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["disk_entries"] = self._disk_count
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def _memory_put(self, key, value, size):
+        if self.max_entries <= 0 or (self.max_bytes and size > self.max_bytes):
+            return
+        self._bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+            evicted, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(evicted)
+            self._counters["evictions"] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.pkl")
+
+    def _disk_files(self):
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            files.extend(os.path.join(root, n) for n in names if n.endswith(".pkl"))
+        return files
+
+    def _disk_get(self, key):
+        """(値, pickleしたサイズ) を返す（見つからなければ (None, 0)）"""
+        if not self.disk_dir:
+            return None, 0
+        path = self._disk_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            value = pickle.loads(data)
+            # 最近使ったものを残すためにアクセス時刻を更新
+            os.utime(path)
+            return value, len(data)
+        except FileNotFoundError:
+            return None, 0
+        except Exception as e:
+            print(f"[{self.name}] ディスクキャッシュの読み込みに失敗しました: {e}")
+            return None, 0
+
+    def _disk_put(self, key, data):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            existed = os.path.exists(path)
+            # 書き込み途中のファイルを読まないよう一時ファイルから置き換える
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"[{self.name}] ディスクキャッシュの書き込みに失敗しました: {e}")
+            return
+
+        with self._lock:
+            if not existed:
+                self._disk_count += 1
+            over_limit = self.max_disk_entries and self._disk_count > self.max_disk_entries
+        if over_limit:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """古いものから1割程度まとめて削除し、件数を上限以下に戻す"""
+        files = []
+        for path in self._disk_files():
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        files.sort()
+        excess = len(files) - self.max_disk_entries
+        target = max(excess, self.max_disk_entries // 10) if excess > 0 else 0
+        removed = 0
+        for _, path in files[:target]:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_count = len(files) - removed
+            self._counters["disk_evictions"] += removed
+
+
+def cache_from_env(name):
+    """環境変数の設定からキャッシュを作成"""
+    return OCRResultCache(
+        max_entries=int(os.environ.get("OCR_CACHE_MAX_ENTRIES", "256")),
+        disk_dir=os.environ.get("OCR_CACHE_DIR", ""),
+        max_disk_entries=int(os.environ.get("OCR_CACHE_DISK_MAX_ENTRIES", "10000")),
+        name=name,
+        # メモリ上のキャッシュの上限（MB、0で無制限）
+        max_bytes=int(float(os.environ.get("OCR_CACHE_MAX_MB", "64")) * 1024 * 1024),
+    )
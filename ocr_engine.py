@@ -0,0 +1,255 @@
+"""
+Qwen3-VLとDeepSeek-OCRを1つのプロセスで扱うOCRエンジン（unified_app.pyから使う）
+
+- engine.ocr(image, task, options) の共通の呼び出し方でどちらのモデルも使える
+- options["backend"]（auto/qwen/deepseek）で使うモデルを選び、autoではタスクごとの振り分け規則に従う
+  （既定: ocr → Qwen3-VL-2B、markdown（参照領域付き） → DeepSeek-OCR）
+- メモリ予算を超える場合は、推論中でないモデルを最後に使った時刻の古い順に解放してから読み込む
+  （解放したモデルは次に振り分けられたときに再び読み込まれる）
+
+    OCR_BACKENDS=qwen,deepseek OCR_ROUTES=ocr:qwen,markdown:deepseek OCR_MEMORY_BUDGET_GB=16 python unified_app.py
+
+モデルの読み込み・解放は各アプリのモジュール（app.py、deepseekuse_gradio.py）のmodel_registryを通して行う
+"""
+import importlib
+import os
+import threading
+import time
+
+from model_registry import MODEL_LOADING, MODEL_WAIT_SECONDS, ModelNotReady
+
+# 使うモデル（カンマ区切り）
+BACKENDS = [name for name in os.environ.get("OCR_BACKENDS", "qwen,deepseek").split(",") if name]
+# タスクごとの振り分け規則（タスク:モデル、カンマ区切り）
+ROUTES = dict(
+    route.split(":", 1) for route in os.environ.get("OCR_ROUTES", "ocr:qwen,markdown:deepseek").split(",") if route
+)
+# 読み込んでおけるモデルの合計サイズ（GB、0の場合は制限しない）
+MEMORY_BUDGET_GB = float(os.environ.get("OCR_MEMORY_BUDGET_GB", "0"))
+
+TASKS = ("ocr", "markdown")
+AUTO = "auto"
+GIB = 1024 ** 3
+
+
+class Backend:
+    """1つのモデル（アプリのモジュール）への共通の呼び出し口"""
+
+    name = None
+    label = None
+    module_name = None
+    tasks = ()
+    # 読み込む前に使うモデルのサイズの見積もり（GB、読み込み後は実際の重みのサイズを使う）
+    default_memory_gb = 0.0
+
+    def __init__(self):
+        self.memory_gb = float(os.environ.get(f"OCR_{self.name.upper()}_MEMORY_GB", str(self.default_memory_gb)))
+        self.module = None
+        self.in_flight = 0
+        self.last_used = 0.0
+        self.measured_bytes = None
+
+    def import_module(self):
+        # モジュールのimportではモデルは読み込まれない（model_registryが最初の推論で読み込む）
+        if self.module is None:
+            # アプリのモジュールには受付制御・UIを作らせない（統合アプリが1つだけ持つ）
+            os.environ["OCR_EMBEDDED"] = "1"
+            self.module = importlib.import_module(self.module_name)
+        return self.module
+
+    @property
+    def models(self):
+        return self.import_module().models
+
+    @property
+    def key(self):
+        return self.import_module().APP_NAME
+
+    def loaded(self):
+        return self.module is not None and self.models.loaded(self.key)
+
+    def memory_bytes(self):
+        return self.measured_bytes if self.measured_bytes is not None else int(self.memory_gb * GIB)
+
+    def measure(self):
+        """読み込んだモデルの重みのサイズを記録する（ワーカー使用時は見積もりのまま）"""
+        model = getattr(self.module, "model", None)
+        if model is not None and self.measured_bytes is None:
+            from quantization import model_size_bytes
+            self.measured_bytes = model_size_bytes(model)
+
+    def run(self, image, task, options, trace, degraded):
+        """ocr_imageを呼び、共通の形の結果（regions・blocksを含む）を返す"""
+        raise NotImplementedError
+
+    def status(self):
+        state = self.models.status()[self.key] if self.module is not None else {"state": "idle"}
+        return dict(
+            state, label=self.label, tasks=list(self.tasks), in_flight=self.in_flight,
+            memory_gb=round(self.memory_bytes() / GIB, 2), measured=self.measured_bytes is not None,
+        )
+
+
+class QwenBackend(Backend):
+    name = "qwen"
+    label = "Qwen3-VL-2B"
+    module_name = "app"
+    tasks = ("ocr",)
+    default_memory_gb = 9.0
+
+    def run(self, image, task, options, trace, degraded):
+        result = self.module.ocr_image(image, trace=trace, degraded=degraded)
+        # Qwen3-VLのOCRは領域の座標を出力しない
+        return dict(result, regions=None, blocks=None)
+
+
+class DeepSeekBackend(Backend):
+    name = "deepseek"
+    label = "DeepSeek-OCR"
+    module_name = "deepseekuse_gradio"
+    tasks = ("ocr", "markdown")
+    default_memory_gb = 14.0
+
+    def run(self, image, task, options, trace, degraded):
+        crop_mode = self.module.API_CROP_MODES.get(str(options.get("crop_mode", "auto")).lower())
+        if crop_mode is None:
+            raise ValueError("crop_modeにはauto、onまたはoffを指定してください")
+        return self.module.ocr_image(image, self.module.API_TASKS[task], crop_mode, trace, degraded=degraded)
+
+
+BACKEND_TYPES = {backend.name: backend for backend in (QwenBackend, DeepSeekBackend)}
+
+
+class OCREngine:
+    """
+    タスク・指定に応じてモデルを選び、メモリ予算の範囲でモデルを読み込み・解放する
+
+    ocr(image, task, options) -> {"backend", "model", "task", "text", "regions", "blocks",
+                                  "preprocess", "generation", "cached"}
+    """
+
+    def __init__(self, backends=BACKENDS, routes=ROUTES, memory_budget_gb=MEMORY_BUDGET_GB):
+        unknown = [name for name in backends if name not in BACKEND_TYPES]
+        if unknown or not backends:
+            raise ValueError(f"OCR_BACKENDSには{', '.join(BACKEND_TYPES)}を指定してください: {unknown or backends}")
+        self.backends = {name: BACKEND_TYPES[name]() for name in backends}
+        self.routes = {task: name for task, name in routes.items() if name in self.backends}
+        self.memory_budget = int(memory_budget_gb * GIB)
+        self._condition = threading.Condition()
+
+    def route(self, task, options=None):
+        """使うモデルの名前を返す（指定がなければ振り分け規則、規則がなければタスクに対応するモデル）"""
+        requested = str((options or {}).get("backend", AUTO)).lower()
+        if requested != AUTO:
+            backend = self.backends.get(requested)
+            if backend is None:
+                raise ValueError(f"backendにはauto、{', '.join(self.backends)}のいずれかを指定してください")
+            if task not in backend.tasks:
+                raise ValueError(f"{backend.label}はタスク{task}に対応していません")
+            return requested
+        name = self.routes.get(task)
+        if name is not None and task in self.backends[name].tasks:
+            return name
+        for name, backend in self.backends.items():
+            if task in backend.tasks:
+                return name
+        raise ValueError(f"タスク{task}に対応するモデルがありません")
+
+    def _used_bytes(self, exclude=None):
+        # 推論を受け付けたモデルは読み込みがまだ始まっていなくてもメモリを使うものとして数える
+        return sum(
+            backend.memory_bytes() for backend in self.backends.values()
+            if backend is not exclude and (backend.loaded() or backend.in_flight)
+        )
+
+    def _make_room(self, backend):
+        """
+        backendを読み込めるだけのメモリを空ける（_conditionを保持した状態で呼ぶ）
+
+        他のモデルが推論中・読み込み中なら終わるまで待ち、他に読み込んだモデルがなければ予算を超えて読み込む
+        """
+        if not self.memory_budget or backend.loaded():
+            return
+        deadline = time.monotonic() + MODEL_WAIT_SECONDS
+        while self._used_bytes(exclude=backend) + backend.memory_bytes() > self.memory_budget:
+            others = [
+                other for other in self.backends.values()
+                if other is not backend and (other.loaded() or other.in_flight)
+            ]
+            idle = sorted(
+                (other for other in others if other.in_flight == 0 and other.models.ready(other.key)),
+                key=lambda other: other.last_used
+            )
+            if idle:
+                print(f"メモリ予算を超えるため{idle[0].label}を解放して{backend.label}を読み込みます")
+                idle[0].models.unload(idle[0].key)
+                continue
+            if not others:
+                print(f"警告: {backend.label}の見積もりサイズがメモリ予算を超えています")
+                return
+            # 推論中・読み込み中のモデルが終わるのを待ってから解放する
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ModelNotReady(f"他のモデルの推論中のため{backend.label}を読み込めません")
+            self._condition.wait(min(remaining, 1.0))
+
+    def _acquire(self, backend):
+        with self._condition:
+            self._make_room(backend)
+            backend.in_flight += 1
+            backend.last_used = time.monotonic()
+
+    def _release(self, backend):
+        with self._condition:
+            backend.in_flight -= 1
+            backend.last_used = time.monotonic()
+            self._condition.notify_all()
+
+    def ocr(self, image, task="ocr", options=None, trace=None, degraded=False, wait_seconds=MODEL_WAIT_SECONDS):
+        """
+        1枚の画像を処理する（不正なタスク・指定はValueError、モデルの準備ができなければModelNotReadyを送出）
+        """
+        options = options or {}
+        task = str(task).lower()
+        if task not in TASKS:
+            raise ValueError(f"taskには{'、'.join(TASKS)}のいずれかを指定してください")
+        backend = self.backends[self.route(task, options)]
+        backend.import_module()
+        self._acquire(backend)
+        try:
+            backend.models.require(backend.key, timeout=wait_seconds)
+            backend.measure()
+            result = backend.run(image, task, options, trace, degraded)
+        finally:
+            self._release(backend)
+        return dict(result, backend=backend.name, model=backend.module.model_name, task=task)
+
+    def start_from_env(self):
+        """OCR_MODEL_LOADINGに従い、振り分け規則で先に挙がるモデルからメモリ予算に収まる分を読み込む"""
+        if MODEL_LOADING == "lazy":
+            return self
+        used = 0
+        order = list(dict.fromkeys(list(self.routes.values()) + list(self.backends)))
+        for name in order:
+            backend = self.backends[name]
+            if self.memory_budget and used and used + backend.memory_bytes() > self.memory_budget:
+                break
+            used += backend.memory_bytes()
+            backend.import_module()
+            if MODEL_LOADING == "eager":
+                backend.models.load_all()
+                backend.measure()
+            else:
+                backend.models.start()
+        return self
+
+    def ready(self):
+        """読み込み中・読み込みに失敗したモデルがない（未読み込みのモデルは必要になった時点で読み込む）"""
+        return all(backend.status()["state"] in ("idle", "ready") for backend in self.backends.values())
+
+    def status(self):
+        return {
+            "memory_budget_gb": round(self.memory_budget / GIB, 2) if self.memory_budget else None,
+            "routes": self.routes,
+            "backends": {name: backend.status() for name, backend in self.backends.items()},
+        }
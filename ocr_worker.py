@@ -0,0 +1,112 @@
+"""
+推論ワーカープロセス（worker_pool.WorkerPoolが起動する）
+
+    python ocr_worker.py --app app --index 0 --fds 5,6
+
+割り当てられたCPUとスレッド数を設定してからアプリのモジュールとモデルを読み込み、
+フロントエンドから届いたリクエストをmodule.worker_infer(request, trace)で処理して結果を返す
+"""
+import argparse
+import importlib
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+
+
+def configure_threads():
+    """CPUアフィニティとtorchのスレッド数を設定（モデルの読み込み前に行う）"""
+    cpus = None
+    cpu_list = os.environ.get("OCR_WORKER_CPUS", "")
+    if cpu_list and hasattr(os, "sched_setaffinity"):
+        cpus = sorted(int(cpu) for cpu in cpu_list.split(","))
+        os.sched_setaffinity(0, cpus)
+
+    import torch
+
+    threads = int(os.environ.get("OCR_WORKER_THREADS", "0"))
+    if threads:
+        torch.set_num_threads(threads)
+    # ワーカー同士でコアを取り合わないよう、演算間の並列実行は行わない
+    torch.set_num_interop_threads(1)
+    # スレッド数はフロントエンドがCPUを分割して決めているため、アプリの読み込み時には調整しない
+    os.environ["OCR_THREAD_TUNING"] = "off"
+    return torch.get_num_threads(), cpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OCR推論ワーカー")
+    parser.add_argument("--app", required=True, help="モデルを読み込むモジュール名（app, deepseekuse_gradio）")
+    parser.add_argument("--index", type=int, required=True)
+    parser.add_argument("--fds", required=True, help="受信用,送信用のファイルディスクリプタ")
+    args = parser.parse_args()
+
+    read_fd, write_fd = (int(fd) for fd in args.fds.split(","))
+    receiver = Connection(read_fd, writable=False)
+    sender = Connection(write_fd, readable=False)
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            sender.send(message)
+
+    threads, cpus = configure_threads()
+    # ワーカーでは推論だけを行うため、アプリのモジュールに受付制御・UIを作らせない
+    os.environ["OCR_EMBEDDED"] = "1"
+    module = importlib.import_module(args.app)
+    # 準備完了（hello）を送る前にモデルを読み込む（OCR_WARMUP=1ならウォームアップも行う）
+    module.models.load_all()
+    import metrics
+    from metrics import RequestTrace
+
+    # リクエストの記録（JSONL）はフロントエンドが段階・値を合わせて書き出すため、ワーカーでは書かない
+    metrics.JSONL_PATH = ""
+
+    def handle(message):
+        trace = RequestTrace(module.APP_NAME)
+        started = time.perf_counter()
+        reply = {"op": "result", "id": message["id"]}
+        status = "ok"
+        try:
+            reply["result"] = module.worker_infer(message["request"], trace)
+        except Exception as e:
+            traceback.print_exc()
+            reply["error"] = f"{type(e).__name__}: {e}"
+            status = "error"
+        finally:
+            reply.update(stages=dict(trace.stages), values=dict(trace.values),
+                         worker_seconds=time.perf_counter() - started)
+            # 処理中の件数（_RSSTracker）を戻すため、応答に写した後でトレースを閉じる
+            trace.finish(status)
+        try:
+            send(reply)
+        except OSError:
+            pass
+
+    send({"op": "hello", "index": args.index, "pid": os.getpid(), "threads": threads, "cpus": cpus})
+    pool = ThreadPoolExecutor(
+        max_workers=getattr(module, "WORKER_CONCURRENCY", 1),
+        thread_name_prefix=f"ocr-worker-{args.index}"
+    )
+    while True:
+        try:
+            message = receiver.recv()
+        except (EOFError, OSError):
+            # フロントエンドが終了した
+            break
+        op = message.get("op")
+        if op == "ping":
+            send({"op": "pong"})
+        elif op == "infer":
+            pool.submit(handle, message)
+        elif op == "shutdown":
+            break
+
+    # 処理中の推論は結果の送り先がないため待たずに終了する
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+知覚ハッシュによるほぼ同一画像の検出（結果キャッシュの前段、既定では無効）
+
+結果キャッシュ（ocr_cache.py）は画素が完全に一致する画像にしか当たらないため、同じ画像を圧縮し直した・
+縮小し直した画像は毎回推論される。正規化したグレースケールの縮小画像からdHash（隣り合う画素の明暗の
+向き）を求めて候補を絞り、文字が読める解像度の文字の形（2値画像）を比べて確かめてから過去の結果を返す
+
+    OCR_PHASH=1 python app.py                      # 有効にする（既定: 0、完全一致のキャッシュのみ）
+    OCR_PHASH_MAX_DISTANCE=4 python app.py         # 64ビットのハッシュで候補とするハミング距離（既定: 6）
+    OCR_PHASH_VERIFY_MB=256 python app.py          # 確認用の2値画像を保持するメモリの上限（MB）
+
+- 検索: 64ビットのハッシュを(距離+1)個の帯に分け、帯ごとの値で候補を引く（距離以内なら少なくとも
+  1つの帯が完全に一致する）。全件と比較せず、帯が一致した登録だけを比べる
+- 確認: ハッシュの縮小画像では文字が読めず、同じ様式で数字だけ違う帳票も一致してしまうため、ハッシュだけで
+  結果を返すことはしない。長辺OCR_PHASH_VERIFY_SIZE画素で文字の部分を1ビットにした画像を8画素四方の
+  区画ごとに比べ、どの区画も食い違う画素が少ない場合のみ同じ画像とみなす（文字1つの違いでも区画の差は
+  大きくなる）。2値画像は圧縮して1件あたり数KB〜20KB程度（A4の文書1ページ）で保持する
+  （区画の平均だけの数百バイトの署名では、文字1つの違いと圧縮し直しによる揺れを区別できない）
+- 白紙に近い画像などハッシュの情報量が少ない画像は登録・検索しない
+- 結果自体は結果キャッシュに保存されており、キャッシュから追い出された結果は引けないため、
+  登録件数の上限は結果キャッシュが保持できる件数（ディスクキャッシュがあればその件数）に合わせる
+
+撮り直した画像は位置がずれて確認を通らないことが多い（誤った結果を返さないことを優先する）
+"""
+import json
+import os
+import threading
+import zlib
+from array import array
+
+from PIL import Image, ImageChops, ImageOps
+
+# 1の場合はほぼ同一の画像に過去の結果を返す
+PHASH = os.environ.get("OCR_PHASH", "0") == "1"
+# 64ビットのハッシュで候補とするハミング距離
+MAX_DISTANCE = int(os.environ.get("OCR_PHASH_MAX_DISTANCE", "6"))
+# 256ビットのハッシュで候補とするハミング距離
+FINE_MAX_DISTANCE = int(os.environ.get("OCR_PHASH_FINE_MAX_DISTANCE", "20"))
+# 保持する件数の上限（超えたら古いものから削除、結果キャッシュが保持できる件数を超える分は使わない）
+MAX_ENTRIES = int(os.environ.get("OCR_PHASH_MAX_ENTRIES", "100000"))
+# 確認に使う2値画像の長辺（文字の形が残る解像度）
+VERIFY_SIZE = int(os.environ.get("OCR_PHASH_VERIFY_SIZE", "768"))
+# 確認で許す区画ごとの食い違う画素の割合（0〜255、255で区画のすべての画素）
+VERIFY_MAX_DIFF = int(os.environ.get("OCR_PHASH_VERIFY_MAX_DIFF", "64"))
+# 確認用の2値画像（圧縮済み）を保持するメモリの上限（MB、超えたら古いものから削除）
+VERIFY_MB = float(os.environ.get("OCR_PHASH_VERIFY_MB", "256"))
+
+# 縦横比の許容差（相対値）
+ASPECT_TOLERANCE = 0.03
+# 64ビットのハッシュで立っているビットがこれ未満（または64からこれを引いた数より多い）画像は
+# 明暗の変化が少なく、別の画像とも一致しやすいため扱わない
+MIN_BITS = 8
+# ハッシュに使う縮小画像の一辺
+THUMBNAIL_SIZE = 64
+# 確認で比べる区画の一辺（画素）
+VERIFY_BLOCK = 8
+# コントラストを正規化したグレースケールでこれより暗い画素を文字とみなす
+INK_LEVEL = 160
+# 1回の検索で確認する候補の数
+MAX_VERIFY_CANDIDATES = 3
+
+
+def _dhash(image, size):
+    """size×sizeビットのdHash（各行で右隣の画素より明るいか）"""
+    pixels = list(image.resize((size + 1, size), Image.BOX).getdata())
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _verify_image(image):
+    """確認用の、長辺VERIFY_SIZE画素のコントラストを正規化したグレースケール画像"""
+    scale = min(1.0, VERIFY_SIZE / max(image.width, image.height))
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return ImageOps.autocontrast(image.resize(size, Image.BOX, reducing_gap=2.0).convert("L"))
+
+
+def _ink_mask(gray):
+    """文字の部分を1にした2値画像（確認用）"""
+    return gray.point(lambda value: 255 if value < INK_LEVEL else 0).convert("1", dither=Image.NONE)
+
+
+def fingerprint(image):
+    """
+    画像の (64ビットのハッシュ, 256ビットのハッシュ, 縦横比, 確認用の2値画像) を返す（情報量が少ない画像はNone）
+
+    ハッシュはグレースケール化・コントラストの正規化をした縮小画像から求めるため、明るさ・圧縮・解像度の
+    違いの影響を受けにくい
+    """
+    gray = _verify_image(image)
+    thumbnail = gray.resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BOX)
+    coarse = _dhash(thumbnail, 8)
+    bits = _distance(coarse, 0)
+    if bits < MIN_BITS or bits > 64 - MIN_BITS:
+        return None
+    return coarse, _dhash(thumbnail, 16), image.width / max(1, image.height), _ink_mask(gray)
+
+
+def same_content(mask, size, blob, max_diff=VERIFY_MAX_DIFF):
+    """確認用の2値画像が、保存した2値画像（size、圧縮済みのblob）と区画ごとに見て同じか"""
+    stored = Image.frombytes("1", size, zlib.decompress(blob)).convert("L")
+    mask = mask.convert("L")
+    if mask.size != size:
+        mask = mask.resize(size, Image.BOX)
+    diff = ImageChops.difference(mask, stored)
+    # 区画ごとの食い違う画素の割合（文字1つ分の違いでも、その区画では多くの画素が食い違う）
+    blocks = diff.resize(
+        (max(1, size[0] // VERIFY_BLOCK), max(1, size[1] // VERIFY_BLOCK)), Image.BOX
+    )
+    return blocks.getextrema()[1] <= max_diff
+
+
+def _band_widths(bands):
+    base, extra = divmod(64, bands)
+    return [base + (1 if index < extra else 0) for index in range(bands)]
+
+
+class NearDuplicateIndex:
+    """
+    知覚ハッシュから結果キャッシュのキーを引く索引
+
+    settingsはキャッシュキーに含める処理パラメータ（同じ設定の結果の中からのみ探す）
+    """
+
+    def __init__(self, max_distance=MAX_DISTANCE, fine_max_distance=FINE_MAX_DISTANCE, max_entries=MAX_ENTRIES,
+                 max_verify_bytes=int(VERIFY_MB * 1024 * 1024), name="ocr"):
+        if not 0 <= max_distance < 16:
+            raise ValueError(f"OCR_PHASH_MAX_DISTANCEには0〜15を指定してください: {max_distance}")
+        self.max_distance = max_distance
+        self.fine_max_distance = fine_max_distance
+        self.max_entries = max(0, int(max_entries))
+        self.max_verify_bytes = max(0, int(max_verify_bytes))
+        self.name = name
+        self._shifts = []
+        shift = 64
+        for width in _band_widths(max_distance + 1):
+            shift -= width
+            self._shifts.append((shift, (1 << width) - 1))
+        # 登録番号 -> (設定の番号, 64ビット, 256ビット, 縦横比, 結果キャッシュのキー, 確認用の画像の大きさ, 圧縮した画素)
+        # （登録順＝古い順）
+        self._entries = {}
+        # (設定の番号, 帯, 帯の値) -> 登録番号の配列（削除した番号は検索時に読み飛ばし、増えたら作り直す）
+        self._buckets = {}
+        self._scopes = {}
+        self._next_id = 0
+        self._oldest_id = 0
+        self._stale = 0
+        self._verify_bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "rejected": 0, "misses": 0, "skipped": 0, "evictions": 0}
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.max_verify_bytes > 0
+
+    def _scope(self, settings):
+        scope = json.dumps(settings, sort_keys=True, ensure_ascii=False, default=str)
+        if scope not in self._scopes:
+            self._scopes[scope] = len(self._scopes)
+        return self._scopes[scope]
+
+    def _bands(self, scope, coarse):
+        return [(scope, index, (coarse >> shift) & mask) for index, (shift, mask) in enumerate(self._shifts)]
+
+    def _count(self, event):
+        with self._lock:
+            self._counters[event] += 1
+
+    def candidates(self, fingerprint, settings):
+        """
+        ハッシュが近く縦横比がほぼ同じ登録を、64ビット・256ビットのハッシュが近い順に返す
+
+        戻り値: [(ハミング距離, 結果キャッシュのキー, 確認用の画像の大きさ, 圧縮した画素), ...]（確認前の候補）
+        """
+        coarse, fine, aspect, _ = fingerprint
+        with self._lock:
+            scope = self._scope(settings)
+            found = []
+            seen = set()
+            for band in self._bands(scope, coarse):
+                for entry_id in self._buckets.get(band, ()):
+                    if entry_id in seen:
+                        continue
+                    seen.add(entry_id)
+                    entry = self._entries.get(entry_id)
+                    if entry is None:
+                        continue
+                    distance = _distance(coarse, entry[1])
+                    if distance > self.max_distance or abs(entry[3] - aspect) > ASPECT_TOLERANCE * aspect:
+                        continue
+                    fine_distance = _distance(fine, entry[2])
+                    if fine_distance > self.fine_max_distance:
+                        continue
+                    found.append((distance, fine_distance, entry[4], entry[5], entry[6]))
+        found.sort(key=lambda item: item[:2])
+        return [(distance, key, size, blob) for distance, _, key, size, blob in found[:MAX_VERIFY_CANDIDATES]]
+
+    def find(self, image, settings, cache):
+        """
+        ほぼ同一の画像の結果を結果キャッシュから探し、(結果またはNone, 知覚ハッシュ) を返す
+
+        ハッシュが近い候補は確認用の2値画像を比べて確かめ、通ったものだけを返す
+        （結果には {"near_duplicate": {"distance": ハミング距離}} を付ける）。
+        知覚ハッシュは推論後にadd()で登録するために返す（無効な場合はNone）
+        """
+        if not self.enabled:
+            return None, None
+        found = fingerprint(image)
+        if found is None:
+            self._count("skipped")
+            return None, None
+        candidates = self.candidates(found, settings)
+        for distance, key, size, blob in candidates:
+            if not same_content(found[3], size, blob):
+                continue
+            result = cache.get(key)
+            if result is not None:
+                self._count("hits")
+                return dict(result, near_duplicate={"distance": distance}), found
+        # ハッシュは近いが確認で落とした候補があれば誤一致を防いだものとして数える
+        self._count("rejected" if candidates else "misses")
+        return None, found
+
+    def add(self, fingerprint, settings, key):
+        """画像の知覚ハッシュ・確認用の2値画像と結果キャッシュのキーを登録する"""
+        if not self.enabled or fingerprint is None:
+            return
+        coarse, fine, aspect, mask = fingerprint
+        blob = zlib.compress(mask.tobytes(), 9)
+        with self._lock:
+            scope = self._scope(settings)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, coarse, fine, aspect, key, mask.size, blob)
+            self._verify_bytes += len(blob)
+            for band in self._bands(scope, coarse):
+                bucket = self._buckets.get(band)
+                if bucket is None:
+                    bucket = self._buckets[band] = array("Q")
+                bucket.append(entry_id)
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._verify_bytes > self.max_verify_bytes
+            ):
+                self._verify_bytes -= len(self._entries.pop(self._oldest_id)[6])
+                self._oldest_id += 1
+                self._counters["evictions"] += 1
+                self._stale += 1
+            if self._stale > max(len(self._entries), 1024):
+                self._rebuild()
+
+    def _rebuild(self):
+        """削除済みの登録番号を帯の配列から取り除く（_lockを保持した状態で呼ぶ）"""
+        self._buckets = {}
+        for entry_id, entry in self._entries.items():
+            for band in self._bands(entry[0], entry[1]):
+                bucket = self._buckets.get(band)
+                if bucket is None:
+                    bucket = self._buckets[band] = array("Q")
+                bucket.append(entry_id)
+        self._stale = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                self._counters,
+                entries=len(self._entries),
+                max_entries=self.max_entries,
+                max_distance=self.max_distance,
+                verify_bytes=self._verify_bytes,
+            )
+
+
+def cache_capacity(cache):
+    """結果キャッシュが保持できる件数（ディスクキャッシュがあればその件数、なければメモリ上の件数）"""
+    return cache.max_disk_entries if cache.disk_dir else cache.max_entries
+
+
+def index_from_env(name, cache):
+    """
+    環境変数の設定から索引を作成（OCR_PHASH=0の場合は何も登録しない索引）
+
+    結果が追い出された登録は引けないため、件数の上限は結果キャッシュが保持できる件数までとする
+    """
+    if not PHASH:
+        return NearDuplicateIndex(max_entries=0, name=name)
+    max_entries = min(MAX_ENTRIES, cache_capacity(cache))
+    print(f"[{name}] ほぼ同一画像の索引: 最大{max_entries}件（結果キャッシュの保持件数に合わせる）")
+    return NearDuplicateIndex(max_entries=max_entries, name=name)
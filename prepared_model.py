@@ -0,0 +1,312 @@
+"""
+CPU推論用に変換済みのモデル（prepared model）の作成と読み込み
+
+- 作成: 対象のdtypeに変換したモデルをsafetensorsで保存し、チェックサムのマニフェストを書き出す
+- 読み込み: マニフェストを検証し、重みを確保せずにモデルを構築してから、
+  メモリマップしたファイルのテンソルをそのまま割り当てる
+  （同じホスト上の複数プロセスがページキャッシュ上の同じ重みを共有できる）
+
+使い方:
+    python prepared_model.py qwen --out ./models/qwen3-vl-2b-cpu
+    python prepared_model.py deepseek --out ./models/deepseek-ocr-cpu
+    python prepared_model.py verify ./models/deepseek-ocr-cpu --mode full
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import time
+
+import torch
+
+MANIFEST_NAME = "prepared_manifest.json"
+MANIFEST_VERSION = 1
+
+# safetensorsのdtype表記とtorchのdtypeの対応
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+class PreparedModelError(Exception):
+    """変換済みモデルの検証・読み込みに失敗した場合のエラー"""
+
+
+def _sha256_file(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_safetensors_header(path):
+    """safetensorsのヘッダ（テンソル名→dtype/shape/オフセット）とデータ部の開始位置を返す"""
+    with open(path, "rb") as f:
+        raw_len = f.read(8)
+        if len(raw_len) != 8:
+            raise PreparedModelError(f"safetensorsのヘッダが不正です: {path}")
+        (header_len,) = struct.unpack("<Q", raw_len)
+        header_bytes = f.read(header_len)
+    header = json.loads(header_bytes)
+    return header, 8 + header_len, header_bytes
+
+
+def _header_sha256(path):
+    _, _, header_bytes = read_safetensors_header(path)
+    return hashlib.sha256(header_bytes).hexdigest()
+
+
+def is_prepared(path):
+    return bool(path) and os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def write_manifest(out_dir, source, dtype):
+    """ディレクトリ内の全ファイルのサイズとチェックサムを記録"""
+    import transformers
+
+    files = {}
+    for name in sorted(os.listdir(out_dir)):
+        path = os.path.join(out_dir, name)
+        if name == MANIFEST_NAME or not os.path.isfile(path):
+            continue
+        entry = {"size": os.path.getsize(path), "sha256": _sha256_file(path)}
+        if name.endswith(".safetensors"):
+            entry["header_sha256"] = _header_sha256(path)
+        files[name] = entry
+
+    manifest = {
+        "format_version": MANIFEST_VERSION,
+        "source": source,
+        "dtype": str(dtype).replace("torch.", ""),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "torch_version": torch.__version__,
+        "transformers_version": transformers.__version__,
+        "files": files,
+    }
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    return manifest
+
+
+def verify_prepared_dir(path, mode="fast"):
+    """
+    マニフェストと実ファイルを照合する
+
+    mode:
+      full: 全ファイルのSHA-256を照合（重みファイル全体を読むため起動は遅くなる）
+      fast: 重み以外はSHA-256、重みはサイズとsafetensorsヘッダのSHA-256を照合
+      off:  マニフェストの読み込みのみ
+    """
+    manifest_path = os.path.join(path, MANIFEST_NAME)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise PreparedModelError(f"マニフェストを読み込めません: {manifest_path} ({e})")
+
+    if manifest.get("format_version") != MANIFEST_VERSION:
+        raise PreparedModelError(f"未対応のマニフェスト形式です: {manifest.get('format_version')}")
+    if mode == "off":
+        return manifest
+
+    for name, expected in manifest["files"].items():
+        file_path = os.path.join(path, name)
+        if not os.path.isfile(file_path):
+            raise PreparedModelError(f"ファイルが見つかりません: {file_path}")
+        if os.path.getsize(file_path) != expected["size"]:
+            raise PreparedModelError(f"ファイルサイズが一致しません: {file_path}")
+        if mode == "fast" and "header_sha256" in expected:
+            actual = _header_sha256(file_path)
+            expected_hash = expected["header_sha256"]
+        else:
+            actual = _sha256_file(file_path)
+            expected_hash = expected["sha256"]
+        if actual != expected_hash:
+            raise PreparedModelError(f"チェックサムが一致しません: {file_path}")
+    return manifest
+
+
+def load_mmap_state_dict(path):
+    """
+    ディレクトリ内のsafetensorsをメモリマップし、コピーせずにテンソルとして参照する
+
+    MAP_PRIVATE（copy-on-write）でマップするため、書き込まれない限りページキャッシュ上の
+    同じページが全プロセスで共有される
+    """
+    state_dict = {}
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".safetensors"):
+            continue
+        file_path = os.path.join(path, name)
+        header, data_start, _ = read_safetensors_header(file_path)
+        with open(file_path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        for key, info in header.items():
+            if key == "__metadata__":
+                continue
+            dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+            if dtype is None:
+                raise PreparedModelError(f"未対応のdtypeです: {info['dtype']} ({key})")
+            begin, end = info["data_offsets"]
+            shape = info["shape"]
+            numel = 1
+            for dim in shape:
+                numel *= dim
+            if numel == 0:
+                state_dict[key] = torch.empty(shape, dtype=dtype)
+                continue
+            tensor = torch.frombuffer(mapped, dtype=dtype, count=numel, offset=data_start + begin)
+            if (end - begin) != tensor.numel() * tensor.element_size():
+                raise PreparedModelError(f"テンソルのサイズが一致しません: {key}")
+            state_dict[key] = tensor.view(shape)
+    return state_dict
+
+
+def _apply_key_mapping(model, state_dict):
+    """保存時のキー名を読み込み時のモジュール名に合わせる（transformersのキー変換規則を適用）"""
+    mapping = getattr(model, "_checkpoint_conversion_mapping", None) or {}
+    if not mapping:
+        return state_dict
+    converted = {}
+    for key, value in state_dict.items():
+        for pattern, replacement in mapping.items():
+            new_key, count = re.subn(pattern, replacement, key)
+            if count:
+                key = new_key
+                break
+        converted[key] = value
+    return converted
+
+
+def build_empty_model(model_cls, path, dtype, **kwargs):
+    """設定ファイルからモデルを構築する（パラメータはmetaデバイスに置き、重みのメモリを確保しない）"""
+    from accelerate import init_empty_weights
+    from transformers import AutoConfig
+
+    config = AutoConfig.from_pretrained(path, **kwargs)
+    # バッファ（回転位置埋め込みの周波数等）は保存されないものがあるため通常どおり確保する
+    with init_empty_weights(include_buffers=False):
+        if hasattr(model_cls, "from_config"):
+            # AutoModel等（trust_remote_codeをそのまま渡す）
+            return model_cls.from_config(config, torch_dtype=dtype, **kwargs)
+        return model_cls._from_config(config, torch_dtype=dtype)
+
+
+def attach_mmap_weights(model, path):
+    """metaデバイス上のパラメータに、メモリマップしたテンソルを割り当てる"""
+    state_dict = _apply_key_mapping(model, load_mmap_state_dict(path))
+    model_keys = set(model.state_dict().keys())
+    matched = {key: value for key, value in state_dict.items() if key in model_keys}
+    model.load_state_dict(matched, strict=False, assign=True)
+    # 共有している重み（lm_headとembed_tokens等）の参照を結び直す
+    if hasattr(model, "tie_weights"):
+        model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    missing += [name for name, buffer in model.named_buffers() if buffer.device.type == "meta"]
+    if missing:
+        raise PreparedModelError(
+            f"変換済みモデルに含まれない重みがあります（{len(missing)}個、例: {missing[0]}）。"
+            "prepared_model.pyで作り直してください"
+        )
+    print(f"メモリマップした重みを使用します: {len(matched)}/{len(model_keys)}個")
+    return len(matched)
+
+
+def load_prepared(model_cls, path, verify=None, **kwargs):
+    """
+    マニフェストを検証してから変換済みモデルを読み込む
+
+    from_pretrainedで重みを読み込んでから差し替えると、一時的に重み全体のコピーを確保するため、
+    重みを確保せずに構築したモデルにメモリマップしたテンソルを直接割り当てる
+    """
+    verify = verify or os.environ.get("OCR_PREPARED_VERIFY", "fast")
+    started = time.time()
+    manifest = verify_prepared_dir(path, mode=verify)
+    dtype = getattr(torch, manifest["dtype"])
+    print(f"変換済みモデルを検証しました ({verify}, {time.time() - started:.2f}秒): {path}")
+
+    model = build_empty_model(model_cls, path, dtype, **kwargs)
+    attach_mmap_weights(model, path)
+    if os.path.exists(os.path.join(path, "generation_config.json")):
+        from transformers import GenerationConfig
+        model.generation_config = GenerationConfig.from_pretrained(path)
+    return model.eval()
+
+
+def prepare_snapshot(model, preprocessor, out_dir, source, dtype=torch.float32):
+    """対象のdtypeに変換したモデルを保存し、マニフェストを書き出す"""
+    os.makedirs(out_dir, exist_ok=True)
+    model = model.to(dtype)
+    for param in model.parameters():
+        if param.dtype.is_floating_point and param.dtype != dtype:
+            param.data = param.data.to(dtype)
+
+    # 単一ファイルにまとめてメモリマップ時のファイル数を減らす
+    model.save_pretrained(out_dir, safe_serialization=True, max_shard_size="100GB")
+    preprocessor.save_pretrained(out_dir)
+    manifest = write_manifest(out_dir, source, dtype)
+    print(f"変換済みモデルを保存しました: {out_dir} ({len(manifest['files'])}ファイル)")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU推論用の変換済みモデルを作成・検証します")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    for name, default_source, default_out in (
+        ("qwen", "Qwen/Qwen3-VL-2B-Instruct", "./models/qwen3-vl-2b-cpu"),
+        ("deepseek", "deepseek-ai/DeepSeek-OCR", "./models/deepseek-ocr-cpu"),
+    ):
+        p = sub.add_parser(name)
+        p.add_argument("--source", default=default_source, help="変換元のモデル名またはディレクトリ")
+        p.add_argument("--out", default=default_out, help="出力先ディレクトリ")
+
+    p = sub.add_parser("verify")
+    p.add_argument("path")
+    p.add_argument("--mode", choices=["fast", "full", "off"], default="full")
+
+    args = parser.parse_args()
+
+    if args.command == "verify":
+        manifest = verify_prepared_dir(args.path, mode=args.mode)
+        print(f"検証に成功しました: {args.path} (source={manifest['source']}, dtype={manifest['dtype']})")
+        return
+
+    if args.command == "qwen":
+        from transformers import Qwen3VLForConditionalGeneration, AutoProcessor
+        preprocessor = AutoProcessor.from_pretrained(args.source)
+        model = Qwen3VLForConditionalGeneration.from_pretrained(args.source, torch_dtype=torch.float32)
+    else:
+        from transformers import AutoModel, AutoTokenizer
+        from cpu_compat import convert_model_to_float32
+        preprocessor = AutoTokenizer.from_pretrained(args.source, trust_remote_code=True)
+        model = AutoModel.from_pretrained(
+            args.source,
+            trust_remote_code=True,
+            use_safetensors=True,
+            torch_dtype=torch.float32
+        )
+        convert_model_to_float32(model)
+
+    prepare_snapshot(model.eval(), preprocessor, args.out, source=args.source)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import math
+import os
+
+from PIL import Image, ImageChops, ImageFilter, ImageStat
+
+# 画素数の予算（環境変数から取得）
+MIN_PIXELS = int(os.environ.get("OCR_MIN_PIXELS", str(256 * 28 * 28)))
+MAX_PIXELS = int(os.environ.get("OCR_MAX_PIXELS", str(1280 * 28 * 28)))
+
+# 余白の除去とテキスト密度の判定
+TRIM_MARGINS = os.environ.get("OCR_TRIM_MARGINS", "1") == "1"
+LOW_DENSITY_THRESHOLD = float(os.environ.get("OCR_LOW_DENSITY_THRESHOLD", "0.03"))
+HIGH_DENSITY_THRESHOLD = float(os.environ.get("OCR_HIGH_DENSITY_THRESHOLD", "0.12"))
+
+# テキストの少ない画像に適用する画素数予算の倍率
+LOW_DENSITY_BUDGET_RATIO = float(os.environ.get("OCR_LOW_DENSITY_BUDGET_RATIO", "0.25"))
+
+# DeepSeek-OCRの解像度モード (base_size, image_size, crop_mode)
+DEEPSEEK_MODES = {
+    "small": (640, 640, False),
+    "base": (1024, 1024, False),
+    "gundam": (1024, 640, True),
+}
+
+
+def trim_margins(image, tolerance=16, padding_ratio=0.01):
+    """四隅の色と同じ一様な余白を切り取り、切り取った範囲を返す"""
+    gray = image.convert("L")
+    # 四隅の明るさの中央値を背景色とみなす
+    corners = sorted(
+        gray.getpixel(point)
+        for point in ((0, 0), (gray.width - 1, 0), (0, gray.height - 1), (gray.width - 1, gray.height - 1))
+    )
+    background = (corners[1] + corners[2]) // 2
+    diff = ImageChops.difference(gray, Image.new("L", gray.size, background))
+    bbox = diff.point(lambda p: 255 if p > tolerance else 0).getbbox()
+    if bbox is None:
+        return image, None
+
+    pad = int(max(image.size) * padding_ratio)
+    left, top, right, bottom = bbox
+    bbox = (max(0, left - pad), max(0, top - pad), min(image.width, right + pad), min(image.height, bottom + pad))
+    if bbox == (0, 0, image.width, image.height):
+        return image, None
+    return image.crop(bbox), bbox
+
+
+def estimate_text_density(image, sample_size=512, edge_threshold=48):
+    """縮小したグレースケール画像のエッジ画素の割合をテキスト密度の目安とする"""
+    thumb = image.convert("L")
+    thumb.thumbnail((sample_size, sample_size))
+    edges = thumb.filter(ImageFilter.FIND_EDGES).point(lambda p: 255 if p > edge_threshold else 0)
+    return ImageStat.Stat(edges).mean[0] / 255.0
+
+
+def fit_pixel_budget(image, min_pixels, max_pixels):
+    """縦横比を保ったまま画素数を[min_pixels, max_pixels]に収める"""
+    pixels = image.width * image.height
+    if pixels > max_pixels:
+        scale = math.sqrt(max_pixels / pixels)
+        resample = Image.LANCZOS
+    elif pixels < min_pixels:
+        scale = math.sqrt(min_pixels / pixels)
+        resample = Image.BICUBIC
+    else:
+        return image
+    size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+    return image.resize(size, resample)
+
+
+def choose_deepseek_mode(density, width, height):
+    """テキスト密度と画像サイズからDeepSeek-OCRの解像度モードを選ぶ"""
+    if density < LOW_DENSITY_THRESHOLD:
+        return "small"
+    if density >= HIGH_DENSITY_THRESHOLD or max(width, height) > 1280:
+        return "gundam"
+    return "base"
+
+
+def preprocess_image(image, min_pixels=None, max_pixels=None, trim=None):
+    """
+    推論前の前処理（余白除去→テキスト密度の推定→画素数予算への縮小・拡大）
+
+    (処理後の画像, 選択したパラメータのdict) を返す
+    """
+    min_pixels = MIN_PIXELS if min_pixels is None else min_pixels
+    max_pixels = MAX_PIXELS if max_pixels is None else max_pixels
+    trim = TRIM_MARGINS if trim is None else trim
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    info = {"original_size": [image.width, image.height]}
+
+    trimmed_box = None
+    if trim:
+        image, trimmed_box = trim_margins(image)
+    info["trimmed_box"] = list(trimmed_box) if trimmed_box else None
+
+    density = estimate_text_density(image)
+    low_density = density < LOW_DENSITY_THRESHOLD
+    info["text_density"] = round(density, 4)
+    info["low_density"] = low_density
+
+    # テキストの少ない画像は予算を絞り、大きな写真でも少ない画素数で処理する
+    budget = int(max_pixels * LOW_DENSITY_BUDGET_RATIO) if low_density else max_pixels
+    budget = max(budget, min_pixels)
+    image = fit_pixel_budget(image, min_pixels, budget)
+    info["pixel_budget"] = [min_pixels, budget]
+    info["size"] = [image.width, image.height]
+    info["deepseek_mode"] = choose_deepseek_mode(density, image.width, image.height)
+    return image, info
+
+
+def preprocess_settings():
+    """キャッシュキーに含める前処理の設定値"""
+    return {
+        "min_pixels": MIN_PIXELS,
+        "max_pixels": MAX_PIXELS,
+        "trim": TRIM_MARGINS,
+        "low_density": LOW_DENSITY_THRESHOLD,
+        "high_density": HIGH_DENSITY_THRESHOLD,
+        "low_density_ratio": LOW_DENSITY_BUDGET_RATIO,
+    }
@@ -0,0 +1,183 @@
+"""
+固定の指示文（プロンプト）のテンプレート展開・トークナイズを起動時に1回だけ行う
+
+- Qwen3-VL: チャットテンプレートは画像に依存しないため展開済みの文字列を使い回し、
+  画像トークンの前後を事前にトークナイズしておく。リクエストごとの処理は画像の前処理と、
+  画像トークン（<|image_pad|>）をグリッドに応じた個数だけ並べることのみになる
+- DeepSeek-OCR: model.infer内でプロンプトの各部分がトークナイズされるため、
+  短い文字列のencode結果を記憶するトークナイザーを渡す
+
+    OCR_PRETOKENIZED_PROMPT=0 python app.py   # 従来どおりリクエストごとにprocessorでトークナイズ
+
+起動時に通常のprocessorの出力と一致するかを確認し、一致しない場合は従来の処理に戻す
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from PIL import Image
+from transformers import BatchFeature
+
+# 1の場合は事前に展開・トークナイズしたプロンプトを使う
+PRETOKENIZED_PROMPT = os.environ.get("OCR_PRETOKENIZED_PROMPT", "1") == "1"
+
+# 起動時の一致確認に使う画像の大きさ（縦横比の異なる2枚でパディングも確認する）
+SELF_CHECK_SIZES = ((96, 64), (64, 160))
+# encode結果を記憶する文字列の最大長と件数（プロンプトの断片のみを対象にする）
+ENCODE_CACHE_MAX_CHARS = 512
+ENCODE_CACHE_MAX_ENTRIES = 64
+
+
+class PretokenizedPrompt:
+    """
+    画像1枚＋固定の指示文からなるモデル入力を作る（processor(text=..., images=...)の代わり）
+
+    build_messages(image)は画像を受け取りチャット形式のメッセージを返す関数
+    """
+
+    def __init__(self, processor, build_messages, enabled=PRETOKENIZED_PROMPT):
+        self.processor = processor
+        # テンプレートの展開結果は画像の内容・大きさによらない
+        self.template = processor.apply_chat_template(
+            build_messages(Image.new("RGB", SELF_CHECK_SIZES[0], "white")),
+            tokenize=False,
+            add_generation_prompt=True
+        )
+        self.enabled = False
+        self.prefix_ids = self.suffix_ids = None
+        self.check_ms = None
+        if enabled:
+            try:
+                self.enabled = self._prepare()
+            except Exception as e:
+                print(f"プロンプトの事前トークナイズを使用しません: {type(e).__name__}: {e}")
+
+    def _prepare(self):
+        image_token = getattr(self.processor, "image_token", None)
+        image_processor = getattr(self.processor, "image_processor", None)
+        if image_token is None or image_processor is None or self.template.count(image_token) != 1:
+            print("プロンプトの事前トークナイズを使用しません（このprocessorには対応していません）")
+            return False
+
+        tokenizer = self.processor.tokenizer
+        prefix, suffix = self.template.split(image_token)
+        self.prefix_ids = tokenizer.encode(prefix, add_special_tokens=False)
+        self.suffix_ids = tokenizer.encode(suffix, add_special_tokens=False)
+        self.image_token_id = tokenizer.convert_tokens_to_ids(image_token)
+        self.merge_length = image_processor.merge_size ** 2
+        return self._self_check()
+
+    def _self_check(self):
+        """通常のprocessorと同じ入力になるかを確認し、それぞれの所要時間を記録する"""
+        images = [Image.new("RGB", size, "white") for size in SELF_CHECK_SIZES]
+        started = time.perf_counter()
+        expected = self._processor_inputs(images)
+        processor_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        actual = self._pretokenized_inputs(images)
+        pretokenized_ms = (time.perf_counter() - started) * 1000
+
+        if set(expected.keys()) != set(actual.keys()) or not all(
+            torch.equal(expected[key], actual[key]) for key in expected.keys()
+        ):
+            print("プロンプトの事前トークナイズを使用しません（processorの出力と一致しません）")
+            return False
+        self.check_ms = {"processor": round(processor_ms, 3), "pretokenized": round(pretokenized_ms, 3)}
+        print(
+            f"プロンプトを事前トークナイズしました (指示文 {len(self.suffix_ids)}トークン, "
+            f"入力作成 {processor_ms:.1f}ms -> {pretokenized_ms:.1f}ms)"
+        )
+        return True
+
+    def _processor_inputs(self, images):
+        return self.processor(
+            text=[self.template] * len(images),
+            images=images,
+            padding=True,
+            return_tensors="pt"
+        )
+
+    def _pretokenized_inputs(self, images):
+        image_inputs = self.processor.image_processor(images=images, return_tensors="pt")
+        rows = [
+            self.prefix_ids + [self.image_token_id] * int(grid.prod() // self.merge_length) + self.suffix_ids
+            for grid in image_inputs["image_grid_thw"]
+        ]
+        width = max(len(row) for row in rows)
+        pad = self.processor.tokenizer.pad_token_id
+        left = self.processor.tokenizer.padding_side == "left"
+        input_ids, attention_mask = [], []
+        for row in rows:
+            fill = width - len(row)
+            input_ids.append([pad] * fill + row if left else row + [pad] * fill)
+            attention_mask.append([0] * fill + [1] * len(row) if left else [1] * len(row) + [0] * fill)
+        return BatchFeature(data={
+            "input_ids": torch.tensor(input_ids),
+            "attention_mask": torch.tensor(attention_mask),
+            **image_inputs,
+        })
+
+    def __call__(self, images):
+        """画像のリストからモデル入力を作成（バッチ内は左右どちらかに詰めてパディング）"""
+        if self.enabled:
+            return self._pretokenized_inputs(images)
+        return self._processor_inputs(images)
+
+    def stats(self):
+        return {
+            "pretokenized": self.enabled,
+            "prefix_tokens": len(self.prefix_ids) if self.enabled else None,
+            "suffix_tokens": len(self.suffix_ids) if self.enabled else None,
+            "self_check_ms": self.check_ms,
+        }
+
+
+class CachedEncodeTokenizer:
+    """
+    短い文字列のencode結果を記憶するトークナイザーのラッパー（それ以外は元のトークナイザーに委譲）
+
+    model.inferのように内部で毎回同じプロンプト断片をトークナイズする処理に渡す
+    """
+
+    def __init__(self, tokenizer, max_chars=ENCODE_CACHE_MAX_CHARS, max_entries=ENCODE_CACHE_MAX_ENTRIES):
+        self._tokenizer = tokenizer
+        self._max_chars = max_chars
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self._tokenizer, name)
+
+    def __call__(self, *args, **kwargs):
+        return self._tokenizer(*args, **kwargs)
+
+    def __len__(self):
+        return len(self._tokenizer)
+
+    def encode(self, text, *args, **kwargs):
+        if args or "return_tensors" in kwargs or not isinstance(text, str) or len(text) > self._max_chars:
+            return self._tokenizer.encode(text, *args, **kwargs)
+        key = (text, tuple(sorted(kwargs.items())))
+        with self._lock:
+            ids = self._entries.get(key)
+            if ids is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if ids is None:
+            ids = self._tokenizer.encode(text, **kwargs)
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = ids
+                if len(self._entries) > self._max_entries:
+                    self._entries.popitem(last=False)
+        # 呼び出し側で変更されても記憶した結果が壊れないようにコピーを返す
+        return list(ids)
+
+    def stats(self):
+        with self._lock:
+            return {"pretokenized": True, "entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,127 @@
+"""
+CPU推論用のint8動的量子化
+
+nn.Linearの重みをint8で保持し、活性化は推論時に行ごとに量子化する（torch.ao.quantization.quantize_dynamic）
+デコードはメモリ帯域律速のため、重みが1/4になることでトークン生成も速くなる
+
+    OCR_QUANTIZE=int8 python app.py                  # テキスト側のLinearのみint8（画像エンコーダはfloat32のまま）
+    OCR_QUANTIZE=int8 OCR_QUANTIZE_VISION=1 python app.py   # 画像エンコーダも含めてint8
+
+精度の確認は benchmarks/quantization_accuracy.py で行う
+"""
+import os
+
+import torch
+
+# off: 量子化しない / int8: Linearの重みをint8に動的量子化
+QUANTIZE_MODE = os.environ.get("OCR_QUANTIZE", "off")
+# 1の場合は画像エンコーダ（と射影層）も量子化する（既定では精度を優先してfloat32のまま）
+QUANTIZE_VISION = os.environ.get("OCR_QUANTIZE_VISION", "0") == "1"
+# 追加で量子化対象外とするモジュール（カンマ区切り、"mlp"のような名前の要素または"model.layers.0"のような部分パス）
+EXTRA_SKIP = [name for name in os.environ.get("OCR_QUANTIZE_SKIP", "").split(",") if name]
+
+# 画像エンコーダ側のモジュール名（Qwen3-VL: visual、DeepSeek-OCR: sam_model/vision_model/projector）
+VISION_MODULE_NAMES = ("visual", "sam_model", "vision_model", "clip_model", "projector")
+# 出力層は誤差が直接トークン選択に効くうえ、埋め込みと重みを共有していると量子化してもメモリが減らない
+DEFAULT_SKIP_NAMES = ("lm_head",)
+
+
+def _select_engine():
+    """CPUに合った量子化エンジンを選ぶ（x86: fbgemm、ARM: qnnpack）"""
+    engines = torch.backends.quantized.supported_engines
+    for engine in ("fbgemm", "x86", "qnnpack"):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError(f"int8の量子化エンジンが利用できません (対応エンジン: {engines})")
+
+
+def _skipped(name, skip_names):
+    parts = name.split(".")
+    return any(skip in parts or (("." in skip) and skip in name) for skip in skip_names)
+
+
+def quantizable_linear_names(model, quantize_vision=False, skip=()):
+    """量子化対象のnn.Linearの名前と、除外したものの名前を返す"""
+    skip_names = tuple(DEFAULT_SKIP_NAMES) + tuple(skip)
+    if not quantize_vision:
+        skip_names += VISION_MODULE_NAMES
+    selected, skipped = [], []
+    for name, module in model.named_modules():
+        if type(module) is not torch.nn.Linear:
+            continue
+        (skipped if _skipped(name, skip_names) else selected).append(name)
+    return selected, skipped
+
+
+def model_size_bytes(model):
+    """state_dictのテンソルの合計バイト数（共有している重みは1回だけ数える）"""
+    seen = set()
+
+    def size(value):
+        if isinstance(value, (tuple, list)):
+            return sum(size(item) for item in value)
+        if not isinstance(value, torch.Tensor):
+            return 0
+        key = (value.data_ptr(), value.nelement(), value.dtype)
+        if key in seen:
+            return 0
+        seen.add(key)
+        return value.nelement() * value.element_size()
+
+    return sum(size(value) for value in model.state_dict().values())
+
+
+def quantize_model(model, quantize_vision=False, skip=(), verbose=True):
+    """
+    モデルのnn.Linearをその場でint8の動的量子化Linearに置き換える
+
+    戻り値: {"engine": 量子化エンジン, "quantized": 置き換えた数, "skipped": 除外した数,
+            "size_before": バイト数, "size_after": バイト数}
+    """
+    engine = _select_engine()
+    selected, skipped = quantizable_linear_names(model, quantize_vision=quantize_vision, skip=skip)
+    size_before = model_size_bytes(model)
+    if selected:
+        qconfig = torch.ao.quantization.default_dynamic_qconfig
+        torch.ao.quantization.quantize_dynamic(
+            model,
+            qconfig_spec={name: qconfig for name in selected},
+            dtype=torch.qint8,
+            inplace=True,
+        )
+    summary = {
+        "engine": engine,
+        "quantized": len(selected),
+        "skipped": len(skipped),
+        "size_before": size_before,
+        "size_after": model_size_bytes(model),
+    }
+    if verbose:
+        print(
+            f"int8動的量子化: Linear {summary['quantized']}個を変換、{summary['skipped']}個を除外 "
+            f"({size_before / 1024 ** 2:.0f}MiB -> {summary['size_after'] / 1024 ** 2:.0f}MiB, エンジン: {engine})"
+        )
+    return summary
+
+
+def quantization_label(mode=None, quantize_vision=None):
+    """キャッシュキー・ヘルスチェックに含める量子化の設定（量子化しない場合は"off"）"""
+    mode = QUANTIZE_MODE if mode is None else mode
+    quantize_vision = QUANTIZE_VISION if quantize_vision is None else quantize_vision
+    if mode == "off":
+        return "off"
+    return f"{mode}+vision" if quantize_vision else mode
+
+
+def quantize_from_env(model):
+    """環境変数の設定に従って量子化し、適用した設定のラベルを返す（GPU環境では何もしない）"""
+    if QUANTIZE_MODE == "off":
+        return "off"
+    if QUANTIZE_MODE != "int8":
+        raise ValueError(f"OCR_QUANTIZEにはoffまたはint8を指定してください: {QUANTIZE_MODE}")
+    if torch.cuda.is_available():
+        print("GPU環境のため量子化は行いません")
+        return "off"
+    quantize_model(model, quantize_vision=QUANTIZE_VISION, skip=EXTRA_SKIP)
+    return quantization_label()
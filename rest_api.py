@@ -0,0 +1,290 @@
+import asyncio
+import io
+import json
+import os
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from PIL import Image, ImageOps
+from starlette.concurrency import run_in_threadpool
+from starlette.formparsers import MultiPartParser
+
+from admission import UI_QUEUE_MAX_SIZE, AdmissionRejected, client_id
+from job_queue import FINAL_STATUSES, RESULT_IMAGE, RESULT_TEXT, SUCCEEDED, JobQueueFull
+from metrics import REGISTRY, RequestTrace
+from model_registry import ModelNotReady
+
+# Keep-Aliveの保持時間（Cloud Runのロードバランサより長くする）
+KEEPALIVE_SECONDS = int(os.environ.get("OCR_KEEPALIVE_SECONDS", "75"))
+
+# アップロードサイズの上限
+MAX_UPLOAD_BYTES = int(os.environ.get("OCR_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+# multipartの区切り・ヘッダー・パラメータの分として、画像の上限に加えて受け付けるバイト数
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# ジョブの状態を通知するServer-Sent Eventsの確認間隔と、無通信を避けるためのコメントの送信間隔（秒）
+JOB_EVENTS_POLL_SECONDS = 1.0
+JOB_EVENTS_HEARTBEAT_SECONDS = 15.0
+
+
+class UploadTooLarge(Exception):
+    """アップロードがMAX_UPLOAD_BYTESを超えている（読み込みの途中で打ち切る）"""
+
+
+def error_response(status, message, headers=None):
+    return JSONResponse({"error": message}, status_code=status, headers=headers)
+
+
+def too_large_response():
+    return error_response(413, f"画像サイズが上限（{MAX_UPLOAD_BYTES}バイト）を超えています")
+
+
+def decode_image(data):
+    """アップロードされたバイト列をPIL Imageにデコード（EXIFの向きを反映）"""
+    with Image.open(io.BytesIO(data)) as image:
+        return ImageOps.exif_transpose(image).convert("RGB")
+
+
+async def read_body(request, limit):
+    """
+    リクエスト本文を読み込む（limitバイトを超えたらUploadTooLargeを送出）
+
+    Content-Lengthで超えているとわかる場合は読まずに、わからない場合は読みながら上限を確認する
+    """
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > limit:
+        raise UploadTooLarge()
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > limit:
+            raise UploadTooLarge()
+    return bytes(body)
+
+
+async def read_upload(request):
+    """
+    multipart（file/imageフィールド）または生のバイト列から画像とパラメータを取り出す
+
+    画像がMAX_UPLOAD_BYTESを超える場合は、本文を読み切る前にUploadTooLargeを送出する
+    """
+    params = dict(request.query_params)
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        body = await read_body(request, MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES)
+
+        async def stream():
+            yield body
+
+        form = await MultiPartParser(request.headers, stream()).parse()
+        try:
+            upload = form.get("file") or form.get("image")
+            data = await upload.read() if upload is not None and hasattr(upload, "read") else b""
+            for key, value in form.items():
+                if isinstance(value, str):
+                    params.setdefault(key, value)
+        finally:
+            await form.close()
+    else:
+        data = await read_body(request, MAX_UPLOAD_BYTES)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise UploadTooLarge()
+    return data, params
+
+
+def rejected_response(error):
+    headers = {"Retry-After": str(error.retry_after)} if error.retry_after else None
+    return error_response(error.status, str(error), headers)
+
+
+def create_api(ocr_fn, health_fn, title, app_name, admission=None, jobs=None):
+    """
+    Gradio UIと同じプロセス・同じモデルを使うHTTP APIを作成
+
+    ocr_fn(image, params, trace, ticket) -> JSON化可能なdict（不正なパラメータはValueErrorを送出）
+    health_fn() -> {"ready": bool, ...}（/healthzはモデルの準備ができるまで503、/livezは常に200）
+    admissionを渡した場合は画像のデコード前に受付判定を行い、混雑時は429/503で即座に返す
+    jobs（job_queue.JobQueue）を渡した場合は非同期ジョブのAPI（/api/jobs）も提供する
+    """
+    api = FastAPI(title=title)
+
+    @api.get("/metrics")
+    def metrics():
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    @api.get("/healthz")
+    def healthz():
+        info = health_fn()
+        return JSONResponse(info, status_code=200 if info.get("ready") else 503)
+
+    @api.get("/livez")
+    def livez():
+        return JSONResponse({"alive": True})
+
+    @api.post("/api/ocr")
+    async def ocr(request: Request):
+        started = time.perf_counter()
+        try:
+            data, params = await read_upload(request)
+        except UploadTooLarge:
+            return too_large_response()
+        if not data:
+            return error_response(400, "画像が送信されていません（multipartのfileフィールドまたはリクエスト本文で送信してください）")
+
+        ticket = None
+        if admission is not None:
+            try:
+                ticket = admission.acquire(client_id(request))
+            except AdmissionRejected as e:
+                return rejected_response(e)
+
+        trace = RequestTrace(app_name)
+        status = "error"
+        try:
+            try:
+                image = await run_in_threadpool(decode_image, data)
+            except Exception as e:
+                status = "bad_request"
+                return error_response(400, f"画像をデコードできません: {e}")
+            decoded = time.perf_counter()
+            trace.add("upload_decode", decoded - started)
+
+            try:
+                result = await run_in_threadpool(ocr_fn, image, params, trace, ticket)
+            except ValueError as e:
+                status = "bad_request"
+                return error_response(400, str(e))
+            except ModelNotReady as e:
+                status = "not_ready"
+                return error_response(e.status, str(e), {"Retry-After": str(e.retry_after)})
+            except Exception as e:
+                print(f"APIでエラーが発生しました: {e}")
+                return error_response(500, f"エラーが発生しました: {e}")
+
+            status = "cached" if result.get("cached") else "ok"
+            finished = time.perf_counter()
+            timings = dict(result.get("timings") or {})
+            timings.update(
+                decode_ms=round((decoded - started) * 1000, 2),
+                ocr_ms=round((finished - decoded) * 1000, 2),
+                total_ms=round((finished - started) * 1000, 2),
+                stages_ms=trace.summary(),
+            )
+            result["timings"] = timings
+            return JSONResponse(result)
+        finally:
+            trace.finish(status)
+            if ticket is not None:
+                ticket.measured = status == "ok"
+                admission.release(ticket)
+
+    if jobs is not None:
+        add_job_routes(api, jobs)
+
+    return api
+
+
+def add_job_routes(api, jobs):
+    """非同期ジョブのAPI（登録・状態・結果・状態変化の通知）を追加"""
+
+    def job_or_404(job_id):
+        job = jobs.store.get(job_id)
+        if job is None:
+            return None, error_response(404, "ジョブが見つかりません")
+        return job, None
+
+    def base_url(request):
+        return str(request.base_url).rstrip("/")
+
+    @api.post("/api/jobs")
+    async def submit_job(request: Request):
+        try:
+            data, params = await read_upload(request)
+        except UploadTooLarge:
+            return too_large_response()
+        if not data:
+            return error_response(400, "画像が送信されていません（multipartのfileフィールドまたはリクエスト本文で送信してください）")
+        # 壊れた画像はジョブとして登録せずにすぐ返す
+        try:
+            await run_in_threadpool(decode_image, data)
+        except Exception as e:
+            return error_response(400, f"画像をデコードできません: {e}")
+
+        try:
+            job, created = await run_in_threadpool(
+                jobs.submit, data, params, client_id(request), request.headers.get("idempotency-key")
+            )
+        except JobQueueFull as e:
+            return error_response(503, str(e), {"Retry-After": "60"})
+        except AdmissionRejected as e:
+            return rejected_response(e)
+        info = jobs.describe(job, base_url(request))
+        return JSONResponse(info, status_code=202 if created else 200, headers={"Location": info["status_url"]})
+
+    @api.get("/api/jobs/{job_id}")
+    def job_status(job_id: str, request: Request):
+        job, error = job_or_404(job_id)
+        if error is not None:
+            return error
+        return JSONResponse(jobs.describe(job, base_url(request)))
+
+    @api.get("/api/jobs/{job_id}/result")
+    def job_result(job_id: str):
+        job, error = job_or_404(job_id)
+        if error is not None:
+            return error
+        if job["status"] != SUCCEEDED:
+            return error_response(409, f"ジョブは完了していません（状態: {job['status']}）")
+        with open(jobs.store.file_path(job_id, RESULT_TEXT), encoding="utf-8") as f:
+            return PlainTextResponse(f.read(), media_type="text/markdown; charset=utf-8")
+
+    @api.get("/api/jobs/{job_id}/image")
+    def job_image(job_id: str):
+        job, error = job_or_404(job_id)
+        if error is not None:
+            return error
+        path = jobs.store.file_path(job_id, RESULT_IMAGE) if job["status"] == SUCCEEDED else None
+        if path is None:
+            return error_response(404, "検出結果画像はありません")
+        return FileResponse(path, media_type="image/jpeg", filename=RESULT_IMAGE)
+
+    @api.get("/api/jobs/{job_id}/events")
+    async def job_events(job_id: str, request: Request):
+        _job, error = job_or_404(job_id)
+        if error is not None:
+            return error
+        url = base_url(request)
+
+        async def events():
+            last = None
+            last_sent = time.monotonic()
+            while True:
+                current = await run_in_threadpool(jobs.store.get, job_id)
+                if current is None:
+                    yield "event: error\ndata: {\"error\": \"ジョブが削除されました\"}\n\n"
+                    return
+                info = jobs.describe(current, url)
+                state = (current["status"], current["progress"], current["message"])
+                if state != last:
+                    last, last_sent = state, time.monotonic()
+                    yield f"event: {current['status']}\ndata: {json.dumps(info, ensure_ascii=False)}\n\n"
+                elif time.monotonic() - last_sent >= JOB_EVENTS_HEARTBEAT_SECONDS:
+                    last_sent = time.monotonic()
+                    yield ": keep-alive\n\n"
+                if current["status"] in FINAL_STATUSES or await request.is_disconnected():
+                    return
+                await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def serve(demo, api, port):
+    """Gradio UIをAPIと同じサーバーにマウントして起動"""
+    import gradio as gr
+    import uvicorn
+
+    # Gradio側の待ち行列も上限を設け、溢れた分は待たせずにエラーを返す
+    demo.queue(max_size=UI_QUEUE_MAX_SIZE)
+    app = gr.mount_gradio_app(api, demo, path="/")
+    uvicorn.run(app, host="0.0.0.0", port=port, timeout_keep_alive=KEEPALIVE_SECONDS)
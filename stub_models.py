@@ -0,0 +1,263 @@
+"""
+ベンチマーク・動作確認用のスタブモデル（重みのダウンロード不要、CPUのみで動作）
+
+    OCR_MODEL_BACKEND=stub python app.py
+    OCR_MODEL_BACKEND=stub python deepseekuse_gradio.py
+
+実モデルと同じ呼び出し方（processor/generate、tokenizer/infer）に対応し、
+画像の内容から決まる疑似テキストを返す。処理時間は画素数・生成トークン数に比例した
+待ち時間で再現するため、同じ入力なら毎回同じ結果・ほぼ同じ時間になる
+"""
+import math
+import os
+import random
+import string
+import threading
+import time
+import zlib
+
+import torch
+from PIL import Image
+from transformers import BatchFeature
+
+# 生成1トークンあたりの時間（ミリ秒）
+TOKEN_MS = float(os.environ.get("OCR_STUB_TOKEN_MS", "2"))
+# prefillの時間（Qwen3-VLは100万画素あたり、DeepSeek-OCRは視覚トークン100個あたりのミリ秒）
+PREFILL_MS = float(os.environ.get("OCR_STUB_PREFILL_MS", "40"))
+# バッチに1行増えるごとに増えるデコード時間の割合（バッチ推論の効果を再現する）
+BATCH_DECODE_COST = float(os.environ.get("OCR_STUB_BATCH_DECODE_COST", "0.15"))
+
+WORDS = (
+    "請求書", "合計", "金額", "日付", "株式会社", "御中", "税込", "数量", "単価", "備考",
+    "invoice", "total", "amount", "date", "page", "section", "summary", "table", "item", "note",
+)
+THUMBNAIL_SIZE = 16
+# 疑似テキストの最大トークン数（実際の出力はmax_new_tokensで打ち切られる）
+MAX_INFER_TOKENS = 2048
+
+
+class StubTokenizer:
+    """1文字を1トークンとして扱うトークナイザー（未知の文字は語彙に追加する）"""
+
+    pad_token_id = 0
+    eos_token_id = 1
+
+    def __init__(self):
+        self.padding_side = "right"
+        self._chars = ["", ""]
+        self._ids = {}
+        self._lock = threading.Lock()
+        for char in string.printable + "".join(WORDS):
+            self._token_id(char)
+
+    def _token_id(self, char):
+        token_id = self._ids.get(char)
+        if token_id is None:
+            with self._lock:
+                token_id = self._ids.get(char)
+                if token_id is None:
+                    token_id = self._ids[char] = len(self._chars)
+                    self._chars.append(char)
+        return token_id
+
+    def encode(self, text, add_special_tokens=False):
+        return [self._token_id(char) for char in text]
+
+    def decode(self, token_ids, skip_special_tokens=True, **kwargs):
+        if isinstance(token_ids, torch.Tensor):
+            token_ids = token_ids.tolist()
+        return "".join(self._chars[i] for i in token_ids if i > self.eos_token_id)
+
+
+def _thumbnail(image):
+    thumb = image.convert("L").resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR)
+    return torch.tensor(list(thumb.getdata()), dtype=torch.uint8)
+
+
+def _pseudo_text(thumbnail, max_tokens):
+    """縮小画像から決まる疑似テキスト（暗い画素が多いほど長くなる）"""
+    seed = zlib.crc32(bytes(thumbnail.tolist()))
+    ink = float((thumbnail < 128).float().mean())
+    length = min(max_tokens, 16 + int(ink * 4 * max_tokens))
+    rng = random.Random(seed)
+    text = ""
+    while len(text) < length:
+        text += rng.choice(WORDS) + ("\n" if rng.random() < 0.15 else " ")
+    return text[:length].strip()
+
+
+def _grounded_text(text):
+    """疑似テキストの各行に<|grounding|>の参照領域（上から順に並べた座標）を付ける"""
+    lines = [line for line in text.splitlines() if line.strip()]
+    blocks = []
+    for index, line in enumerate(lines):
+        top = index * 999 // len(lines)
+        bottom = (index + 1) * 999 // len(lines)
+        label = "title" if index == 0 else "text"
+        blocks.append(f"<|ref|>{label}<|/ref|><|det|>[[20, {top}, 979, {bottom}]]<|/det|>\n{line.strip()}")
+    return "\n\n".join(blocks)
+
+
+def _sleep_ms(ms):
+    if ms > 0:
+        time.sleep(ms / 1000.0)
+
+
+def _decode_loop(input_ids, targets, pad_token_id, max_new_tokens, stopping_criteria=None, streamer=None):
+    """
+    行ごとの目標トークン列を1トークンずつ出力する（generateのデコード部分の代わり）
+
+    max_new_tokensで打ち切り、stopping_criteriaが終了と判定した行は実モデルと同じく以降をパディングで埋める
+    """
+    steps = min(max_new_tokens, max(len(target) for target in targets))
+    step_ms = TOKEN_MS * (1 + BATCH_DECODE_COST * (len(targets) - 1))
+    finished = [False] * len(targets)
+    generated = []
+    for step in range(steps):
+        _sleep_ms(step_ms)
+        column = torch.tensor([
+            target[step] if step < len(target) and not done else pad_token_id
+            for target, done in zip(targets, finished)
+        ])
+        generated.append(column)
+        if streamer is not None:
+            streamer.put(column)
+        for row, target in enumerate(targets):
+            if step + 1 >= len(target):
+                finished[row] = True
+        if stopping_criteria is not None:
+            stopped = stopping_criteria(torch.cat([input_ids, torch.stack(generated, dim=1)], dim=1), None)
+            finished = [done or bool(stop) for done, stop in zip(finished, stopped)]
+        if all(finished):
+            break
+
+    if streamer is not None:
+        streamer.end()
+    return torch.cat([input_ids, torch.stack(generated, dim=1)], dim=1)
+
+
+class StubQwenProcessor:
+    """Qwen3-VLのAutoProcessorの代わり（apply_chat_template/__call__/batch_decode）"""
+
+    def __init__(self):
+        self.tokenizer = StubTokenizer()
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        text = "".join(
+            part.get("text", "<image>")
+            for message in messages
+            for part in message["content"]
+        )
+        return f"user\n{text}\nassistant\n" if add_generation_prompt else f"user\n{text}\n"
+
+    def __call__(self, text, images, padding=True, return_tensors="pt"):
+        rows = [self.tokenizer.encode(prompt) for prompt in text]
+        width = max(len(row) for row in rows)
+        pad = self.tokenizer.pad_token_id
+        input_ids, attention_mask = [], []
+        for row in rows:
+            fill = [pad] * (width - len(row))
+            mask = [1] * len(row)
+            if self.tokenizer.padding_side == "left":
+                input_ids.append(fill + row)
+                attention_mask.append([0] * len(fill) + mask)
+            else:
+                input_ids.append(row + fill)
+                attention_mask.append(mask + [0] * len(fill))
+        return BatchFeature(data={
+            "input_ids": torch.tensor(input_ids),
+            "attention_mask": torch.tensor(attention_mask),
+            "pixel_values": torch.stack([_thumbnail(image) for image in images]),
+            "image_pixels": torch.tensor([image.width * image.height for image in images]),
+        })
+
+    def batch_decode(self, sequences, **kwargs):
+        return [self.tokenizer.decode(ids, **kwargs) for ids in sequences]
+
+
+class StubQwenModel(torch.nn.Module):
+    """Qwen3VLForConditionalGeneration.generateの代わり"""
+
+    def __init__(self, tokenizer):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.proj = torch.nn.Linear(4, 4)
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    def generate(self, input_ids, pixel_values, image_pixels, max_new_tokens=512, streamer=None,
+                 stopping_criteria=None, **kwargs):
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+
+        # prefillは画素数に比例
+        _sleep_ms(PREFILL_MS * float(image_pixels.sum()) / 1e6)
+
+        # 疑似テキストの長さは上限によらず画像で決まり、上限を超える分は打ち切られる
+        targets = [
+            self.tokenizer.encode(_pseudo_text(thumb, MAX_INFER_TOKENS)) + [self.tokenizer.eos_token_id]
+            for thumb in pixel_values
+        ]
+        return _decode_loop(input_ids, targets, self.tokenizer.pad_token_id, max_new_tokens, stopping_criteria, streamer)
+
+
+class StubDeepSeekModel(torch.nn.Module):
+    """DeepSeek-OCRのmodel.inferの代わり（eval_modeでの生の出力と、結果ファイルの書き出しを再現）"""
+
+    def __init__(self, tokenizer):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.proj = torch.nn.Linear(4, 4)
+
+    def generate(self, input_ids, images=None, max_new_tokens=MAX_INFER_TOKENS, stopping_criteria=None,
+                 grounding=False, **kwargs):
+        # imagesは縮小画像（疑似テキストの元）のリスト
+        texts = [_pseudo_text(thumb, MAX_INFER_TOKENS) for thumb in images]
+        if grounding:
+            texts = [_grounded_text(text) for text in texts]
+        targets = [self.tokenizer.encode(text) + [self.tokenizer.eos_token_id] for text in texts]
+        return _decode_loop(input_ids, targets, self.tokenizer.pad_token_id, max_new_tokens, stopping_criteria)
+
+    def infer(self, tokenizer, prompt="", image_file=None, output_path=None, base_size=1024,
+              image_size=640, crop_mode=True, save_results=False, test_compress=False, eval_mode=False, **kwargs):
+        with Image.open(image_file) as image:
+            image = image.convert("RGB")
+
+        # 視覚トークン数は全体画像（base_size）とクロップしたタイル（image_size）の合計
+        vision_tokens = (base_size // 64) ** 2
+        if crop_mode:
+            tiles = min(9, math.ceil(image.width / image_size) * math.ceil(image.height / image_size))
+            vision_tokens += tiles * (image_size // 64) ** 2
+        _sleep_ms(PREFILL_MS * vision_tokens / 100)
+
+        # 実モデルと同じくself.generateを呼ぶ（生成トークン数の上限・繰り返し検出の差し替えが効く）
+        input_ids = torch.tensor([tokenizer.encode(prompt)], dtype=torch.long)
+        output_ids = self.generate(input_ids, images=[_thumbnail(image)], max_new_tokens=MAX_INFER_TOKENS,
+                                   eos_token_id=tokenizer.eos_token_id, grounding="<|grounding|>" in prompt)
+        text = tokenizer.decode(output_ids[0, input_ids.shape[1]:])
+        if eval_mode:
+            return text
+
+        if save_results and output_path:
+            from ocr_artifacts import parse_output, place_regions, render_boxes
+
+            markdown, regions = parse_output(text)
+            with open(os.path.join(output_path, "result.mmd"), "w", encoding="utf-8") as f:
+                f.write(markdown)
+            boxes = place_regions(regions, (0, 0, image.width, image.height))
+            render_boxes(image, boxes).save(os.path.join(output_path, "result_with_boxes.jpg"), quality=80)
+        return text
+
+
+def load_stub_qwen():
+    """(processor, model) を返す"""
+    processor = StubQwenProcessor()
+    return processor, StubQwenModel(processor.tokenizer).eval()
+
+
+def load_stub_deepseek():
+    """(tokenizer, model) を返す"""
+    tokenizer = StubTokenizer()
+    return tokenizer, StubDeepSeekModel(tokenizer).eval()
@@ -0,0 +1,85 @@
+"""AdmissionController: 上限による拒否・縮退と、処理間隔の指数移動平均"""
+import pytest
+
+import admission
+from admission import AdmissionController, AdmissionRejected, client_id
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    return clock
+
+
+def test_service_interval_follows_ewma(clock):
+    controller = AdmissionController("test", max_queue=0, max_per_client=0, slo_seconds=0,
+                                     initial_service_seconds=10.0)
+    first, second = controller.acquire(), controller.acquire()
+    clock.now += 4.0
+    controller.release(first)
+    assert controller.service_interval == pytest.approx(10.0 + admission.EWMA_ALPHA * (4.0 - 10.0))
+    interval = controller.service_interval
+    # 次の完了までの間隔は前の完了から数える
+    clock.now += 2.0
+    controller.release(second)
+    assert controller.service_interval == pytest.approx(interval + admission.EWMA_ALPHA * (2.0 - interval))
+
+
+def test_unmeasured_release_keeps_interval(clock):
+    controller = AdmissionController("test", slo_seconds=0, initial_service_seconds=10.0)
+    ticket = controller.acquire()
+    clock.now += 0.01
+    ticket.measured = False
+    controller.release(ticket)
+    assert controller.service_interval == 10.0
+    assert controller.in_flight == 0
+
+
+def test_slo_degrades_then_rejects(clock):
+    controller = AdmissionController("test", max_queue=0, max_per_client=0, slo_seconds=20, degrade_margin=1.5,
+                                     initial_service_seconds=10.0)
+    # 推定 10秒, 20秒 はSLO内、30秒は縮退、40秒は拒否
+    assert not controller.acquire().degraded
+    assert not controller.acquire().degraded
+    assert controller.acquire().degraded
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire()
+    assert rejected.value.reason == "slo"
+    assert rejected.value.status == 503
+
+
+def test_queue_and_client_limits(clock):
+    controller = AdmissionController("test", max_queue=3, max_per_client=2, slo_seconds=0)
+    controller.acquire("a")
+    controller.acquire("a")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("a")
+    assert rejected.value.status == 429
+    controller.acquire("b")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("c")
+    assert rejected.value.reason == "queue_full"
+
+
+class FakeRequest:
+    def __init__(self, forwarded, host="10.0.0.1"):
+        self.headers = {"x-forwarded-for": forwarded} if forwarded else {}
+        self.client = type("Client", (), {"host": host})()
+
+
+def test_client_id_uses_trusted_hop():
+    # 左側はクライアントが書き換えられるため、右からtrusted_proxies番目を使う
+    request = FakeRequest("1.1.1.1, 2.2.2.2, 3.3.3.3")
+    assert client_id(request, trusted_proxies=1) == "3.3.3.3"
+    assert client_id(request, trusted_proxies=2) == "2.2.2.2"
+    assert client_id(request, trusted_proxies=0) == "10.0.0.1"
+    assert client_id(FakeRequest(None)) == "10.0.0.1"
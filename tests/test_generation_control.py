@@ -0,0 +1,62 @@
+"""find_repetition / find_loop / adaptive_max_new_tokensの閾値の確認（torch・transformersが必要）"""
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+import generation_control as gc
+
+
+def looping(prefix_length, unit, repeats):
+    """新しい内容prefix_lengthトークンの後にunitがrepeats回続くトークン列"""
+    return list(range(1000, 1000 + prefix_length)) + list(unit) * repeats
+
+
+def test_line_loop_is_stopped():
+    unit = [11, 12, 13, 14, 15, 16]
+    repeats = gc.REPETITION_MIN_TOKENS // len(unit) + 2
+    ids = looping(50, unit, repeats)
+    start, period = gc.find_loop(ids)
+    assert period == len(unit)
+    assert start == 50
+    # 繰り返し部分を1回分だけ残すと、新しい内容の直後で切れる
+    assert ids[:start + period] == list(range(1000, 1050)) + unit
+
+
+def test_repetitive_table_passes():
+    # 「0」「同上」のように同じ行が続く表でも、REPETITION_MIN_TOKENSに満たなければ打ち切らない
+    row = [21, 22, 23, 24, 25]
+    repeats = (gc.REPETITION_MIN_TOKENS - 1) // len(row)
+    assert repeats >= gc.REPETITION_MIN_REPEATS
+    assert gc.find_loop(looping(30, row, repeats)) is None
+
+
+def test_loop_needs_min_repeats():
+    # 長い周期の行は範囲が足りていても、REPETITION_MIN_REPEATS回未満なら打ち切らない
+    unit = list(range(100, 100 + gc.REPETITION_MIN_TOKENS // 4))
+    assert gc.find_repetition(looping(10, unit, gc.REPETITION_MIN_REPEATS - 1)) is None
+
+
+def test_short_token_loop_needs_longer_span():
+    # 1トークンの繰り返しは行の繰り返しより長い範囲（TOKEN_LOOP_MIN_TOKENS）を占めるまで許す
+    assert gc.find_loop(looping(20, [7], gc.REPETITION_MIN_TOKENS * 2 - 1)) is None
+    start, period = gc.find_loop(looping(20, [7], gc.TOKEN_LOOP_MIN_TOKENS + 10))
+    assert (start, period) == (20, 1)
+
+
+def test_multiple_of_short_period_is_token_loop():
+    # 周期4でも中身が周期2の繰り返しなら、トークン単位の繰り返しとして扱う
+    ids = looping(20, [7, 8], gc.REPETITION_MIN_TOKENS // 2 + 10)
+    assert gc.find_loop(ids) is None
+
+
+def test_adaptive_max_new_tokens():
+    assert gc.adaptive_max_new_tokens(None, 1024) == 1024
+    assert gc.adaptive_max_new_tokens({}, 1024) == 1024
+    # 文字のない画像でも下限は確保する
+    assert gc.adaptive_max_new_tokens({"text_density": 0.0}, 1024) == gc.MIN_NEW_TOKENS
+    # 文字の多いページは上限で頭打ち
+    assert gc.adaptive_max_new_tokens({"text_density": 1.0}, 1024, cap=2048) == 2048
+    density = 0.01
+    expected = int(density * gc.TOKENS_PER_DENSITY * gc.MAX_TOKENS_MARGIN + 0.999999)
+    assert gc.adaptive_max_new_tokens({"text_density": density}, 1024, cap=100000) == max(gc.MIN_NEW_TOKENS, expected)
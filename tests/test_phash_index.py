@@ -0,0 +1,126 @@
+"""NearDuplicateIndex: 再圧縮した画像は引け、数字1つの違う画像は確認で落ち、古い登録から追い出される"""
+import io
+import random
+
+from PIL import Image, ImageDraw, ImageFont
+
+from ocr_cache import OCRResultCache
+from phash_index import NearDuplicateIndex, fingerprint
+
+SETTINGS = {"model": "test"}
+
+
+def load_font(size):
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
+
+FONT = load_font(22)
+
+
+def invoice(amounts, size=(1240, 1754)):
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    draw.text((80, 60), "INVOICE No. 2024-%04d" % amounts[0], fill="black", font=FONT)
+    for index, amount in enumerate(amounts):
+        y = 200 + index * 40
+        draw.text((80, y), f"Item {index + 1} widget", fill="black", font=FONT)
+        draw.text((900, y), f"{amount:,}", fill="black", font=FONT)
+    draw.text((700, 240 + len(amounts) * 40), f"TOTAL {sum(amounts):,}", fill="black", font=FONT)
+    return image
+
+
+def reencode(image, quality, size=None):
+    if size:
+        image = image.resize(size)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return Image.open(io.BytesIO(buffer.getvalue())).convert("RGB")
+
+
+def amounts(seed):
+    rng = random.Random(seed)
+    return [rng.randint(100, 9999) for _ in range(25)]
+
+
+def indexed(image, index, cache, text):
+    """推論結果を結果キャッシュと索引に登録したときと同じ状態にする"""
+    key = OCRResultCache.make_key(image, **SETTINGS)
+    cache.put(key, {"text": text})
+    _, found = index.find(image, SETTINGS, cache)
+    index.add(found, SETTINGS, key)
+    return key
+
+
+def test_reencoded_image_hits():
+    cache = OCRResultCache(max_entries=16)
+    index = NearDuplicateIndex(max_entries=16)
+    original = invoice(amounts(1))
+    indexed(original, index, cache, "original")
+
+    result, _ = index.find(reencode(original, 50, (1100, 1556)), SETTINGS, cache)
+    assert result is not None
+    assert result["text"] == "original"
+    assert result["near_duplicate"]["distance"] <= index.max_distance
+    assert index.stats()["hits"] == 1
+
+
+def test_changed_digit_is_rejected():
+    cache = OCRResultCache(max_entries=16)
+    index = NearDuplicateIndex(max_entries=16)
+    values = amounts(1)
+    indexed(invoice(values), index, cache, "original")
+
+    changed = values[:5] + [values[5] + 1] + values[6:]
+    result, _ = index.find(reencode(invoice(changed), 90), SETTINGS, cache)
+    # ハッシュは近いが、確認用の2値画像で別の内容と判定する
+    assert result is None
+    assert index.stats()["rejected"] == 1
+
+
+def test_different_document_misses():
+    cache = OCRResultCache(max_entries=16)
+    index = NearDuplicateIndex(max_entries=16)
+    indexed(invoice(amounts(1)), index, cache, "first")
+
+    other = Image.new("RGB", (1240, 1754), "white")
+    draw = ImageDraw.Draw(other)
+    for y in range(100, 1700, 120):
+        draw.rectangle((100, y, 1100, y + 60), fill="black")
+    misses = index.stats()["misses"]
+    result, _ = index.find(other, SETTINGS, cache)
+    assert result is None
+    assert index.stats()["misses"] == misses + 1
+
+
+def test_other_settings_miss():
+    cache = OCRResultCache(max_entries=16)
+    index = NearDuplicateIndex(max_entries=16)
+    original = invoice(amounts(1))
+    indexed(original, index, cache, "original")
+    result, _ = index.find(reencode(original, 90), {"model": "other"}, cache)
+    assert result is None
+
+
+def test_oldest_entries_are_evicted():
+    cache = OCRResultCache(max_entries=16)
+    index = NearDuplicateIndex(max_entries=2)
+    images = [invoice(amounts(seed)) for seed in (1, 2, 3)]
+    for seed, image in enumerate(images):
+        indexed(image, index, cache, f"doc {seed}")
+
+    stats = index.stats()
+    assert stats["entries"] == 2
+    assert stats["evictions"] == 1
+    assert index.find(reencode(images[0], 90), SETTINGS, cache)[0] is None
+    assert index.find(reencode(images[2], 90), SETTINGS, cache)[0]["text"] == "doc 2"
+
+
+def test_blank_image_is_skipped():
+    index = NearDuplicateIndex(max_entries=16)
+    blank = Image.new("RGB", (800, 600), "white")
+    assert fingerprint(blank) is None
+    assert index.find(blank, SETTINGS, OCRResultCache(max_entries=16)) == (None, None)
+    assert index.stats()["skipped"] == 1
@@ -0,0 +1,50 @@
+"""merge_tile_texts: タイルの重なり部分の重複行の除去"""
+from tiling import merge_tile_texts
+
+
+def test_rows_are_interleaved_by_height():
+    texts = {
+        (0, 0): "Name: Yamada Taro\nAddress: Tokyo",
+        (0, 1): "Taro Tel 03-1234\nTokyo Shinjuku",
+    }
+    merged = merge_tile_texts(texts, 1, 2).splitlines()
+    # 同じ高さの行は左のタイルから順に並ぶ
+    assert merged == ["Name: Yamada Taro", "Taro Tel 03-1234", "Address: Tokyo", "Tokyo Shinjuku"]
+
+
+def test_horizontal_duplicate_at_same_height_is_dropped():
+    texts = {
+        (0, 0): "Quarterly report 2024\nRevenue up 12 percent\nCosts flat",
+        (0, 1): "Quarterly report 2024\nRevenue up 12 percent\nMargin improved",
+    }
+    merged = merge_tile_texts(texts, 1, 2).splitlines()
+    assert merged.count("Quarterly report 2024") == 1
+    assert merged.count("Revenue up 12 percent") == 1
+    assert "Costs flat" in merged and "Margin improved" in merged
+
+
+def test_repeated_lines_at_other_heights_are_kept():
+    # 表の「同上」のように離れた高さで繰り返される行は取り除かない
+    left = "\n".join(["Item A", "same as above", "Item B", "Item C", "Item D", "Item E"])
+    right = "\n".join(["Price 100", "Price 200", "Price 300", "Price 400", "Price 500", "same as above"])
+    merged = merge_tile_texts({(0, 0): left, (0, 1): right}, 1, 2).splitlines()
+    assert merged.count("same as above") == 2
+
+
+def test_vertical_overlap_is_merged():
+    texts = {
+        (0, 0): "Chapter 1\nfirst line\nsecond line\nthird line",
+        (1, 0): "second line\nthird line\nfourth line\nfifth line",
+    }
+    merged = merge_tile_texts(texts, 2, 1).splitlines()
+    assert merged == ["Chapter 1", "first line", "second line", "third line", "fourth line", "fifth line"]
+
+
+def test_vertical_overlap_with_cut_line():
+    # 境界で切れた行（上の末尾・下の先頭）は読み取り結果が揃わなくても重なりとして取り除く
+    texts = {
+        (0, 0): "heading\nalpha beta gamma\ndelta epsilon\nhalf cut li",
+        (1, 0): "ne cut half\nalpha beta gamma\ndelta epsilon\nzeta eta",
+    }
+    merged = merge_tile_texts(texts, 2, 1).splitlines()
+    assert merged == ["heading", "alpha beta gamma", "delta epsilon", "half cut li", "zeta eta"]
@@ -0,0 +1,332 @@
+"""
+CPU推論のスレッド数（torchの演算内・演算間の並列数）の調整
+
+コンテナのCPU上限（cgroupのクォータ）を検出し、モデルの読み込み前にtorchのスレッド数を設定する。
+Cloud Runの1〜2 vCPUでは既定値（ホストのコア数）のままだとスレッドを作りすぎて遅くなり、
+大きなマシンでは逆にコアを使い切れないため、マシンごとに計測した設定（プロファイル）を使う
+
+    OCR_THREAD_TUNING=auto python app.py        # 既定: 保存済みのプロファイル、なければCPU上限から決める
+    OCR_THREAD_TUNING=calibrate python app.py   # プロファイルがなければ起動時に計測して保存する
+    OCR_THREAD_TUNING=off python app.py         # 従来どおりtorchの既定値のまま
+    OCR_THREAD_GOAL=throughput python app.py    # 同時実行時のスループットが最大の設定を選ぶ（既定: latency）
+
+    # 起動前に計測してプロファイルだけを作る
+    python thread_tuning.py --goal latency --streams 1
+
+計測は合成の負荷（視覚エンコーダー相当のまとまった行列積と、1トークンずつの生成相当の小さな行列積）を
+設定ごとに別プロセスで実行する（演算間のスレッド数は1プロセスで1回しか設定できないため）。
+プロファイルはCPUの種類・CPU上限・torchのバージョン・目的・同時実行数ごとにJSONに保存する
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# off: 設定しない / auto: 保存済みのプロファイルかCPU上限から決める / calibrate: なければ計測して保存する
+THREAD_TUNING = os.environ.get("OCR_THREAD_TUNING", "auto")
+# latency: 1件の処理時間が最短 / throughput: 同時実行時の処理件数が最大
+THREAD_GOAL = os.environ.get("OCR_THREAD_GOAL", "latency")
+# プロファイルの保存先（複数のマシンの設定を1つのファイルに保存できる）
+PROFILE_PATH = os.environ.get("OCR_THREAD_PROFILE", "./models/thread_profile.json")
+# 設定1つあたりの計測時間（秒）
+CALIBRATION_SECONDS = float(os.environ.get("OCR_THREAD_CALIBRATION_SECONDS", "3"))
+
+GOALS = ("latency", "throughput")
+# 合成負荷の大きさ（隠れ層の次元・視覚トークン数・生成トークン数・層数）
+HIDDEN = 1024
+VISION_TOKENS = 256
+DECODE_TOKENS = 16
+LAYERS = 4
+
+_applied = None
+_lock = threading.Lock()
+
+
+def cgroup_cpu_limit():
+    """cgroupのCPUクォータ（コア数、小数あり）を返す（制限がない・読めない場合はNone）"""
+    try:
+        # cgroup v2: "クォータ 周期" または "max 周期"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def affinity_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def effective_cpus():
+    """実際に使えるCPU数（実行可能なCPU数とCPUクォータの小さい方、クォータは切り上げ）"""
+    cpus = affinity_cpus()
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return cpus
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def machine_key(goal, streams):
+    """プロファイルを引くキー（CPUの種類・CPU数・CPU上限・torchのバージョン・目的・同時実行数）"""
+    import torch
+
+    limit = cgroup_cpu_limit()
+    return "|".join([
+        cpu_model(),
+        f"cpus={affinity_cpus()}",
+        f"quota={round(limit, 2) if limit is not None else 'none'}",
+        f"torch={torch.__version__}",
+        f"goal={goal}",
+        f"streams={streams}",
+    ])
+
+
+def default_profile(goal, streams):
+    """
+    計測していない場合の設定（CPU上限から決める）
+
+    latencyではCPUをすべて1件の演算に使い、throughputでは同時に処理する件数でCPUを分ける
+    """
+    cpus = effective_cpus()
+    intra = cpus if goal == "latency" else max(1, cpus // max(1, streams))
+    return {"intra_op": intra, "inter_op": 1, "source": "default"}
+
+
+def candidate_configs(cpus):
+    """計測する (演算内, 演算間) のスレッド数の組み合わせ"""
+    counts = sorted({1, cpus} | {count for count in (2, 4, 8, 16, 32, 64) if count < cpus})
+    inter_ops = (1, 2) if cpus >= 4 else (1,)
+    return [(intra, inter) for intra in counts for inter in inter_ops]
+
+
+def _synthetic_item(torch, weights, patches):
+    # 視覚エンコーダー・プリフィル相当（まとまった行列積）
+    hidden = patches
+    for weight in weights:
+        hidden = torch.nn.functional.gelu(hidden @ weight)
+    # 1トークンずつの生成相当（小さな行列積の繰り返し）
+    token = hidden[-1:]
+    for _ in range(DECODE_TOKENS):
+        for weight in weights:
+            token = torch.tanh(token @ weight)
+    return token
+
+
+def probe(intra_op, inter_op, streams, seconds):
+    """
+    このプロセスにスレッド数を設定して合成負荷を実行し、{"latency", "throughput"} を返す
+
+    streams件を同時に処理し、latencyは1件の処理時間の中央値（秒）、throughputは1秒あたりの処理件数
+    """
+    import torch
+
+    torch.set_num_threads(intra_op)
+    torch.set_num_interop_threads(inter_op)
+    generator = torch.Generator().manual_seed(0)
+    weights = [torch.randn(HIDDEN, HIDDEN, generator=generator) / math.sqrt(HIDDEN) for _ in range(LAYERS)]
+    patches = torch.randn(VISION_TOKENS, HIDDEN, generator=generator)
+    with torch.inference_mode():
+        _synthetic_item(torch, weights, patches)
+
+    durations = []
+    durations_lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def run_stream():
+        with torch.inference_mode():
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                _synthetic_item(torch, weights, patches)
+                with durations_lock:
+                    durations.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run_stream) for _ in range(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    durations.sort()
+    return {
+        "latency": durations[len(durations) // 2] if durations else None,
+        "throughput": len(durations) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def calibrate(goal=THREAD_GOAL, streams=1, seconds=CALIBRATION_SECONDS):
+    """スレッド数の組み合わせごとに別プロセスで合成負荷を計測し、目的に最も合う設定を返す"""
+    if goal not in GOALS:
+        raise ValueError(f"OCR_THREAD_GOALにはlatencyまたはthroughputを指定してください: {goal}")
+    cpus = effective_cpus()
+    # latencyでは1件ずつ処理したときの速さを比べる
+    streams = 1 if goal == "latency" else max(1, streams)
+    print(f"スレッド数を計測しています... (CPU: {cpus}, 目的: {goal}, 同時実行数: {streams})")
+    measurements = []
+    for intra_op, inter_op in candidate_configs(cpus):
+        env = dict(os.environ, OMP_NUM_THREADS=str(intra_op), MKL_NUM_THREADS=str(intra_op))
+        command = [
+            sys.executable, os.path.abspath(__file__), "--probe",
+            "--intra-op", str(intra_op), "--inter-op", str(inter_op),
+            "--streams", str(streams), "--seconds", str(seconds),
+        ]
+        completed = subprocess.run(command, env=env, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f"  {intra_op}/{inter_op}: 計測に失敗しました: {completed.stderr.strip()[-200:]}")
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        if result["latency"] is None:
+            continue
+        print(f"  {intra_op}/{inter_op}: {result['latency'] * 1000:.1f}ms, {result['throughput']:.2f}件/秒")
+        measurements.append(dict(result, intra_op=intra_op, inter_op=inter_op))
+
+    if not measurements:
+        print("警告: スレッド数を計測できなかったため、CPU上限から決めます")
+        return default_profile(goal, streams)
+    if goal == "latency":
+        best = min(measurements, key=lambda item: item["latency"])
+    else:
+        best = max(measurements, key=lambda item: item["throughput"])
+    return {
+        "intra_op": best["intra_op"],
+        "inter_op": best["inter_op"],
+        "source": "calibrated",
+        "latency": round(best["latency"], 5),
+        "throughput": round(best["throughput"], 3),
+        "calibrated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def load_profiles(path=PROFILE_PATH):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_profile(key, profile, path=PROFILE_PATH):
+    """プロファイルを保存する（他のマシンのプロファイルは残す）"""
+    profiles = load_profiles(path)
+    profiles[key] = profile
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # 書き込み途中のファイルを読まないよう一時ファイルから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(profiles, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"警告: スレッド数のプロファイルを保存できませんでした: {e}")
+
+
+def resolve_profile(mode=THREAD_TUNING, goal=THREAD_GOAL, streams=1, path=PROFILE_PATH):
+    """モードに応じて使う設定を決める（offの場合はNone）"""
+    if mode == "off":
+        return None
+    if mode not in ("auto", "calibrate"):
+        raise ValueError(f"OCR_THREAD_TUNINGにはauto、calibrateまたはoffを指定してください: {mode}")
+    streams = 1 if goal == "latency" else max(1, streams)
+    key = machine_key(goal, streams)
+    profile = load_profiles(path).get(key)
+    if profile is not None:
+        return dict(profile, source="profile")
+    if mode == "calibrate":
+        profile = calibrate(goal, streams)
+        if profile["source"] == "calibrated":
+            save_profile(key, profile, path)
+        return profile
+    return default_profile(goal, streams)
+
+
+def apply_thread_profile(streams=1):
+    """
+    torchのスレッド数を設定する（モデルの読み込み前に呼ぶ、2回目以降は最初の設定を返す）
+
+    GPU使用時・OCR_THREAD_TUNING=offでは設定せずNoneを返す
+    """
+    global _applied
+    with _lock:
+        if _applied is not None:
+            return _applied
+        import torch
+
+        if torch.cuda.is_available():
+            return None
+        profile = resolve_profile(streams=streams)
+        if profile is None:
+            return None
+        torch.set_num_threads(profile["intra_op"])
+        try:
+            torch.set_num_interop_threads(profile["inter_op"])
+        except RuntimeError:
+            # 演算間の並列処理が始まった後は変更できない（演算内のスレッド数だけ設定する）
+            pass
+        _applied = dict(
+            profile, intra_op=torch.get_num_threads(), inter_op=torch.get_num_interop_threads(),
+            cpus=effective_cpus(), cpu_limit=cgroup_cpu_limit(), goal=THREAD_GOAL,
+        )
+        print(f"torchのスレッド数: 演算内{_applied['intra_op']}, 演算間{_applied['inter_op']} ({profile['source']})")
+        return _applied
+
+
+def applied_profile():
+    """apply_thread_profileで設定した内容（設定していない場合はNone）"""
+    return _applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU推論のスレッド数を計測してプロファイルを保存する")
+    parser.add_argument("--goal", choices=GOALS, default=THREAD_GOAL)
+    parser.add_argument("--streams", type=int, default=1, help="同時に処理する件数（throughputのみ）")
+    parser.add_argument("--seconds", type=float, default=CALIBRATION_SECONDS, help="設定1つあたりの計測時間")
+    parser.add_argument("--output", default=PROFILE_PATH)
+    parser.add_argument("--probe", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--intra-op", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--inter-op", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        print(json.dumps(probe(args.intra_op, args.inter_op, args.streams, args.seconds)))
+        return
+
+    streams = 1 if args.goal == "latency" else max(1, args.streams)
+    profile = calibrate(args.goal, streams, args.seconds)
+    save_profile(machine_key(args.goal, streams), profile, args.output)
+    print(json.dumps(profile, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
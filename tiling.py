@@ -0,0 +1,237 @@
+"""
+大きな画像の分割OCR（ポスター・図面などの大判画像用）
+
+画素数予算に縮小すると文字が潰れる画像を、重なりのあるタイルに分割して並列に推論し、
+タイルごとのテキストを読み順（上の段から、段の中は行ごとに左から）に結合する。
+重なり部分で重複した行は、上のタイルの末尾と下のタイルの先頭の一致、
+左のタイルの同じ高さにある同じ行の有無から取り除く
+
+分割するのは、余白を除いた後も画素数予算を大きく超え、かつ文字が密な画像のみ
+（文字の少ない大きな写真は縮小しても読めるため、前処理で1枚として縮小する）
+
+    OCR_TILING=0 python app.py   # 分割せず従来どおり画素数予算に縮小する
+"""
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from difflib import SequenceMatcher
+
+from PIL import Image
+
+from job_queue import report_progress
+from preprocess import HIGH_DENSITY_THRESHOLD, TRIM_MARGINS, estimate_text_density, trim_margins
+
+# 1の場合は大きな画像をタイルに分割して推論する
+TILING = os.environ.get("OCR_TILING", "1") == "1"
+# 画素数が画素数予算の何倍を超えたら分割するか
+TILE_TRIGGER_RATIO = float(os.environ.get("OCR_TILE_TRIGGER_RATIO", "2.5"))
+# 隣り合うタイルの重なり（タイルの一辺に対する割合）
+TILE_OVERLAP = float(os.environ.get("OCR_TILE_OVERLAP", "0.08"))
+# タイル数の上限（超える場合は画像を縮小してから分割する）
+MAX_TILES = int(os.environ.get("OCR_MAX_TILES", "16"))
+# テキスト密度がこれ未満のタイルは推論しない（余白だけのタイル）
+EMPTY_TILE_DENSITY = float(os.environ.get("OCR_EMPTY_TILE_DENSITY", "0.002"))
+# 余白を除いた画像のテキスト密度がこれ以上の場合のみ分割する（縮小すると文字が潰れる密な文書）
+TILE_MIN_DENSITY = float(os.environ.get("OCR_TILE_MIN_DENSITY", str(HIGH_DENSITY_THRESHOLD)))
+
+# 重複とみなす行の最小文字数（短い行は偶然の一致が多いため残す）
+MIN_DEDUP_CHARS = 4
+# 上下のタイルで重複を探す最大行数
+MAX_OVERLAP_LINES = 6
+# 重なり部分で切れた行は読み取り結果が揺れるため、この類似度以上なら同じ行とみなす
+LINE_SIMILARITY = 0.85
+# 左右のタイルの行を同じ高さとみなす、タイル内の相対位置の差（段の中の最大行数に対する行数）
+POSITION_TOLERANCE = 1.5
+
+
+def tiling_settings():
+    """キャッシュキーに含める分割の設定値"""
+    return {
+        "enabled": TILING,
+        "trigger": TILE_TRIGGER_RATIO,
+        "overlap": TILE_OVERLAP,
+        "max_tiles": MAX_TILES,
+        "empty_density": EMPTY_TILE_DENSITY,
+        "min_density": TILE_MIN_DENSITY,
+    }
+
+
+def needs_tiling(image, max_pixels):
+    """
+    分割して推論する画像か（余白を除いた後も画素数予算を大きく超え、文字が密な画像）
+
+    文字の少ない写真などは画素数予算に縮小しても読めるため、分割せず1回の推論で処理する
+    """
+    threshold = max_pixels * TILE_TRIGGER_RATIO
+    if not TILING or image.width * image.height <= threshold:
+        return False
+    if TRIM_MARGINS:
+        image, _ = trim_margins(image)
+        if image.width * image.height <= threshold:
+            return False
+    return estimate_text_density(image) >= TILE_MIN_DENSITY
+
+
+def plan_tiles(width, height, max_pixels, overlap_ratio=TILE_OVERLAP, max_tiles=MAX_TILES):
+    """
+    画像をタイル1枚あたりmax_pixels以下に分割する配置を決める
+
+    戻り値: (縮小率, 段数, 列数, [(段, 列, (left, top, right, bottom)), ...]) （座標は縮小後の画像上）
+    """
+    side = max(1, int(math.sqrt(max_pixels)))
+    overlap = int(side * overlap_ratio)
+    scale = 1.0
+    while True:
+        scaled_width, scaled_height = max(1, int(width * scale)), max(1, int(height * scale))
+        cols = max(1, math.ceil((scaled_width - overlap) / (side - overlap)))
+        rows = max(1, math.ceil((scaled_height - overlap) / (side - overlap)))
+        if rows * cols <= max_tiles:
+            break
+        # タイル数が上限に収まるまで縮小する
+        scale *= math.sqrt(max_tiles / (rows * cols)) * 0.98
+
+    def spans(length, count):
+        size = math.ceil((length + (count - 1) * overlap) / count)
+        return [
+            (start, start + size)
+            for start in (min(index * (size - overlap), length - size) for index in range(count))
+        ]
+
+    tiles = [
+        (row, col, (left, top, right, bottom))
+        for row, (top, bottom) in enumerate(spans(scaled_height, rows))
+        for col, (left, right) in enumerate(spans(scaled_width, cols))
+    ]
+    return scale, rows, cols, tiles
+
+
+def _normalize(line):
+    return "".join(line.split()).lower()
+
+
+def _same_line(a, b):
+    a, b = _normalize(a), _normalize(b)
+    if a == b:
+        return True
+    if min(len(a), len(b)) < MIN_DEDUP_CHARS:
+        return False
+    return SequenceMatcher(None, a, b).ratio() >= LINE_SIMILARITY
+
+
+def _vertical_overlap(above, lines):
+    """
+    上のタイルの末尾と一致する、下のタイルの先頭の行数を返す
+
+    境界で切れた行は読み取り結果が揃わないため、上のタイルの末尾1行・下のタイルの先頭1行を
+    読み飛ばした一致も探す（下のタイルの読み飛ばした行も取り除く）
+    """
+    for count in range(min(MAX_OVERLAP_LINES, len(above), len(lines)), 0, -1):
+        for tail_skip in (0, 1):
+            tail = above[len(above) - tail_skip - count:len(above) - tail_skip]
+            for head_skip in (0, 1):
+                head = lines[head_skip:head_skip + count]
+                if len(tail) == count and len(head) == count and all(_same_line(a, b) for a, b in zip(tail, head)):
+                    return head_skip + count
+    return 0
+
+
+def merge_tile_texts(texts, rows, cols):
+    """
+    タイルごとのテキスト {(段, 列): テキスト} を読み順に結合し、重なり部分の重複行を取り除く
+
+    テキストには座標がないため、各行の高さはタイル内の行の順番から推定する（タイル内で行は等間隔とみなす）。
+    段の中では推定した高さごとに左のタイルから順に並べ、横に長い行が列ごとに分かれて出力されないようにする。
+    左右の重なりで取り除くのは、左のタイルのほぼ同じ高さに同じ行がある場合のみ
+    （表の「0」「同上」など、離れた位置で繰り返される行は残す）
+    """
+    lines = {key: [line for line in text.splitlines() if line.strip()] for key, text in texts.items()}
+    output = []
+    for row in range(rows):
+        slots = max([len(lines.get((row, col), [])) for col in range(cols)] + [1])
+        placed = []
+        left = []
+        for col in range(cols):
+            current = lines.get((row, col))
+            if not current:
+                left = []
+                continue
+            # タイル内の相対的な高さ（0〜slots）
+            positions = [(index + 0.5) / len(current) * slots for index in range(len(current))]
+            start = 0
+            # 上のタイルとの重なり: 下のタイルの先頭に、上のタイルの末尾と同じ行が並ぶ
+            above = lines.get((row - 1, col))
+            if above:
+                start = _vertical_overlap(above, current)
+            kept = []
+            for position, line in zip(positions[start:], current[start:]):
+                # 左のタイルとの重なり: 重なりの帯に収まる行は、左右のタイルのほぼ同じ高さに現れる
+                duplicate = len(_normalize(line)) >= MIN_DEDUP_CHARS and any(
+                    abs(position - left_position) <= POSITION_TOLERANCE and _same_line(left_line, line)
+                    for left_position, left_line in left
+                )
+                if not duplicate:
+                    kept.append((position, line))
+            placed.extend((int(position), col, order, line) for order, (position, line) in enumerate(kept))
+            left = list(zip(positions, current))
+        # 高さごとに左のタイルから順に並べる
+        output.extend(line for _, _, _, line in sorted(placed, key=lambda item: item[:3]))
+    return "\n".join(output)
+
+
+def split_image(image, max_pixels):
+    """
+    余白を除いた画像をタイルに分割する
+
+    戻り値: (分割前の画像（余白除去・縮小後）, 段数, 列数, [(段, 列, 範囲, タイル画像), ...], 分割の情報)
+    """
+    trimmed_box = None
+    if TRIM_MARGINS:
+        image, trimmed_box = trim_margins(image)
+    scale, rows, cols, boxes = plan_tiles(image.width, image.height, max_pixels)
+    if scale < 1.0:
+        image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.LANCZOS)
+    tiles = [(row, col, box, image.crop(box)) for row, col, box in boxes]
+    info = {
+        "trimmed_box": list(trimmed_box) if trimmed_box else None,
+        "scale": round(scale, 4),
+        "grid": [rows, cols],
+        "size": [image.width, image.height],
+    }
+    return image, rows, cols, tiles, info
+
+
+def ocr_tiles(image, max_pixels, ocr_fn, max_workers=1):
+    """
+    画像をタイルに分割して並列に推論し、結合したテキストを返す
+
+    ocr_fn(タイル画像) -> {"text": テキスト, ...} （その他の項目はタイルごとの結果として残す）
+    戻り値: {"text": 結合したテキスト, "image": 分割前の画像, "tiles": [{"row", "col", "box", "skipped", "result"}],
+            "tiling": 分割の情報}
+    """
+    image, rows, cols, tiles, info = split_image(image, max_pixels)
+    # 余白だけのタイルは推論せずに飛ばす
+    targets = [tile for tile in tiles if estimate_text_density(tile[3]) >= EMPTY_TILE_DENSITY]
+    info["tiles"] = len(tiles)
+    info["skipped_tiles"] = len(tiles) - len(targets)
+    print(f"画像を{rows}x{cols}のタイルに分割して処理します (推論: {len(targets)}枚, 縮小率: {info['scale']})")
+
+    workers = max(1, min(max_workers, len(targets)))
+    by_key = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-tile") as pool:
+        futures = {pool.submit(ocr_fn, tile[3]): (tile[0], tile[1]) for tile in targets}
+        for done, future in enumerate(as_completed(futures), start=1):
+            by_key[futures[future]] = future.result()
+            # 非同期ジョブとして処理している場合はタイル単位の進捗を記録する
+            report_progress(done / len(targets), f"タイル {done}/{len(targets)}")
+
+    text = merge_tile_texts({key: result["text"] for key, result in by_key.items()}, rows, cols)
+    return {
+        "text": text,
+        "image": image,
+        "tiles": [
+            {"row": row, "col": col, "box": list(box), "skipped": (row, col) not in by_key,
+             "result": by_key.get((row, col))}
+            for row, col, box, _ in tiles
+        ],
+        "tiling": info,
+    }
@@ -0,0 +1,280 @@
+import os
+import gradio as gr
+from admission import AdmissionController, AdmissionRejected, client_id
+from batch_documents import process_documents
+from job_queue import JobQueue
+from metrics import register_admission, register_jobs
+from model_registry import MODEL_WAIT_SECONDS, ModelNotReady
+from ocr_artifacts import annotated_image, boxes_requested
+from ocr_engine import OCREngine
+from generation_control import FINISH_LENGTH, FINISH_REPETITION
+from rest_api import create_api, decode_image, serve
+from web_common import (encode_image_base64, get_adsense_bottom, get_adsense_script, get_adsense_top, get_analytics_script,
+                        get_favicon)
+
+# Qwen3-VLとDeepSeek-OCRを1つのプロセスで提供する（モデルは必要になった時点で読み込む）
+#   OCR_BACKENDS / OCR_ROUTES / OCR_MEMORY_BUDGET_GB で使うモデル・振り分け規則・メモリ予算を指定する
+engine = OCREngine()
+
+# メトリクス・ログで使うアプリ名
+APP_NAME = "unified-ocr"
+
+# 混雑時に待たせずに拒否・縮退させる受付制御（UI・API・一括処理で共有、モデルによらず1つ）
+admission = AdmissionController(APP_NAME)
+register_admission(APP_NAME, admission)
+
+# 一括処理で同時に処理するページ数
+PAGE_WORKERS = int(os.environ.get("OCR_PAGE_WORKERS", "2"))
+
+# UIの選択肢とAPIのパラメータ値
+UI_TASKS = {"OCR": "ocr", "Markdown": "markdown"}
+UI_BACKENDS = {"自動": "auto", "Qwen3-VL-2B": "qwen", "DeepSeek-OCR": "deepseek"}
+UI_CROP_MODES = {"自動": "auto", "有効": "on", "無効": "off"}
+
+def display_info(result):
+    """UIに表示する処理パラメータ（使ったモデル・前処理・生成の結果）"""
+    return dict(result["preprocess"], backend=result["backend"], generation=result["generation"])
+
+def process_image_unified(image, task, backend, crop_mode, request: gr.Request = None):
+    """
+    Gradio用の画像処理関数
+
+    (テキスト, 処理パラメータ, 読み順のブロック, 検出結果画像の描画に使う結果) を返す
+    （画像はrender_boxes_unifiedで描画する）
+    """
+    if image is None:
+        return "エラー: 画像がアップロードされていません", None, None, None
+
+    options = {"backend": UI_BACKENDS[backend], "crop_mode": UI_CROP_MODES[crop_mode]}
+    try:
+        with admission.admit(client_id(request)) as ticket:
+            result = engine.ocr(image, UI_TASKS[task], options, degraded=ticket.degraded)
+            ticket.measured = not result["cached"]
+        artifacts = {"image": image, "blocks": result["blocks"]}
+        return result["text"], display_info(result), result["blocks"], artifacts
+
+    except (AdmissionRejected, ModelNotReady, ValueError) as e:
+        return f"エラー: {e}", None, None, None
+    except Exception as e:
+        import traceback
+        error_msg = f"エラーが発生しました: {str(e)}\n\n詳細:\n{traceback.format_exc()}"
+        print(error_msg)
+        return error_msg, None, None, None
+
+def render_boxes_unified(artifacts, show_boxes):
+    """検出結果画像の表示が選ばれていて、参照領域がある場合のみ描画する"""
+    if not show_boxes or not artifacts:
+        return None
+    return annotated_image(artifacts["image"], artifacts["blocks"])
+
+def process_documents_unified(files, task, backend, request: gr.Request = None):
+    """複数の画像・PDFをページ順に処理し、結合したテキストと処理時間を返す（受付制御はページ単位）"""
+    client = client_id(request)
+    options = {"backend": UI_BACKENDS[backend]}
+
+    def ocr_page(image):
+        with admission.admit(client) as ticket:
+            result = engine.ocr(image, UI_TASKS[task], options, degraded=ticket.degraded)
+            ticket.measured = not result["cached"]
+        return result["text"]
+
+    try:
+        return process_documents(files, ocr_page, max_workers=PAGE_WORKERS)
+    except Exception as e:
+        import traceback
+        error_msg = f"エラーが発生しました: {str(e)}\n\n詳細:\n{traceback.format_exc()}"
+        print(error_msg)
+        return error_msg, ""
+
+def api_result(image, params, trace=None, degraded=False, wait_seconds=MODEL_WAIT_SECONDS):
+    """
+    APIで返す結果（検出結果画像を除く）と、boxes=1の場合のみ検出結果画像を返す
+
+    task=ocr|markdown, backend=auto|qwen|deepseek, crop_mode=auto|on|off（DeepSeek-OCRのみ）
+    """
+    options = {"backend": params.get("backend", "auto"), "crop_mode": params.get("crop_mode", "auto")}
+    result = engine.ocr(image, params.get("task", "ocr"), options, trace, degraded=degraded, wait_seconds=wait_seconds)
+    response = {
+        "backend": result["backend"],
+        "model": result["model"],
+        "task": result["task"],
+        "text": result["text"],
+        # DeepSeek-OCRのMarkdownでは領域ごとの種類・座標・テキストを読み順に返す（それ以外はNone・空）
+        "blocks": result["blocks"],
+        "preprocess": result["preprocess"],
+        "cached": result["cached"],
+        # ほぼ同一の画像の結果を返した場合はハッシュのハミング距離（それ以外はNone）
+        "near_duplicate": result.get("near_duplicate"),
+        "degraded": degraded and not result["cached"],
+        # finish_reason: stop（最後まで生成）/ length（上限で打ち切り）/ repetition（繰り返しで打ち切り）
+        "generation": result["generation"],
+        "truncated": result["generation"]["finish_reason"] == FINISH_LENGTH,
+        "early_stopped": result["generation"]["finish_reason"] == FINISH_REPETITION,
+        "boxes_image": None
+    }
+    return response, annotated_image(image, result["blocks"]) if boxes_requested(params) else None
+
+def api_ocr(image, params, trace=None, ticket=None):
+    """HTTP API用のOCR処理（boxes=1で検出結果画像を付与、受付判定はAPI側で済んでいる）"""
+    response, result_image = api_result(image, params, trace, degraded=ticket is not None and ticket.degraded)
+    if result_image is not None:
+        response["boxes_image"] = encode_image_base64(result_image)
+    return response
+
+def job_ocr(image, params, trace):
+    """非同期ジョブ用のOCR処理（起動直後のモデルの読み込みは完了まで待つ、boxes=1の場合のみ検出結果画像を保存）"""
+    return api_result(image, params, trace, wait_seconds=None)
+
+def api_health():
+    return {
+        "ready": engine.ready(),
+        "engine": engine.status(),
+        "admission": admission.stats()
+    }
+
+# Gradioインターフェースの作成
+with gr.Blocks(
+    title="無料OCRツール - Qwen3-VL / DeepSeek-OCR",
+    head=get_favicon() + get_analytics_script() + get_adsense_script()
+) as demo:
+    # トップバナー広告
+    if get_adsense_top():
+        gr.HTML(get_adsense_top())
+
+    gr.Markdown(
+        """
+        # OCRツール（Qwen3-VL / DeepSeek-OCR）
+
+        画像からテキストを抽出します。「自動」ではテキスト抽出をQwen3-VL、Markdown変換をDeepSeek-OCRで処理します。
+        """
+    )
+
+    with gr.Tabs():
+        with gr.Tab("画像1枚"):
+            with gr.Row():
+                with gr.Column():
+                    image_input = gr.Image(
+                        type="pil",
+                        label="画像をアップロード"
+                    )
+
+                    task_radio = gr.Radio(
+                        choices=list(UI_TASKS),
+                        value="OCR",
+                        label="処理タイプ"
+                    )
+
+                    backend_radio = gr.Radio(
+                        choices=list(UI_BACKENDS),
+                        value="自動",
+                        label="モデル"
+                    )
+
+                    crop_mode_radio = gr.Radio(
+                        choices=list(UI_CROP_MODES),
+                        value="自動",
+                        label="クロップモード（DeepSeek-OCRのみ）"
+                    )
+
+                    submit_btn = gr.Button("処理実行", variant="primary")
+
+                with gr.Column():
+                    output_text = gr.Textbox(
+                        label="OCR結果テキスト",
+                        lines=15,
+                        max_lines=30,
+                        placeholder="結果がここに表示されます...",
+                        show_copy_button=True
+                    )
+
+                    show_boxes = gr.Checkbox(
+                        value=True,
+                        label="検出結果画像を表示（Markdownの参照領域がある場合のみ）"
+                    )
+
+                    output_image = gr.Image(
+                        label="検出結果（バウンディングボックス付き）",
+                        type="pil"
+                    )
+
+                    layout_output = gr.JSON(
+                        label="レイアウト（読み順のブロック: 種類・座標・テキスト）"
+                    )
+
+                    preprocess_info = gr.JSON(
+                        label="使用したモデル・前処理・生成トークン数"
+                    )
+
+                    result_artifacts = gr.State(None)
+
+        with gr.Tab("一括処理（複数画像・PDF）"):
+            with gr.Row():
+                with gr.Column():
+                    files_input = gr.File(
+                        file_count="multiple",
+                        file_types=["image", ".pdf"],
+                        label="画像・PDFをアップロード（複数可）"
+                    )
+
+                    batch_task_radio = gr.Radio(
+                        choices=list(UI_TASKS),
+                        value="Markdown",
+                        label="処理タイプ"
+                    )
+
+                    batch_backend_radio = gr.Radio(
+                        choices=list(UI_BACKENDS),
+                        value="自動",
+                        label="モデル"
+                    )
+
+                    batch_btn = gr.Button("一括処理実行", variant="primary")
+
+                    batch_timings = gr.Markdown()
+
+                with gr.Column():
+                    batch_output = gr.Textbox(
+                        label="結合された結果（ページ順）",
+                        lines=15,
+                        max_lines=30,
+                        placeholder="結果がここに表示されます...",
+                        show_copy_button=True
+                    )
+
+    submit_btn.click(
+        fn=process_image_unified,
+        inputs=[image_input, task_radio, backend_radio, crop_mode_radio],
+        outputs=[output_text, preprocess_info, layout_output, result_artifacts]
+    ).then(
+        fn=render_boxes_unified,
+        inputs=[result_artifacts, show_boxes],
+        outputs=[output_image]
+    )
+
+    show_boxes.change(
+        fn=render_boxes_unified,
+        inputs=[result_artifacts, show_boxes],
+        outputs=[output_image]
+    )
+
+    batch_btn.click(
+        fn=process_documents_unified,
+        inputs=[files_input, batch_task_radio, batch_backend_radio],
+        outputs=[batch_output, batch_timings]
+    )
+
+    # ボトムバナー広告
+    if get_adsense_bottom():
+        gr.HTML(get_adsense_bottom())
+
+if __name__ == "__main__":
+    # Cloud Run環境ではPORT環境変数を使用
+    port = int(os.environ.get("PORT", 7860))
+    # 振り分け規則で先に挙がるモデルからメモリ予算に収まる分を読み込む（OCR_MODEL_LOADINGに従う）
+    engine.start_from_env()
+    # 長いドキュメント向けの非同期ジョブ（/api/jobs、完了まで/api/ocrと同じ受付制御の件数に数える）
+    jobs = JobQueue(APP_NAME, job_ocr, decode_image, admission=admission).start()
+    register_jobs(APP_NAME, jobs)
+    # Gradio UIとHTTP API（/api/ocr, /api/jobs, /healthz）を同じサーバーで提供
+    api = create_api(api_ocr, api_health, title="OCR API", app_name=APP_NAME, admission=admission, jobs=jobs)
+    serve(demo, api, port)
@@ -0,0 +1,103 @@
+"""
+Gradio UIで共通のヘッダー・広告のHTML（Google Analytics・AdSense・ファビコン）と、APIの応答で共通の処理
+"""
+import base64
+import io
+import os
+
+# Google Analytics設定（環境変数から取得）
+GA_MEASUREMENT_ID = os.environ.get("GA_MEASUREMENT_ID", "G-01HQFFXE17")
+
+# Google AdSense設定（環境変数から取得）
+ADSENSE_CLIENT_ID = os.environ.get("ADSENSE_CLIENT_ID", "")
+ADSENSE_SLOT_TOP = os.environ.get("ADSENSE_SLOT_TOP", "")
+ADSENSE_SLOT_BOTTOM = os.environ.get("ADSENSE_SLOT_BOTTOM", "")
+
+
+# AdSense広告HTML（設定されている場合のみ表示）
+def get_adsense_top():
+    if ADSENSE_CLIENT_ID and ADSENSE_SLOT_TOP:
+        return f"""
+        <div class="adsense-banner-top" style="text-align: center; margin: 20px 0;">
+          <ins class="adsbygoogle"
+               style="display:block"
+               data-ad-client="ca-pub-{ADSENSE_CLIENT_ID}"
+               data-ad-slot="{ADSENSE_SLOT_TOP}"
+               data-ad-format="auto"
+               data-full-width-responsive="true"></ins>
+          <script>
+               (adsbygoogle = window.adsbygoogle || []).push({{}});
+          </script>
+        </div>
+        """
+    return ""
+
+
+def get_adsense_bottom():
+    if ADSENSE_CLIENT_ID and ADSENSE_SLOT_BOTTOM:
+        return f"""
+        <div class="adsense-banner-bottom" style="text-align: center; margin: 20px 0;">
+          <ins class="adsbygoogle"
+               style="display:block"
+               data-ad-client="ca-pub-{ADSENSE_CLIENT_ID}"
+               data-ad-slot="{ADSENSE_SLOT_BOTTOM}"
+               data-ad-format="auto"
+               data-full-width-responsive="true"></ins>
+          <script>
+               (adsbygoogle = window.adsbygoogle || []).push({{}});
+          </script>
+        </div>
+        """
+    return ""
+
+
+def get_favicon():
+    """ファビコン設定"""
+    # SVGをdata URIとして埋め込み
+    favicon_svg = '''<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 64 64" width="64" height="64"><rect width="64" height="64" fill="%232563eb" rx="8"/><rect x="14" y="12" width="36" height="40" fill="white" rx="2"/><rect x="18" y="18" width="20" height="3" fill="%232563eb" rx="1"/><rect x="18" y="24" width="28" height="3" fill="%232563eb" rx="1"/><rect x="18" y="30" width="24" height="3" fill="%232563eb" rx="1"/><rect x="18" y="36" width="26" height="3" fill="%232563eb" rx="1"/><line x1="12" y1="28" x2="52" y2="28" stroke="%2360a5fa" stroke-width="2" opacity="0.7"/><circle cx="48" cy="44" r="6" fill="none" stroke="%2310b981" stroke-width="2.5"/><line x1="52" y1="48" x2="56" y2="52" stroke="%2310b981" stroke-width="2.5" stroke-linecap="round"/></svg>'''
+
+    return f'''
+    <link rel="icon" type="image/svg+xml" href="data:image/svg+xml,{favicon_svg}">
+    <link rel="apple-touch-icon" href="data:image/svg+xml,{favicon_svg}">
+    '''
+
+
+def get_analytics_script():
+    """Google Analyticsトラッキングコード"""
+    if GA_MEASUREMENT_ID:
+        return f"""
+        <!-- Google tag (gtag.js) -->
+        <script async src="https://www.googletagmanager.com/gtag/js?id={GA_MEASUREMENT_ID}"></script>
+        <script>
+          window.dataLayer = window.dataLayer || [];
+          function gtag(){{dataLayer.push(arguments);}}
+          gtag('js', new Date());
+          gtag('config', '{GA_MEASUREMENT_ID}');
+        </script>
+        """
+    return ""
+
+
+def get_adsense_script():
+    if ADSENSE_CLIENT_ID:
+        return f"""
+        <script async src="https://pagead2.googlesyndication.com/pagead/js/adsbygoogle.js?client=ca-pub-{ADSENSE_CLIENT_ID}"
+             crossorigin="anonymous"></script>
+        """
+    return ""
+
+
+def is_embedded():
+    """
+    統合アプリ（unified_app.py）・推論ワーカーからOCR処理だけを使うために読み込まれたか（OCR_EMBEDDED=1）
+
+    この場合、各アプリのモジュールは受付制御・UIを作らない（呼び出し側が1つだけ持つ）
+    """
+    return os.environ.get("OCR_EMBEDDED", "0") == "1"
+
+
+def encode_image_base64(image):
+    """APIの応答に含める画像（JPEG）のBase64文字列"""
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
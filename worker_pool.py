@@ -0,0 +1,350 @@
+"""
+推論を別プロセスのワーカーで行うためのディスパッチャ（フロントエンド側）
+
+    OCR_WORKERS=2 python app.py
+
+- 各ワーカーは ocr_worker.py として起動し、アプリのモジュールを読み込んでモデルを保持する
+- 利用可能なCPUをワーカー数で分割し、各ワーカーのtorchのスレッド数と実行CPU（アフィニティ）を固定する
+- 変換済みモデル（prepared_model.py）はメモリマップで読み込まれるため、重みのページは全ワーカーで共有される
+- リクエストは処理中の件数が最も少ないワーカーに送り、異常終了・無応答のワーカーは自動で再起動する
+"""
+import atexit
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from multiprocessing.connection import Connection
+
+# 推論ワーカーのプロセス数（0の場合は従来どおり同じプロセスで推論する）
+WORKERS = int(os.environ.get("OCR_WORKERS", "0"))
+# ワーカー1つあたりのtorchのスレッド数（0の場合は利用可能なCPU数をワーカー数で等分）
+WORKER_THREADS = int(os.environ.get("OCR_WORKER_THREADS", "0"))
+# 1の場合は各ワーカーを割り当てたCPUに固定する
+PIN_CPUS = os.environ.get("OCR_WORKER_PIN_CPUS", "1") == "1"
+# モデルの読み込みを含む起動の待ち時間、1件の推論の待ち時間（秒）
+START_TIMEOUT = float(os.environ.get("OCR_WORKER_START_TIMEOUT", "900"))
+REQUEST_TIMEOUT = float(os.environ.get("OCR_WORKER_REQUEST_TIMEOUT", "600"))
+# 死活監視の間隔と、応答がないとみなして再起動するまでの時間（秒）
+PING_INTERVAL = float(os.environ.get("OCR_WORKER_PING_INTERVAL", "10"))
+PING_TIMEOUT = float(os.environ.get("OCR_WORKER_PING_TIMEOUT", "60"))
+
+# ワーカープロセスではこの環境変数がworkerになる（モデルを自分で読み込む）
+ROLE_ENV = "OCR_WORKER_ROLE"
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_worker.py")
+
+
+def is_frontend():
+    """ワーカープロセスに推論を任せる側のプロセスか"""
+    return WORKERS > 0 and os.environ.get(ROLE_ENV) != "worker"
+
+
+class WorkerError(RuntimeError):
+    """ワーカーの異常終了・無応答（別のワーカーで再試行できる）"""
+
+
+class InferenceError(RuntimeError):
+    """ワーカー内の推論で発生した例外（再試行しない）"""
+
+
+def available_cpus():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def partition_cpus(workers, threads=0):
+    """
+    利用可能なCPUをワーカー数で分割し、ワーカーごとの (CPUのリスト, スレッド数) を返す
+
+    スレッド数はCPUのクォータ（cgroup）で実際に使えるCPU数を等分する
+    """
+    from thread_tuning import effective_cpus
+
+    cpus = available_cpus()
+    per_worker = threads or max(1, effective_cpus() // workers)
+    plans = []
+    for index in range(workers):
+        start = (index * per_worker) % len(cpus)
+        assigned = [cpus[(start + offset) % len(cpus)] for offset in range(min(per_worker, len(cpus)))]
+        plans.append((assigned, per_worker))
+    return plans
+
+
+class _Worker:
+    def __init__(self, index, cpus, threads):
+        self.index = index
+        self.cpus = cpus
+        self.threads = threads
+        self.process = None
+        self.sender = None
+        self.pid = None
+        self.healthy = False
+        self.pending = {}
+        self.served = 0
+        self.restarts = 0
+        self.last_pong = 0.0
+        self.send_lock = threading.Lock()
+
+    def send(self, message):
+        with self.send_lock:
+            self.sender.send(message)
+
+
+class WorkerPool:
+    """
+    ワーカープロセス群への推論の振り分け
+
+    module_nameのモジュールはworker_infer(request, trace)とWORKER_CONCURRENCYを定義している必要がある
+    """
+
+    def __init__(self, module_name, workers=WORKERS, threads=WORKER_THREADS, pin_cpus=PIN_CPUS):
+        self.module_name = module_name
+        self.workers = [
+            _Worker(index, cpus if pin_cpus else None, count)
+            for index, (cpus, count) in enumerate(partition_cpus(workers, threads))
+        ]
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self):
+        """全ワーカーを並行して起動し、モデルの読み込みが終わるまで待つ"""
+        threads = [
+            threading.Thread(target=self._spawn, args=(worker,), name=f"ocr-worker-{worker.index}-start")
+            for worker in self.workers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if not any(worker.healthy for worker in self.workers):
+            raise RuntimeError("推論ワーカーを起動できませんでした")
+        for worker in self.workers:
+            if not worker.healthy:
+                threading.Thread(target=self._restart, args=(worker,), daemon=True).start()
+
+        threading.Thread(target=self._monitor, name="ocr-worker-monitor", daemon=True).start()
+        atexit.register(self.close)
+        return self
+
+    def _spawn(self, worker):
+        """ワーカーを起動し、準備完了の通知を待つ（失敗時はFalse）"""
+        parent_read, child_write = os.pipe()
+        child_read, parent_write = os.pipe()
+        env = dict(os.environ)
+        env[ROLE_ENV] = "worker"
+        env["OCR_WORKER_THREADS"] = str(worker.threads)
+        # torchより先に読み込まれるOpenMP/MKLのスレッド数も揃える
+        env["OMP_NUM_THREADS"] = str(worker.threads)
+        env["MKL_NUM_THREADS"] = str(worker.threads)
+        if worker.cpus:
+            env["OCR_WORKER_CPUS"] = ",".join(str(cpu) for cpu in worker.cpus)
+        command = [
+            sys.executable, WORKER_SCRIPT,
+            "--app", self.module_name,
+            "--index", str(worker.index),
+            "--fds", f"{child_read},{child_write}",
+        ]
+        process = subprocess.Popen(command, env=env, pass_fds=(child_read, child_write))
+        os.close(child_read)
+        os.close(child_write)
+        receiver = Connection(parent_read, writable=False)
+        sender = Connection(parent_write, readable=False)
+
+        hello = None
+        deadline = time.monotonic() + START_TIMEOUT
+        while hello is None:
+            try:
+                if receiver.poll(1.0):
+                    hello = receiver.recv()
+                    break
+            except (EOFError, OSError):
+                break
+            if process.poll() is not None or time.monotonic() > deadline:
+                break
+
+        if hello is None:
+            print(f"推論ワーカー{worker.index}の起動に失敗しました (終了コード: {process.poll()})")
+            self._kill(process)
+            receiver.close()
+            sender.close()
+            return False
+
+        with self._lock:
+            worker.process = process
+            worker.sender = sender
+            worker.pid = hello["pid"]
+            worker.last_pong = time.monotonic()
+            worker.healthy = True
+        threading.Thread(
+            target=self._reader, args=(worker, process, receiver),
+            name=f"ocr-worker-{worker.index}-reader", daemon=True
+        ).start()
+        cpus = f", CPU: {hello.get('cpus')}" if hello.get("cpus") else ""
+        print(f"推論ワーカー{worker.index}が起動しました (PID: {worker.pid}, スレッド数: {hello.get('threads')}{cpus})")
+        return True
+
+    def _reader(self, worker, process, receiver):
+        try:
+            while True:
+                message = receiver.recv()
+                if message["op"] == "pong":
+                    worker.last_pong = time.monotonic()
+                    continue
+                with self._lock:
+                    future = worker.pending.pop(message["id"], None)
+                    worker.served += 1
+                if future is None:
+                    continue
+                if message.get("error"):
+                    future.set_exception(InferenceError(message["error"]))
+                else:
+                    future.set_result(message)
+        except (EOFError, OSError):
+            pass
+        finally:
+            receiver.close()
+        self._on_failure(worker, process, "接続が切断されました")
+
+    def _on_failure(self, worker, process, reason):
+        """処理中のリクエストを失敗させ、ワーカーを再起動する"""
+        with self._lock:
+            if worker.process is not process or not worker.healthy:
+                return
+            worker.healthy = False
+            pending, worker.pending = worker.pending, {}
+        for future in pending.values():
+            future.set_exception(WorkerError(f"推論ワーカー{worker.index}が停止しました: {reason}"))
+        self._kill(process)
+        try:
+            worker.sender.close()
+        except OSError:
+            pass
+        if self._closed:
+            return
+
+        print(f"推論ワーカー{worker.index}を再起動します ({reason})")
+        threading.Thread(target=self._restart, args=(worker,), name=f"ocr-worker-{worker.index}-restart",
+                         daemon=True).start()
+
+    def _restart(self, worker):
+        delay = 1.0
+        while not self._closed:
+            worker.restarts += 1
+            if self._spawn(worker):
+                return
+            # 起動に失敗し続ける場合は間隔を空けて再試行する
+            time.sleep(delay)
+            delay = min(delay * 2, 60.0)
+
+    def _monitor(self):
+        while not self._closed:
+            time.sleep(PING_INTERVAL)
+            now = time.monotonic()
+            for worker in self.workers:
+                if not worker.healthy:
+                    continue
+                process = worker.process
+                if now - worker.last_pong > PING_TIMEOUT + PING_INTERVAL:
+                    # 応答しないワーカーは強制終了する（読み取りスレッドがEOFを受けて再起動する）
+                    print(f"推論ワーカー{worker.index}が{PING_TIMEOUT:.0f}秒以上応答しません")
+                    self._kill(process)
+                    continue
+                try:
+                    worker.send({"op": "ping"})
+                except OSError:
+                    self._kill(process)
+
+    @staticmethod
+    def _kill(process):
+        if process is None or process.poll() is not None:
+            return
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+    def _dispatch(self, request):
+        """処理中の件数が最も少ないワーカーに送る"""
+        with self._lock:
+            candidates = [worker for worker in self.workers if worker.healthy]
+            if not candidates:
+                raise WorkerError("利用できる推論ワーカーがありません（再起動中）")
+            worker = min(candidates, key=lambda w: (len(w.pending), w.served))
+            request_id = next(self._ids)
+            future = Future()
+            worker.pending[request_id] = future
+        try:
+            worker.send({"op": "infer", "id": request_id, "request": request})
+        except OSError as e:
+            with self._lock:
+                worker.pending.pop(request_id, None)
+            raise WorkerError(f"推論ワーカー{worker.index}に送信できません: {e}")
+        return worker, request_id, future
+
+    def call(self, request, trace=None, timeout=REQUEST_TIMEOUT):
+        """
+        ワーカーで1件を推論して結果を返す
+
+        ワーカーが異常終了した場合は別のワーカーで1回だけ再試行する
+        traceを渡した場合はワーカー内の段階別の時間と、プロセス間通信の時間（ipc）を記録する
+        """
+        started = time.perf_counter()
+        for attempt in range(2):
+            try:
+                worker, request_id, future = self._dispatch(request)
+                try:
+                    reply = future.result(timeout=timeout)
+                except FutureTimeoutError:
+                    with self._lock:
+                        worker.pending.pop(request_id, None)
+                    raise WorkerError(f"推論ワーカー{worker.index}の応答がタイムアウトしました")
+                break
+            except WorkerError as e:
+                if attempt:
+                    raise
+                print(f"{e}（別のワーカーで再試行します）")
+
+        if trace is not None:
+            for name, seconds in reply["stages"].items():
+                trace.add(name, seconds)
+            for name, value in reply["values"].items():
+                trace.set(name, value)
+            trace.set("worker", worker.index)
+            trace.add("ipc", max(0.0, time.perf_counter() - started - reply["worker_seconds"]))
+        return reply["result"]
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    "index": worker.index,
+                    "pid": worker.pid,
+                    "healthy": worker.healthy,
+                    "in_flight": len(worker.pending),
+                    "served": worker.served,
+                    "restarts": worker.restarts,
+                    "threads": worker.threads,
+                    "cpus": worker.cpus,
+                }
+                for worker in self.workers
+            ]
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self.workers:
+            if worker.healthy:
+                try:
+                    worker.send({"op": "shutdown"})
+                except OSError:
+                    pass
+            self._kill(worker.process)